@@ -0,0 +1,66 @@
+"""
+Runs the MySQL rules of config/gx_rules.yaml on SQLite, for benchmarks.
+
+Named by a lender's `sql_shim = "benchmarks.sqlite_shim"` in secrets.toml (see
+GXRunner._register_sql_shim). rewrite() handles the MySQL syntax the rules use
+that SQLite has no function for; on_connect() adds the missing functions and
+tunes each connection for large read-only scans.
+
+    NOW() - INTERVAL 24 HOUR   -> datetime('now', 'localtime', '-24 hours')
+    a <=> b                    -> a IS b
+    LEAST(...) / GREATEST(...) -> MIN(...) / MAX(...)   (multi-argument, NULL if any is NULL)
+    data_warehouse.v73__x      -> v73__x
+"""
+import re
+import zlib
+import datetime
+
+_INTERVAL = re.compile(
+    r"(?:NOW\(\)|CURRENT_TIMESTAMP(?:\(\))?)\s*-\s*INTERVAL\s+(\d+)\s+(SECOND|MINUTE|HOUR|DAY)\b", re.IGNORECASE
+)
+_LEAST = re.compile(r"\bLEAST\s*\(", re.IGNORECASE)
+_GREATEST = re.compile(r"\bGREATEST\s*\(", re.IGNORECASE)
+# Schema-qualified synthetic tables; SQLite has a single schema
+_SCHEMA_PREFIX = re.compile(r"\b\w+\.(?=v73__)")
+
+# Statements are rewritten once, then served from here
+_rewritten = {}
+
+
+def rewrite(sql):
+    cached = _rewritten.get(sql)
+    if cached is not None:
+        return cached
+    result = _INTERVAL.sub(lambda m: f"datetime('now', 'localtime', '-{m.group(1)} {m.group(2).lower()}s')", sql)
+    result = result.replace("<=>", " IS ")
+    result = _LEAST.sub("MIN(", result)
+    result = _GREATEST.sub("MAX(", result)
+    result = _SCHEMA_PREFIX.sub("", result)
+    _rewritten[sql] = result
+    return result
+
+
+def _now():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _crc32(value):
+    return None if value is None else zlib.crc32(str(value).encode("utf-8"))
+
+
+def _concat_ws(separator, *values):
+    return separator.join(str(v) for v in values if v is not None)
+
+
+def on_connect(dbapi_conn):
+    dbapi_conn.create_function("NOW", 0, _now)
+    dbapi_conn.create_function("CRC32", 1, _crc32, deterministic=True)
+    dbapi_conn.create_function("CONCAT_WS", -1, _concat_ws, deterministic=True)
+    cursor = dbapi_conn.cursor()
+    try:
+        # Large page cache and in-memory temp b-trees for the GROUP BY / window queries
+        cursor.execute("PRAGMA cache_size = -262144")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+        cursor.execute("PRAGMA mmap_size = 1073741824")
+    finally:
+        cursor.close()
@@ -0,0 +1,329 @@
+"""
+Synthetic v73__* tables for the benchmarks.
+
+One application per row number n = 1..rows, with every table the rules in
+config/gx_rules.yaml read (the seven validated tables plus the lookup tables
+their joins use). Clean rows are built to satisfy the rules; a row is "bad"
+with probability failure_rate, decided by a hash of n (so the same rows are bad
+in every build), and then breaks one rule of its table:
+
+    v73__application_to_lender           app_auto_decision = 'UNKNOWN'
+    v73__application_approval_to_funding merchant_id IS NULL
+    v73__transaction_details             customer_id IS NULL
+    v73__loan_details                    amount = -1
+    v73__offer_details                   apr = -1
+    v73__bureau_details                  bureau_pull_type IS NULL
+    v73__offer_evaluation                decision IS NULL
+
+Cross-table rules fail along with them (e.g. a bad loan amount also fails the
+funded-amount check on v73__application_approval_to_funding).
+
+Rows are generated inside the database (INSERT ... WITH RECURSIVE ... SELECT) in
+chunks, so 50M-row builds never pass through Python. Timestamps end a minute
+before the build, so the "table is refreshing" checks pass for 24 hours.
+Works on SQLite and MySQL 8 / MariaDB 10.2+.
+"""
+import time
+import logging
+import datetime
+
+import sqlalchemy
+
+logger = logging.getLogger('dq_engine')
+
+# Bump when the generated data changes, so existing benchmark databases are rebuilt
+GENERATOR_VERSION = 1
+
+CHUNK_ROWS = 1000000
+
+# Loan amount m (the LEAST of the four component amounts), pre-funding debt,
+# monthly income and FICO of application n
+_M = "(5000 + (n % 20) * 1000)"
+_PFD = "(100.0 + (n % 50) * 10)"
+_INCOME = "(3000.0 + (n % 30) * 100)"
+_FICO = "(600 + n % 200)"
+_SOFT_PENDING = "(n % 2 = 1)"
+
+
+class _Dialect:
+    def __init__(self, name, base_time):
+        self.name = name
+        self.base_time = base_time
+
+    def ts(self, offset="n"):
+        """Timestamp `offset` seconds after the build's base time."""
+        if self.name == "mysql":
+            return f"DATE_ADD('{self.base_time}', INTERVAL {offset} SECOND)"
+        return f"datetime('{self.base_time}', '+' || ({offset}) || ' seconds')"
+
+    def concat(self, *parts):
+        if self.name == "mysql":
+            return f"CONCAT({', '.join(parts)})"
+        return " || ".join(parts)
+
+    def column_type(self, kind):
+        if self.name == "mysql":
+            return {"int": "BIGINT", "real": "DOUBLE", "text": "VARCHAR(255)", "ts": "DATETIME"}[kind]
+        return {"int": "INTEGER", "real": "REAL", "text": "TEXT", "ts": "TEXT"}[kind]
+
+
+def _bad(value_if_bad, value):
+    return f"CASE WHEN bad = 1 THEN {value_if_bad} ELSE {value} END"
+
+
+# table -> (primary key, indexed join columns, [(column, kind, SQL expression or callable(dialect))])
+TABLES = {
+    "v73__application_to_lender": ("application_id", [], [
+        ("application_id", "int", "n"),
+        ("application_timestamp", "ts", lambda d: d.ts()),
+        ("latest_status", "text", "'APPROVED'"),
+        ("latest_sub_status", "text", "'APPROVED'"),
+        ("app_auto_decision", "text", _bad("'UNKNOWN'", f"CASE WHEN {_SOFT_PENDING} THEN 'SOFT_PENDING' ELSE 'APPROVED' END")),
+        ("app_final_decision", "text", "'APPROVED'"),
+        ("ind_manual_review", "int", f"CASE WHEN {_SOFT_PENDING} THEN 1 ELSE 0 END"),
+        ("pending_checks", "text", f"CASE WHEN {_SOFT_PENDING} THEN '[\"INCOME_VERIFICATION\"]' ELSE '[]' END"),
+        ("ind_income_verification", "int", f"CASE WHEN {_SOFT_PENDING} THEN 1 ELSE 0 END"),
+        ("income_verification_method", "text", f"CASE WHEN {_SOFT_PENDING} THEN 'PAYSTUB' ELSE NULL END"),
+        ("verified_income", "real", f"CASE WHEN {_SOFT_PENDING} THEN {_INCOME} * 12 ELSE NULL END"),
+        ("original_total_monthly_income", "real", _INCOME),
+        ("max_loan_amount_1_1", "int", _M),
+        ("max_loan_amount_2_1", "int", f"{_M} + 1000"),
+        ("max_loan_amount_3_1", "int", f"{_M} + 2000"),
+        ("max_loan_amount_4_1", "int", f"{_M} + 3000"),
+        ("max_loan_amount_1", "real", f"{_M} + {_PFD}"),
+        ("max_loan_amount_2", "real", f"{_M} + 1000 + {_PFD}"),
+        ("max_loan_amt", "int", _M),
+        ("intermediate_max_loan_amt", "int", _M),
+        ("stated_income_max_loan_amt", "int", _M),
+        ("maximum_avl_amt", "int", _M),
+        ("pre_funding_debt", "real", _PFD),
+        ("monthly_debt_burden", "real", _PFD),
+        ("other_monthly_debt_burden", "real", "0.0"),
+        ("lender_adjustment_debt", "real", "0.0"),
+        ("active_contract_balance_merchant", "real", "0.0"),
+        ("calculated_dti", "real", f"ROUND({_PFD} / {_INCOME}, 4)"),
+        ("lender_decline_reason", "text", "NULL"),
+        ("lender_rejection_status", "text", "NULL"),
+        ("bor_fico", "int", _FICO),
+        ("last_decision_timestamp", "ts", lambda d: d.ts()),
+    ]),
+    "v73__application_approval_to_funding": ("application_id", [], [
+        ("application_id", "int", "n"),
+        ("application_timestamp", "ts", lambda d: d.ts()),
+        ("merchant_id", "int", _bad("NULL", "n % 500")),
+        ("store_id", "int", "n % 2000"),
+        ("contract_amt", "real", _M),
+        ("selected_offer_id", "int", "n"),
+        ("contract_timestamp", "ts", lambda d: d.ts()),
+        ("total_funded_amt", "real", _M),
+        ("total_refunded_amt", "real", "0.0"),
+        ("voided_amt", "real", "0.0"),
+        ("first_funding_timestamp", "ts", lambda d: d.ts("n + 60")),
+        ("last_funding_timestamp", "ts", lambda d: d.ts("n + 60")),
+        ("autopay_method", "text", "'ACH'"),
+        ("expiry_timestamp", "ts", lambda d: d.ts("n + 2592000")),
+        ("mdr_pct", "real", "2.5"),
+        ("mdr_amt", "real", f"ROUND(2.5 * {_M} * 0.01, 2)"),
+        ("change_order_timestamp", "ts", "NULL"),
+        ("original_contract_amt", "real", _M),
+        ("ofee_amount_final", "real", "25.0"),
+        ("ofee_payment_method", "text", "'CARD'"),
+        ("ofee_payment_status", "int", "300"),
+    ]),
+    "v73__transaction_details": ("order_id", ["application_id", "transaction_id"], [
+        ("order_id", "int", "n"),
+        ("transaction_id", "int", "n"),
+        ("application_id", "int", "n"),
+        ("customer_id", "int", _bad("NULL", "n")),
+        ("flow_type", "text", "'POS'"),
+        ("merchant_id", "int", "n % 500"),
+        ("store_id", "int", "n % 2000"),
+        ("entry_point", "text", "'WEB'"),
+        ("transaction_timestamp", "ts", lambda d: d.ts()),
+        ("status", "text", "'COMPLETED'"),
+        ("request_amount", "int", _M),
+        ("decline_reason_code", "text", "NULL"),
+        ("rejection_status", "text", "NULL"),
+        ("is_counter_offer", "int", "0"),
+        ("selected_offer_id", "int", "n"),
+        ("auto_pay_set", "int", "1"),
+        ("autopay_method", "text", "'ACH'"),
+        ("ofee_payment_set", "int", "1"),
+        ("ofee_amount_final", "real", "25.0"),
+        ("ofee_payment_method", "text", "'CARD'"),
+        ("verification_payment_set", "int", "0"),
+        ("verification_payment_method", "text", "NULL"),
+    ]),
+    "v73__loan_details": ("loan_id", ["application_id"], [
+        ("loan_id", "int", "n"),
+        ("application_id", "int", "n"),
+        ("lms_customer_id", "int", "n"),
+        ("amount", "real", _bad("-1", _M)),
+        ("term_value", "int", "36"),
+        ("apr", "real", "9.99"),
+        ("is_autopay_set", "int", "1"),
+        ("interest_begin_date", "ts", lambda d: d.ts()),
+        ("effective_at", "ts", lambda d: d.ts()),
+    ]),
+    "v73__offer_details": ("offer_id", ["application_id", "transaction_id"], [
+        ("offer_id", "int", "n"),
+        ("application_id", "int", "n"),
+        ("transaction_id", "int", "n"),
+        # Incentivised/autopay offers must have a parent; each offer is its own
+        ("parent_offer_id", "int", "n"),
+        ("is_incentivized", "int", "1"),
+        ("is_autopay_required", "int", "1"),
+        ("term", "int", "36"),
+        ("first_payment", "int", "0"),
+        ("shown", "int", "1"),
+        ("apr", "real", _bad("-1", "9.99")),
+        ("payment_amount", "real", "100.0"),
+        ("mdr", "real", "2.5"),
+        ("min_amount", "real", "1000.0"),
+        ("max_amount", "real", "50000.0"),
+    ]),
+    "v73__bureau_details": ("application_id", ["customer_id"], [
+        ("application_id", "int", "n"),
+        ("customer_id", "int", "n"),
+        ("bureau_pull_time", "ts", lambda d: d.ts()),
+        ("bureau_pull_type", "text", _bad("NULL", "'TRANSUNION_SOFT'")),
+        ("response_data", "text", lambda d: d.concat("'{\"success\": true, \"fico\": '", _FICO, "'}'")),
+    ]),
+    "v73__offer_evaluation": ("application_id", [], [
+        ("application_id", "int", "n"),
+        ("evaluation_type", "text", "'INITIAL_EVALUATION'"),
+        ("decision", "text", _bad("NULL", "'APPROVED'")),
+        ("decision_data", "text", "'{}'"),
+        ("evaluation_data", "text", "'{}'"),
+        ("evaluated_at", "ts", lambda d: d.ts()),
+        ("is_customer_offer", "int", "1"),
+    ]),
+    # Lookup tables read by joins only
+    "v73__application_details": ("application_id", [], [
+        ("application_id", "int", "n"),
+        ("bor_customer_id", "int", "n"),
+    ]),
+    "v73__application_details_v1": ("application_id", [], [
+        ("application_id", "int", "n"),
+        ("bor_monthly_income", "real", _INCOME),
+    ]),
+    "v73__mrd_application": ("application_id", [], [
+        ("application_id", "int", "n"),
+        ("status", "int", "3000"),
+    ]),
+    "v73__transaction_details_v1": ("transaction_id", ["application_id"], [
+        ("transaction_id", "int", "n"),
+        ("application_id", "int", "n"),
+        ("change_order_timestamp", "ts", "NULL"),
+    ]),
+    "v73__pos_card_account": ("pos_card_account_id", ["application_id"], [
+        ("pos_card_account_id", "int", "n"),
+        ("application_id", "int", "n"),
+        ("status", "int", "100"),
+        ("created_at", "ts", lambda d: d.ts()),
+        ("expiry_at", "ts", lambda d: d.ts("n + 2592000")),
+    ]),
+    "v73__pos_card_disbursement": ("pos_card_disbursement_id", ["account_id"], [
+        ("pos_card_disbursement_id", "int", "n"),
+        ("account_id", "int", "n"),
+        ("type", "text", "'OUTFLOW'"),
+        ("status", "int", "300"),
+        ("updated_at", "ts", lambda d: d.ts("n + 60")),
+    ]),
+    "v73__pos_card_account_to_action": ("pos_card_account_to_action_id", ["account_id"], [
+        ("pos_card_account_to_action_id", "int", "n"),
+        ("account_id", "int", "n"),
+        ("type", "text", "'OPEN'"),
+        ("amount", "real", _M),
+        ("created_at", "ts", lambda d: d.ts()),
+    ]),
+    "v73__pos_pg_gateway_transaction": ("pos_pg_gateway_transaction_id", ["application_id"], [
+        ("pos_pg_gateway_transaction_id", "int", "n"),
+        ("application_id", "int", "n"),
+        ("type", "text", "'ORIGINATION_FEE'"),
+        ("status", "int", "300"),
+        ("gateway", "text", "'CARD'"),
+        ("created_at", "ts", lambda d: d.ts()),
+    ]),
+    "v73__pos_pg_gateway_transaction_to_action": ("pos_pg_gateway_transaction_to_action_id", ["gateway_transaction_id"], [
+        ("pos_pg_gateway_transaction_to_action_id", "int", "n"),
+        ("gateway_transaction_id", "int", "n"),
+        ("type", "text", "'AUTH_CAPTURE'"),
+        ("status", "int", "700"),
+        ("amount", "real", "25.0"),
+        ("created_at", "ts", lambda d: d.ts()),
+    ]),
+}
+
+
+def _expression(expression, dialect):
+    return expression(dialect) if callable(expression) else expression
+
+
+def _insert_chunk(conn, dialect, table_name, columns, salt, bad_per_10k, start, end):
+    names = ", ".join(name for name, _, _ in columns)
+    expressions = ", ".join(_expression(expression, dialect) for _, _, expression in columns)
+    conn.execute(sqlalchemy.text(
+        f"INSERT INTO {table_name} ({names}) "
+        f"WITH RECURSIVE seq(n) AS (SELECT {start} UNION ALL SELECT n + 1 FROM seq WHERE n < {end}) "
+        f"SELECT {expressions} FROM ("
+        f"SELECT n, CASE WHEN (n * 2654435761 + {salt}) % 1000003 % 10000 < {bad_per_10k} THEN 1 ELSE 0 END AS bad "
+        f"FROM seq) s"
+    ))
+
+
+def _prepare(conn, dialect, chunk_rows):
+    if dialect.name == "sqlite":
+        # A throwaway benchmark database: no journal needed while loading
+        conn.exec_driver_sql("PRAGMA journal_mode = OFF")
+        conn.exec_driver_sql("PRAGMA synchronous = OFF")
+    elif dialect.name == "mysql":
+        conn.exec_driver_sql(f"SET SESSION cte_max_recursion_depth = {chunk_rows + 1}")
+
+
+def current_build(engine):
+    """(rows, failure_rate, version) of the data in the database, or None."""
+    try:
+        with engine.connect() as conn:
+            row = conn.execute(sqlalchemy.text("SELECT rows_generated, failure_rate, version FROM _bench_meta")).fetchone()
+    except Exception:
+        return None
+    return tuple(row) if row else None
+
+
+def generate(engine, rows, failure_rate=0.01, chunk_rows=CHUNK_ROWS):
+    """(Re)creates every synthetic table with `rows` rows. Returns the build time in seconds."""
+    started = time.perf_counter()
+    base_time = (datetime.datetime.now() - datetime.timedelta(seconds=rows + 60)).strftime("%Y-%m-%d %H:%M:%S")
+    dialect = _Dialect(engine.dialect.name, base_time)
+    bad_per_10k = int(round(failure_rate * 10000))
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE IF EXISTS _bench_meta")
+
+    for salt, (table_name, (primary_key, indexed, columns)) in enumerate(TABLES.items()):
+        table_started = time.perf_counter()
+        column_defs = ", ".join(f"{name} {dialect.column_type(kind)}" for name, kind, _ in columns)
+        with engine.begin() as conn:
+            _prepare(conn, dialect, chunk_rows)
+            conn.exec_driver_sql(f"DROP TABLE IF EXISTS {table_name}")
+            conn.exec_driver_sql(f"CREATE TABLE {table_name} ({column_defs})")
+            for start in range(1, rows + 1, chunk_rows):
+                _insert_chunk(conn, dialect, table_name, columns, salt, bad_per_10k, start, min(rows, start + chunk_rows - 1))
+            # Indexes after the load: much faster than maintaining them row by row
+            conn.exec_driver_sql(f"CREATE UNIQUE INDEX ux_{table_name}_pk ON {table_name} ({primary_key})")
+            for column in indexed:
+                conn.exec_driver_sql(f"CREATE INDEX ix_{table_name}_{column} ON {table_name} ({column})")
+        logger.info(f"Generated {table_name}: {rows} rows in {time.perf_counter() - table_started:.1f}s")
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE" if dialect.name == "sqlite" else f"ANALYZE TABLE {', '.join(TABLES)}")
+        conn.exec_driver_sql(
+            "CREATE TABLE _bench_meta (rows_generated BIGINT, failure_rate DOUBLE PRECISION, version INTEGER, generated_at VARCHAR(32))"
+        )
+        conn.execute(
+            sqlalchemy.text("INSERT INTO _bench_meta VALUES (:rows, :rate, :version, :at)"),
+            {"rows": rows, "rate": failure_rate, "version": GENERATOR_VERSION,
+             "at": datetime.datetime.now().isoformat(timespec="seconds")}
+        )
+    return time.perf_counter() - started
@@ -1,64 +1,280 @@
-from src.gx_wrapper import GXRunner
-from src.notifier import send_summary_email
-import concurrent.futures
-import pandas as pd
+"""
+The nightly validation run: every lender, table and rule, then the summary report
+and email. Heavy modules (pandas, SQLAlchemy, the engine) are imported inside
+main() so importing this file, e.g. from scheduler.py or a spawned worker, is
+cheap. `python -m src.cli run` runs the same job with filters.
+"""
+import functools
 import logging
-import logging.config
+import concurrent.futures
 from datetime import datetime
 
-logging.config.fileConfig('config/logging.conf')
+from src import work_scheduler
+from src.logging_setup import configure_logging
+
 logger = logging.getLogger('dq_engine')
 
-def run_wrapper(lender):
-    # UPDATE: No longer passing specific table_name. 
-    # This tells the runner to look at 'tables' in YAML and run ALL of them.
-    # Instantiate locally to avoid PicklingError with ProcessPoolExecutor
-    runner = GXRunner()
-    return runner.run_validation(lender)
+def _connectivity_gate(runner, lenders):
+    """Probes every lender's database at once; returns {lender: error} for those that don't answer."""
+    if not lenders:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(lenders)) as pool:
+        errors = dict(zip(lenders, pool.map(runner.check_connection, lenders)))
+    return {lender_id: error for lender_id, error in errors.items() if error}
+
+def _run_process_schedule(temp_runner, lenders, run_id, store, table_metadata, selection=None, check_engine=None,
+                          executor=None):
+    """Runs the (lender, table, rule) units on the process pool and returns their DataFrames."""
+    settings = temp_runner.settings
+    # Split the run into (lender, table, rule) units, most expensive first by history
+    history = {}
+    if store:
+        try:
+            history = store.average_durations(days=settings.get('scheduler_history_days', 14))
+        except Exception as e:
+            logger.error(f"Could not read unit history, scheduling without it: {e}")
+    units = work_scheduler.plan_work(
+        temp_runner, lenders, history, check_engine=check_engine, table_metadata=table_metadata, selection=selection
+    )
+    per_host_limit = int(settings.get('max_queries_per_host', 8))
+    workers = settings.get('scheduler_workers', 'auto')
+    workers = work_scheduler.auto_workers(units, per_host_limit) if workers == 'auto' else int(workers)
+    lender_budgets = {l: temp_runner.lender_time_budget(l) for l in lenders}
+    logger.info(f"Scheduling {len(units)} units on {workers} workers (max {per_host_limit} queries per host).")
+
+    results = []
+    # ProcessPoolExecutor because the GX Context is not thread-safe.
+    # This fixes "Could not find datasource" errors by giving each job its own memory space.
+    schedule = work_scheduler.run_schedule(
+        units, functools.partial(work_scheduler.run_unit, run_id=run_id), workers, per_host_limit, lender_budgets,
+        executor=executor
+    )
+    for unit, df, exc in schedule:
+        label = f"{unit['lender']} / {unit['table']} ({len(unit['rule_names'] or [])} rules)"
+        if exc is not None:
+            logger.error(f"{label} failed: {exc}")
+            continue
+        results.append(df)
+        if store:
+            store.record_results(run_id, df)
+        logger.info(f"Completed {label}")
+    return results
+
+def main(lenders=None, selection=None, check_engine=None, report=True, source="daily_job", runner=None,
+         executor=None):
+    """
+    Validates every lender and, with report=True, writes the summary report and sends
+    the email. `lenders` and `selection` ({table: [rule names]}, see
+    RuleRegistry.select) narrow the run. The scheduler daemon passes its long-lived
+    `runner` and warm worker pool (`executor`). Returns the run's results, or None if
+    the config could not be loaded.
+    """
+    configure_logging()
+    import pandas as pd
+    from src import parquet_export
+    from src import profiling
+    from src.gx_wrapper import GXRunner
+    from src.async_runner import AsyncSQLRunner, async_available
+    from src.cross_lender import CrossLenderRunner, host_groups
+    from src.results_store import ResultsStore, DEFAULT_DB_PATH
+    from src.notifier import send_summary_email
 
-def main():
     logger.info("=== Starting GX Daily Check (Multi-Table) ===")
+    run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     try:
         # We still need a temporary runner just to get the list of lenders
-        temp_runner = GXRunner()
-        lenders = list(temp_runner.secrets.keys())
+        temp_runner = runner or GXRunner()
+        if runner is not None:
+            runner.start_run(run_id)
+        lenders = list(lenders or temp_runner.secrets.keys())
     except Exception as e:
         logger.critical(f"Config Error: {e}")
-        return
+        return None
 
+    # Every lender's results are recorded as they arrive; the reports below read them back
+    try:
+        store = ResultsStore(temp_runner.settings.get('results_db', DEFAULT_DB_PATH))
+        store.start_run(run_id, source)
+    except Exception as e:
+        logger.error(f"Results store unavailable, reporting from memory only: {e}")
+        store = None
+
+    settings = temp_runner.settings
     all_results = []
-    # 5 Workers is safe for GX memory usage
-    # UPDATE: Switched to ProcessPoolExecutor because GX Context is not thread-safe.
-    # This fixes "Could not find datasource" errors by giving each job its own memory space.
-    with concurrent.futures.ProcessPoolExecutor(max_workers=5) as executor:
-        future_to_lender = {executor.submit(run_wrapper, l): l for l in lenders}
-        
-        for future in concurrent.futures.as_completed(future_to_lender):
-            lender = future_to_lender[future]
+
+    # Connectivity gate: a lender whose database doesn't answer is reported once and
+    # none of its checks are scheduled, instead of every unit waiting on it in turn
+    if settings.get('connectivity_gate', True):
+        unreachable = _connectivity_gate(temp_runner, lenders)
+        if unreachable:
+            gate_df = pd.DataFrame([{
+                "lender": lender_id,
+                "table": "SYSTEM",
+                "status": "CRITICAL_ERROR",
+                "test_description": "Connectivity_Gate",
+                "error_msg": f"Database unreachable, no checks run: {error}",
+                "severity": "critical",
+                "failed_rows": 0,
+                "total_rows": 0
+            } for lender_id, error in unreachable.items()])
+            for lender_id, error in unreachable.items():
+                logger.error(f"[{lender_id}] Connectivity gate failed, skipping the lender: {error}")
+                if runner is None:
+                    temp_runner.dispose_engines(lender_id)
+            all_results.append(gate_df)
+            if store:
+                store.record_results(run_id, gate_df)
+            lenders = [lender_id for lender_id in lenders if lender_id not in unreachable]
+
+    # Sizes of every lender's tables (information_schema estimates, no scans) for
+    # scheduling and the report; the workers fetch their own row counts
+    table_metadata = {}
+    for lender_id in lenders:
+        try:
+            table_metadata[lender_id] = temp_runner.table_metadata(
+                lender_id, tables=list(selection) if selection is not None else None, row_count_mode="estimate"
+            )
+        except Exception as e:
+            logger.error(f"Could not read table metadata for {lender_id}: {e}")
+        finally:
+            if runner is None:
+                temp_runner.dispose_engines(lender_id)
+
+    execution_mode = settings.get('execution_mode', 'process')
+    if execution_mode == 'async' and not async_available(temp_runner, lenders):
+        logger.error("execution_mode 'async' needs greenlet and the lenders' async drivers (aiomysql/aiosqlite); "
+                     "falling back to 'process'.")
+        execution_mode = 'process'
+    if execution_mode == 'async' and (selection is not None or check_engine):
+        # The async runner has no rule selection and always uses direct-engine semantics
+        logger.info("Rule selection or an explicit check engine runs on the process pool.")
+        execution_mode = 'process'
+
+    if not lenders:
+        logger.warning("No reachable lenders to validate.")
+    elif execution_mode == 'async':
+        # One process, every lender's SQL checks interleaved on the event loop
+        logger.info(f"Running {len(lenders)} lenders in async mode.")
+        async_df = AsyncSQLRunner(GXRunner(run_id=run_id)).run(lenders)
+        if not async_df.empty:
+            all_results.append(async_df)
+            if store:
+                store.record_results(run_id, async_df)
+    elif execution_mode == 'cross_lender':
+        # Co-hosted lenders run each check once for all of them; the others as usual
+        groups = host_groups(temp_runner, lenders)
+        grouped = {lender_id for group in groups for lender_id in group}
+        if groups:
+            logger.info(f"Running {len(grouped)} lenders on {len(groups)} shared hosts in cross-lender mode.")
+            # Row counts are fetched once per lender; the per-lender units of uncombined rules reuse them
+            cross_runner = runner or GXRunner(run_id=run_id, persistent_engines=True, cache_table_counts=True)
             try:
-                df = future.result()
-                all_results.append(df)
-                logger.info(f"Completed {lender}")
-            except Exception as exc:
-                logger.error(f"{lender} failed: {exc}")
-
-    if all_results:
-        final_df = pd.concat(all_results, ignore_index=True)
+                cross_df = CrossLenderRunner(cross_runner).run(groups, selection=selection, check_engine=check_engine)
+            finally:
+                if runner is None:
+                    cross_runner.dispose_engines()
+            if not cross_df.empty:
+                all_results.append(cross_df)
+                if store:
+                    store.record_results(run_id, cross_df)
+        remaining = [lender_id for lender_id in lenders if lender_id not in grouped]
+        if remaining:
+            all_results.extend(_run_process_schedule(
+                temp_runner, remaining, run_id, store, table_metadata, selection=selection, check_engine=check_engine,
+                executor=executor
+            ))
+    else:
+        all_results.extend(_run_process_schedule(
+            temp_runner, lenders, run_id, store, table_metadata, selection=selection, check_engine=check_engine,
+            executor=executor
+        ))
+
+    # Workers may race on the Parquet manifest; rebuild it once everyone is done
+    manifest_path = parquet_export.finalize_run_manifest(run_id)
+    if manifest_path:
+        logger.info(f"Saved failed-rows manifest to '{manifest_path}'.")
+
+    final_df = pd.concat(all_results, ignore_index=True) if all_results else pd.DataFrame()
+    if store:
+        try:
+            store.finish_run(run_id)
+            final_df = store.get_run_results(run_id)
+            logger.info(f"Recorded run {run_id} in '{store.db_path}'.")
+        except Exception as e:
+            logger.error(f"Could not read run {run_id} back from the results store: {e}")
+
+    if not report:
+        return final_df
+
+    if not final_df.empty:
         
         # Generate HTML Summary Report
         cols = ['status', 'lender', 'table', 'test_description', 'failed_rows', 'total_rows', 'severity', 'error_msg']
         existing_cols = [c for c in cols if c in final_df.columns]
         summary_df = final_df[existing_cols]
-        summary_df = summary_df[summary_df['status'] == 'FAIL']
+        # Timed-out checks are listed too: they are failures to validate, not passes.
+        # Skipped checks are listed so readers see what a failed gate left unchecked.
+        summary_df = summary_df[summary_df['status'].isin(['FAIL', 'TIMEOUT', 'SKIPPED'])]
 
         def color_status(val):
             if val == 'PASS': color = 'green'
-            elif val == 'ERROR': color = '#ff9900'
+            elif val in ('ERROR', 'TIMEOUT'): color = '#ff9900'
+            elif val == 'SKIPPED': color = 'gray'
             else: color = 'red'
             return f'color: {color}; font-weight: bold'
 
         html_table = summary_df.style.map(color_status, subset=['status']).to_html(index=False)
+
+        # Hot spots of this run, from the per-phase timings the workers wrote
+        profile_html = ""
+        profile_root = temp_runner.settings.get('profile_dir', profiling.PROFILE_ROOT)
+        try:
+            slowest_df = profiling.slowest_checks(run_id, n=temp_runner.settings.get('profile_top_n', 10), root=profile_root)
+            if not slowest_df.empty:
+                phases_df = profiling.phase_totals(run_id, root=profile_root)
+                profile_html = (
+                    f"<h3>⏱️ Slowest {len(slowest_df)} Checks</h3>\n{slowest_df.to_html(index=False, na_rep='')}\n"
+                    f"<h3>Time by Phase</h3>\n{phases_df.to_html(index=False, na_rep='')}"
+                )
+                logger.info(f"Slowest check: {slowest_df.iloc[0]['lender']} / {slowest_df.iloc[0]['table']} / "
+                            f"{slowest_df.iloc[0]['rule']} ({slowest_df.iloc[0]['duration_s']}s)")
+        except Exception as e:
+            logger.error(f"Could not build the profiling section: {e}")
+
+        # Table sizes, so growth shows up next to the checks that slowed down
+        sizes_html = ""
+        size_rows = [
+            {
+                "lender": lender_id,
+                "table": table_name,
+                "rows": meta['row_count'],
+                "rows_estimated": meta['row_count_estimated'],
+                "data_mb": round(meta['data_bytes'] / 1048576, 1) if meta['data_bytes'] is not None else None,
+                "index_mb": round(meta['index_bytes'] / 1048576, 1) if meta['index_bytes'] is not None else None,
+                "last_update": meta['update_time']
+            }
+            for lender_id, tables in table_metadata.items()
+            for table_name, meta in tables.items()
+        ]
+        if size_rows:
+            sizes_html = f"<h3>Table Sizes</h3>\n{pd.DataFrame(size_rows).fillna('').to_html(index=False)}"
+
+        # Delta store: which failing rows are new or resolved since the last run
+        changes_html = ""
+        if temp_runner.failed_row_store is not None:
+            try:
+                change_frames = []
+                for lender_id in lenders:
+                    lender_changes = temp_runner.failed_row_store.run_summary(lender_id, run_id)
+                    if not lender_changes.empty:
+                        lender_changes.insert(0, 'lender', lender_id)
+                        change_frames.append(lender_changes)
+                if change_frames:
+                    changes_df = pd.concat(change_frames, ignore_index=True)
+                    changes_html = f"<h3>Failed Row Changes</h3>\n{changes_df.to_html(index=False)}"
+            except Exception as e:
+                logger.error(f"Could not build the failed-row changes section: {e}")
         
         # Streamlit-like CSS
         streamlit_style = """
@@ -95,7 +311,7 @@ def main():
         report_filename = f'summary_report_{timestamp}.html'
         excel_filename = f'summary_report_{timestamp}.xlsx'
         
-        html_output = f"<!DOCTYPE html>\n<html>\n<head>\n<meta charset='utf-8'>\n<title>GX Summary Report - {timestamp}</title>\n{streamlit_style}\n</head>\n<body>\n<h2>🛡️ Data Warehouse Quality Control - Summary</h2>\n{html_table}\n</body>\n</html>"
+        html_output = f"<!DOCTYPE html>\n<html>\n<head>\n<meta charset='utf-8'>\n<title>GX Summary Report - {timestamp}</title>\n{streamlit_style}\n</head>\n<body>\n<h2>🛡️ Data Warehouse Quality Control - Summary</h2>\n{html_table}\n{profile_html}\n{sizes_html}\n{changes_html}\n</body>\n</html>"
 
         with open(report_filename, 'w', encoding='utf-8') as f:
             f.write(html_output)
@@ -105,11 +321,18 @@ def main():
         summary_df.to_excel(excel_filename, index=False)
         logger.info(f"Saved Excel summary report to '{excel_filename}'.")
 
-        # Filter failures
-        failures = final_df[final_df['status'] != 'PASS']
+        # Filter failures; checks skipped behind a failed gate are counted with the gate
+        failures = final_df[~final_df['status'].isin(['PASS', 'SKIPPED'])]
+        skipped = int((final_df['status'] == 'SKIPPED').sum())
+        if skipped:
+            logger.warning(f"{skipped} checks were skipped because a rule they depend on did not pass.")
         
         if not failures.empty:
-            logger.warning(f"Detected {len(failures)} failures. Check 'failed_rows/' directory for CSV reports.")
+            if temp_runner.failed_row_store is not None:
+                logger.warning(f"Detected {len(failures)} failures. Failing rows are in the delta store under "
+                               f"'{temp_runner.failed_row_store.store_dir}/'.")
+            else:
+                logger.warning(f"Detected {len(failures)} failures. Check 'failed_rows/' directory for CSV reports.")
         else:
             logger.info("All GX checks passed across all tables.")
             
@@ -118,6 +341,7 @@ def main():
 
     else:
         logger.warning("No results generated.")
+    return final_df
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
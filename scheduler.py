@@ -1,12 +1,13 @@
 import schedule
+import sys
 import time
 import logging
-import logging.config
 import daily_job
 import datetime
+from src import rule_registry
+from src.daemon import SchedulerDaemon, DEFAULT_RUN_TIME
+from src.logging_setup import configure_logging
 
-# Setup logging
-logging.config.fileConfig('config/logging.conf')
 logger = logging.getLogger('dq_engine')
 
 def job():
@@ -17,8 +18,16 @@ def job():
         logger.error(f"Scheduled job crashed: {e}")
 
 def main():
-    # Configure the time you want the job to run (24-hour format)
-    run_time = "17:10"
+    configure_logging()
+    settings = rule_registry.load("config/gx_rules.yaml").settings
+
+    # Daemon mode: warm workers, per-rule schedules (see src/daemon.py)
+    if "--daemon" in sys.argv[1:] or settings.get('scheduler_mode') == "daemon":
+        SchedulerDaemon().run_forever()
+        return
+
+    # The time the job runs (24-hour format), settings.daily_run_time in gx_rules.yaml
+    run_time = settings.get('daily_run_time', DEFAULT_RUN_TIME)
     
     logger.info(f"=== Custom Python Scheduler Started ===")
     logger.info(f"Job scheduled to run daily at {run_time}")
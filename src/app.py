@@ -2,8 +2,9 @@ import streamlit as st
 import pandas as pd
 import sys
 import os
+import time
 import toml
-import yaml
+from datetime import datetime
 
 # 1. Setup Page
 st.set_page_config(page_title="GX Lender Dashboard", layout="wide")
@@ -13,22 +14,24 @@ st.title("🛡️ Data Warehouse Quality Control")
 # ---------------------------------------------------------
 # PHASE 1: CONFIG LOADING
 # ---------------------------------------------------------
-@st.cache_data
 def load_config_data():
+    # The compiled rule registry is cached per version of the YAML (src/rule_registry.py),
+    # so this only re-parses after the file changes
     try:
+        from src import rule_registry
         secrets = toml.load("secrets.toml")
         lenders_list = list(secrets['lenders'].keys())
-        with open("config/gx_rules.yaml", 'r') as f:
-            rules = yaml.safe_load(f)
-        tables_list = list(rules['tables'].keys())
-        return lenders_list, tables_list
+        registry = rule_registry.load("config/gx_rules.yaml")
+        return lenders_list, list(registry.tables.keys()), registry, None
     except Exception as e:
-        return [], []
+        return [], [], None, e
 
-lenders, available_tables = load_config_data()
+lenders, available_tables, rule_set, config_error = load_config_data()
 
 if not lenders:
     st.error("Config Error: Check secrets.toml and gx_rules.yaml")
+    if config_error:
+        st.code(str(config_error))
     st.stop()
 
 # ---------------------------------------------------------
@@ -37,52 +40,143 @@ if not lenders:
 st.sidebar.header("Configuration")
 selected_lender = st.sidebar.selectbox("Select Lender", ["ALL"] + lenders)
 target_table_selection = st.sidebar.selectbox("Target Table", ["ALL TABLES"] + available_tables)
+check_engine = st.sidebar.radio(
+    "Check Engine", ["gx", "direct"],
+    help="'direct' runs the SQL rules straight against MySQL without building a GX context (faster)."
+)
+run_depth = st.sidebar.radio(
+    "Depth", ["full", "sample"],
+    index=1 if rule_set.settings.get('run_depth') == "sample" else 0,
+    help="'sample' runs rules marked `mode: sample` on a fixed key-hash sample and estimates their failures."
+)
+force_refresh = st.sidebar.checkbox(
+    "Force refresh",
+    help="Re-check every table. Otherwise tables unchanged since their last dashboard run reuse its results."
+)
 run_btn = st.sidebar.button("Run Diagnostics", type="primary")
 
 # ---------------------------------------------------------
 # PHASE 3: EXECUTION
 # ---------------------------------------------------------
 @st.cache_resource
-def get_runner():
-    from gx_wrapper import GXRunner 
-    return GXRunner(secrets_path="secrets.toml", rules_path="config/gx_rules.yaml")
+def get_runner(rules_hash):
+    # Keyed by the rules file hash: editing gx_rules.yaml gives a fresh runner.
+    # Background jobs share it (each through its own for_run view, see src/job_manager.py),
+    # so lender engines stay open between runs.
+    from src.gx_wrapper import GXRunner
+    from src.logging_setup import configure_logging
+    configure_logging()
+    return GXRunner(
+        secrets_path="secrets.toml", rules_path="config/gx_rules.yaml", persistent_engines=True, cache_results=True
+    )
+
+@st.cache_resource
+def get_results_store():
+    from src.results_store import ResultsStore, DEFAULT_DB_PATH
+    return ResultsStore(rule_set.settings.get('results_db', DEFAULT_DB_PATH))
+
+try:
+    results_store = get_results_store()
+except Exception as e:
+    st.sidebar.warning(f"Results history unavailable: {e}")
+    results_store = None
+
+lender_arg = None if selected_lender == "ALL" else selected_lender
+table_arg = None if target_table_selection == "ALL TABLES" else target_table_selection
+final_df = pd.DataFrame()
+
+@st.cache_resource
+def get_job_manager(rules_hash):
+    # One job queue per server process, shared by every session
+    from src.job_manager import JobManager
+    return JobManager(
+        get_runner(rules_hash),
+        max_workers=int(rule_set.settings.get('dashboard_workers', 4)),
+        results_store=results_store
+    )
+
+try:
+    job_manager = get_job_manager(rule_set.file_hash)
+except Exception as e:
+    st.error(f"Failed to start engine: {e}")
+    st.stop()
 
 if run_btn:
-    with st.spinner("Initializing Engine..."):
-        try:
-            runner = get_runner()
-        except Exception as e:
-            st.error(f"Failed to start engine: {e}")
-            st.stop()
-
-    table_arg = None if target_table_selection == "ALL TABLES" else target_table_selection
-    st.write(f"### ⏳ Running Validation: {target_table_selection}")
-    
-    final_df = pd.DataFrame()
-
-    if selected_lender == "ALL":
-        all_dfs = []
-        progress_bar = st.progress(0)
-        for i, lender in enumerate(lenders):
-            with st.spinner(f"Analyzing {lender} ({i+1}/{len(lenders)})..."):
-                df = runner.run_validation(lender, specific_table=table_arg)
-                all_dfs.append(df)
-            progress_bar.progress((i + 1) / len(lenders))
-        if all_dfs:
-            final_df = pd.concat(all_dfs, ignore_index=True)
+    job_id, joined = job_manager.submit(
+        [lender_arg] if lender_arg else lenders,
+        [table_arg] if table_arg else available_tables,
+        check_engine,
+        refresh=force_refresh,
+        depth=run_depth
+    )
+    st.session_state['job_id'] = job_id
+    if joined:
+        st.info("The same validation is already running; following it instead of starting another.")
+
+# Runs started by anyone on this dashboard can be followed from any session
+active_jobs = job_manager.active_jobs()
+if active_jobs:
+    st.sidebar.write("---")
+    st.sidebar.subheader("Runs in Progress")
+    for active in active_jobs:
+        finished, total = active.progress()
+        who = ", ".join(active.lenders) if len(active.lenders) <= 2 else f"{len(active.lenders)} lenders"
+        label = f"{who} ({finished}/{total})"
+        if st.sidebar.button(label, key=f"follow_{active.job_id}"):
+            st.session_state['job_id'] = active.job_id
+
+job = job_manager.get(st.session_state.get('job_id'))
+
+if job is not None:
+    finished, total = job.progress()
+    if job.done:
+        st.write(f"### ✅ Validation Finished ({job.finished_at:%H:%M:%S})")
     else:
-        with st.spinner(f"Validating {selected_lender}..."):
-            final_df = runner.run_validation(selected_lender, specific_table=table_arg)
+        st.write(f"### ⏳ Running Validation: {finished}/{total} tables done")
+    st.progress(finished / total if total else 1.0)
+
+    with st.expander("Progress by table", expanded=not job.done):
+        st.dataframe(
+            pd.DataFrame(
+                [{"lender": l, "table": t, "status": status} for (l, t), status in job.unit_status.items()]
+            ),
+            use_container_width=True, hide_index=True
+        )
+
+    # Partial results: every table finished so far
+    final_df = job.results()
 
-    # 3. DISPLAY RESULTS
+    if 'cached' in final_df.columns:
+        cached_count = int((final_df['cached'] == True).sum())
+        if cached_count:
+            st.caption(f"♻️ {cached_count} of {len(final_df)} results reused from unchanged tables. "
+                       "Tick 'Force refresh' to re-check them.")
+
+elif results_store is not None:
+    # Show the last recorded run instead of re-running validation
+    last_run_id = results_store.latest_run_id()
+    if last_run_id:
+        final_df = results_store.get_run_results(last_run_id, lender=lender_arg, table_name=table_arg)
+        st.write(f"### 🗂️ Last Recorded Run: {last_run_id}")
+        st.caption("Press 'Run Diagnostics' to validate again.")
+
+# ---------------------------------------------------------
+# PHASE 4: DISPLAY RESULTS
+# ---------------------------------------------------------
+if job is not None or not final_df.empty:
     if not final_df.empty:
-        cols = ['status', 'lender', 'table', 'test_description', 'failed_rows', 'total_rows', 'severity', 'error_msg']
-        existing_cols = [c for c in cols if c in final_df.columns]
+        cols = ['status', 'lender', 'table', 'test_description', 'failed_rows', 'failed_rows_low',
+                'failed_rows_high', 'total_rows', 'severity', 'error_msg']
+        # Confidence bounds only mean something when a sampled rule ran
+        existing_cols = [c for c in cols if c in final_df.columns and not (
+            c.startswith('failed_rows_') and final_df[c].isna().all()
+        )]
         final_df = final_df[existing_cols]
 
         def color_status(val):
             if val == 'PASS': color = 'green'
-            elif val == 'ERROR': color = '#ff9900'
+            elif val in ('ERROR', 'TIMEOUT'): color = '#ff9900'
+            elif val == 'SKIPPED': color = 'gray'
             else: color = 'red'
             return f'color: {color}; font-weight: bold'
 
@@ -97,13 +191,18 @@ if run_btn:
             use_container_width=True,
             column_config={
                 "failed_rows": st.column_config.NumberColumn(format="%d"),
+                "failed_rows_low": st.column_config.NumberColumn(format="%d", help="Lower confidence bound (sampled rules)"),
+                "failed_rows_high": st.column_config.NumberColumn(format="%d", help="Upper confidence bound (sampled rules)"),
                 "total_rows": st.column_config.NumberColumn(format="%d", help="Total rows in the table"),
                 "error_msg": st.column_config.TextColumn("Details / Error", width="large", help="Hover to see full text or check details below.")
             }
         )
         
         # --- ROBUST FILTER: CATCH ANYTHING THAT IS NOT PASS ---
-        fails_or_errors = final_df[final_df['status'] != 'PASS']
+        fails_or_errors = final_df[~final_df['status'].isin(['PASS', 'SKIPPED'])]
+        skipped_count = int((final_df['status'] == 'SKIPPED').sum())
+        if skipped_count:
+            st.info(f"⏭️ {skipped_count} checks skipped because a rule they depend on did not pass.")
         
         if not fails_or_errors.empty:
             st.error(f"⚠️ Found {len(fails_or_errors)} issues.")
@@ -115,11 +214,40 @@ if run_btn:
                 with st.expander(f"{row['status']}: {row['test_description']} ({row['table']})", expanded=True):
                     if row['status'] == 'ERROR':
                         st.code(row['error_msg'], language="sql")
+                    elif row['status'] == 'TIMEOUT':
+                        st.warning(row['error_msg'])
                     else:
                         st.info(f"Failed Rows: {row['failed_rows']} / {row['total_rows']}")
                         if row['error_msg']:
                             st.error(row['error_msg'])
         else:
             st.success("✅ All systems green.")
+    elif job is not None and not job.done:
+        st.info("Waiting for the first table to finish...")
     else:
-        st.warning("No results returned.")
\ No newline at end of file
+        st.warning("No results returned.")
+
+# ---------------------------------------------------------
+# PHASE 5: HISTORY
+# ---------------------------------------------------------
+if results_store is not None:
+    rule_options = results_store.rule_names()
+    if rule_options:
+        st.write("---")
+        st.subheader("📈 Rule History")
+        col_rule, col_days = st.columns([3, 1])
+        trend_rule = col_rule.selectbox("Rule", rule_options)
+        trend_days = col_days.number_input("Days", min_value=1, max_value=365, value=30)
+        trend_df = results_store.rule_trend(trend_rule, days=int(trend_days), lender=lender_arg, table_name=table_arg)
+        if trend_df.empty:
+            st.info("No recorded results for this rule in the selected window.")
+        else:
+            trend_df['recorded_at'] = pd.to_datetime(trend_df['recorded_at'])
+            chart_df = trend_df.pivot_table(index='recorded_at', columns='lender', values='failed_rows', aggfunc='sum')
+            st.line_chart(chart_df)
+            st.dataframe(trend_df, use_container_width=True)
+
+# Keep following a running job: partial results appear as its tables finish
+if job is not None and not job.done:
+    time.sleep(float(rule_set.settings.get('dashboard_poll_seconds', 2)))
+    st.rerun()
@@ -0,0 +1,344 @@
+"""
+Asyncio execution of the YAML SQL checks (settings.execution_mode: async).
+
+All lenders run concurrently from one process on SQLAlchemy's asyncio extension
+(aiomysql driver), instead of one OS process per lender. Rules are run with
+count-first semantics exactly like the direct engine, including fused scans,
+time limits and profiling, and the results have the same columns as
+GXRunner.run_validation. Other expectation types are reported as ERROR.
+
+Concurrency is bounded twice: per lender by max_concurrent_queries (as in the
+threaded runner) and per database host by settings.async_max_queries_per_host.
+Failed rows of a failing check are still downloaded with the regular
+synchronous exporter, on a worker thread.
+
+Requires the optional package `greenlet` and the async driver of the lenders'
+databases: `aiomysql` for MySQL, `aiosqlite` for SQLite (settings.async_driver
+overrides the choice).
+"""
+import time
+import asyncio
+import logging
+import contextlib
+import importlib.util
+
+import pandas as pd
+import sqlalchemy
+
+from src import rule_registry
+from src import sql_fusion
+from src.gx_wrapper import GXRunner, QueryTimeout, is_duplicate_column_error, is_timeout_error
+
+logger = logging.getLogger('dq_engine')
+
+# Async driver for each backend the sync connection string can point at
+ASYNC_DRIVERS = {"mysql": "mysql+aiomysql", "sqlite": "sqlite+aiosqlite"}
+
+
+def async_url(runner, lender_id):
+    """The lender's connection URL with the async driver for its database."""
+    url = sqlalchemy.engine.make_url(runner._build_connection_string(runner.secrets[lender_id]))
+    driver = runner.settings.get('async_driver') or ASYNC_DRIVERS.get(url.get_backend_name())
+    if not driver:
+        raise ValueError(f"No async driver known for '{url.get_backend_name()}'. Set settings.async_driver.")
+    return url.set(drivername=driver)
+
+
+def async_available(runner, lenders):
+    """True if greenlet and the async driver of every lender's database are installed."""
+    modules = {"greenlet"}
+    for lender_id in lenders:
+        try:
+            modules.add(async_url(runner, lender_id).get_driver_name())
+        except ValueError:
+            return False
+    return all(importlib.util.find_spec(module) is not None for module in modules)
+
+
+class AsyncSQLRunner:
+    def __init__(self, runner=None, per_host_limit=None):
+        # The wrapped GXRunner supplies config, planning, result rows and exports
+        self.runner = runner or GXRunner()
+        self.settings = self.runner.settings
+        self.per_host_limit = int(per_host_limit or self.settings.get('async_max_queries_per_host', 8))
+        self._host_slots = {}
+        self._lender_slots = {}
+
+    def _create_engine(self, lender_id):
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        url = async_url(self.runner, lender_id)
+        if url.get_backend_name() == "sqlite":
+            return create_async_engine(url)
+        return create_async_engine(
+            url,
+            pool_size=self.runner._max_concurrent_queries(lender_id),
+            max_overflow=self.settings.get('pool_max_overflow', 5),
+            pool_recycle=self.settings.get('pool_recycle_seconds', 3600),
+            pool_pre_ping=True
+        )
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, lender_id, waits):
+        """Holds a lender and a host slot; the time spent queueing for them is appended to `waits`."""
+        lender_slots, host_slots = self._slots(lender_id)
+        queued = time.perf_counter()
+        async with lender_slots, host_slots:
+            waits.append(time.perf_counter() - queued)
+            yield
+
+    def _slots(self, lender_id):
+        """(lender semaphore, host semaphore) bounding this lender's statements in flight."""
+        host = self.runner.lender_host(lender_id)
+        if host not in self._host_slots:
+            self._host_slots[host] = asyncio.Semaphore(self.per_host_limit)
+        if lender_id not in self._lender_slots:
+            self._lender_slots[lender_id] = asyncio.Semaphore(self.runner._max_concurrent_queries(lender_id))
+        return self._lender_slots[lender_id], self._host_slots[host]
+
+    async def _execute(self, engine, lender_id, query, timeout, waits, fetch="one"):
+        """
+        Runs one statement within the lender's and host's limits. The statement gets
+        the MAX_EXECUTION_TIME hint and is killed by the runner kill_grace_seconds
+        after its limit. fetch="one" returns the first row, fetch="count" counts rows.
+        """
+        if timeout is not None and timeout <= 0:
+            raise QueryTimeout("Skipped: lender time budget exhausted or run cancelled")
+        statement = sqlalchemy.text(self.runner._timeout_hint(engine, query, timeout))
+
+        async with self._slot(lender_id, waits):
+            async with engine.connect() as conn:
+                fired = []
+                watchdog = None
+                if timeout is not None:
+                    # Cancelling the task would wait for the statement; killing it ends both
+                    raw_conn = await conn.get_raw_connection()
+                    delay = timeout + float(self.settings.get('kill_grace_seconds', 5))
+                    watchdog = asyncio.create_task(self._kill_after(engine, raw_conn, delay, fired))
+                try:
+                    if fetch == "count":
+                        result = await conn.stream(statement)
+                        count = 0
+                        async for _ in result:
+                            count += 1
+                        return count
+                    result = await conn.execute(statement)
+                    return result.fetchone()
+                except Exception as e:
+                    if fired or is_timeout_error(e):
+                        raise QueryTimeout(f"Query stopped after exceeding its time limit ({timeout:.1f}s)") from e
+                    raise
+                finally:
+                    if watchdog is not None:
+                        watchdog.cancel()
+
+    async def _kill_after(self, engine, raw_conn, delay, fired):
+        """Stops the statement running on raw_conn after `delay` seconds (KILL QUERY / sqlite interrupt)."""
+        await asyncio.sleep(delay)
+        fired.append(True)
+        try:
+            if engine.dialect.name == "mysql":
+                thread_id = raw_conn.driver_connection.thread_id()
+                async with engine.connect() as kill_conn:
+                    await kill_conn.exec_driver_sql(f"KILL QUERY {int(thread_id)}")
+            elif engine.dialect.name == "sqlite":
+                await raw_conn.driver_connection.interrupt()
+        except Exception as e:
+            logger.error(f"Could not kill a runaway query: {e}")
+
+    async def _finish(self, sync_engine, lender_id, table_name, exp_config, primary_keys, table_count, unexpected_count,
+                      waits):
+        """Builds the result row; a failing check's rows are downloaded on a worker thread."""
+        if unexpected_count == 0:
+            if self.runner.failed_row_store is not None:
+                # Resolving the check's rows in the delta store is file I/O; keep it off the loop
+                return await asyncio.to_thread(
+                    self.runner._finish_count_check,
+                    sync_engine, lender_id, table_name, exp_config, primary_keys, table_count, 0
+                )
+            return self.runner._finish_count_check(
+                sync_engine, lender_id, table_name, exp_config, primary_keys, table_count, 0
+            )
+        async with self._slot(lender_id, waits):
+            return await asyncio.to_thread(
+                self.runner._finish_count_check,
+                sync_engine, lender_id, table_name, exp_config, primary_keys, table_count, unexpected_count
+            )
+
+    async def _count_check(self, engine, sync_engine, lender_id, plan, exp_config, table_count):
+        runner = self.runner
+        table_name = plan['table']
+        meta = exp_config.get('meta', {})
+        display_name = exp_config.get('name') or "Custom SQL Check"
+        query, _ = runner._rule_query(exp_config, table_name)
+        timeout = runner._query_timeout(lender_id, exp_config)
+        # Time queued for a lender/host slot is not the check's cost (plan_work orders units by it)
+        waits = []
+        start = time.perf_counter()
+
+        try:
+            with runner.profiler.phase("query", lender_id, table_name, display_name) as timing:
+                try:
+                    row = await self._execute(engine, lender_id, runner._count_query(query, table_name), timeout, waits)
+                    unexpected_count = int(row[0] or 0)
+                except QueryTimeout:
+                    raise
+                except Exception as count_err:
+                    # A derived table must have unique column names (MySQL 1060);
+                    # such queries are counted client-side instead
+                    if not is_duplicate_column_error(count_err):
+                        raise
+                    unexpected_count = await self._execute(engine, lender_id, query, timeout, waits, fetch="count")
+                timing['rows'] = unexpected_count
+            result_row = await self._finish(
+                sync_engine, lender_id, table_name, exp_config, plan['primary_keys'], table_count, unexpected_count, waits
+            )
+        except QueryTimeout as e:
+            result_row = runner._build_result_row(lender_id, table_name, display_name, meta, "TIMEOUT", 0, table_count, str(e))
+        except Exception as e:
+            result_row = runner._build_result_row(lender_id, table_name, display_name, meta, "ERROR", 0, table_count, str(e)[:2000])
+
+        result_row['duration_s'] = round(time.perf_counter() - start - sum(waits), 3)
+        return [result_row]
+
+    async def _fused_checks(self, engine, sync_engine, lender_id, plan, group, table_count):
+        runner = self.runner
+        table_name = plan['table']
+        first = group[0][1]
+        fused_query = sql_fusion.build_fused_count_query(
+            first['table'], first['alias'], [parsed['condition'] for _, parsed in group], where=first['where']
+        )
+        rule_names = "+".join(exp_config.get('name') or "Custom SQL Check" for exp_config, _ in group)
+        timeouts = [runner._query_timeout(lender_id, exp_config) for exp_config, _ in group]
+        timeout = None if None in timeouts else max(timeouts)
+        waits = []
+        start = time.perf_counter()
+
+        try:
+            with runner.profiler.phase("fused_query", lender_id, table_name, rule_names) as timing:
+                counts = await self._execute(engine, lender_id, fused_query, timeout, waits)
+                timing['rows'] = sum(int(count or 0) for count in counts)
+        except QueryTimeout as e:
+            rows = [
+                runner._build_result_row(
+                    lender_id, table_name, exp_config.get('name') or "Custom SQL Check", exp_config.get('meta', {}),
+                    "TIMEOUT", 0, table_count, str(e)
+                )
+                for exp_config, _ in group
+            ]
+            for row in rows:
+                row['duration_s'] = round((time.perf_counter() - start - sum(waits)) / len(rows), 3)
+            return rows
+        except Exception as e:
+            logger.warning(f"[{lender_id}] [{table_name}] Fused scan of {len(group)} checks failed, running them one by one: {e}")
+            results = await asyncio.gather(*[
+                self._count_check(engine, sync_engine, lender_id, plan, exp_config, table_count) for exp_config, _ in group
+            ])
+            return [row for rows in results for row in rows]
+
+        logger.info(f"[{lender_id}] [{table_name}] Counted {len(group)} checks in one scan.")
+        rows = []
+        for (exp_config, _), count in zip(group, counts):
+            rows.append(await self._finish(
+                sync_engine, lender_id, table_name, exp_config, plan['primary_keys'], table_count, int(count or 0), waits
+            ))
+        for row in rows:
+            row['duration_s'] = round((time.perf_counter() - start - sum(waits)) / len(rows), 3)
+        return rows
+
+    async def run_lender(self, lender_id, specific_table=None):
+        """Async counterpart of GXRunner.run_validation(lender_id, check_engine="direct")."""
+        runner = self.runner
+        logger.info(f"Initializing async engine for {lender_id}...")
+        budget = runner.lender_time_budget(lender_id)
+        if budget:
+            runner._deadlines[lender_id] = time.monotonic() + budget
+        runner._reset_table_metadata(lender_id)
+
+        engine = None
+        try:
+            engine = self._create_engine(lender_id)
+            # Used for the table metadata and to export a failing check's rows
+            sync_engine = runner._get_engine(lender_id)
+
+            if specific_table:
+                if specific_table not in runner.registry.tables:
+                    logger.warning(f"Table {specific_table} requested but not found in rules YAML.")
+                    return pd.DataFrame()
+                target_tables = [specific_table]
+            else:
+                target_tables = list(runner.registry.tables.keys())
+
+            plans = [runner._plan_table(lender_id, t, "direct") for t in target_tables]
+            plans = [plan for plan in plans if plan and (plan['sql_rules'] or plan['unsupported_rules'])]
+
+            # One metadata round trip per lender, shared with the synchronous runner
+            metadata = await asyncio.to_thread(
+                runner.table_metadata, lender_id, [plan['table'] for plan in plans], sync_engine
+            )
+            table_counts = {table_name: meta['row_count'] for table_name, meta in metadata.items()}
+
+            rows = []
+            # Dependency levels run in order, as in GXRunner.run_validation
+            statuses = {}
+            for level in runner._rule_levels(plans):
+                tasks = []
+                for plan in plans:
+                    table_count = table_counts[plan['table']]
+                    level_plan = runner._level_plan(plan, level)
+                    level_rows = runner._skip_failed_dependencies(lender_id, level_plan, statuses, table_count)
+                    sql_rules = level_plan['sql_rules']
+                    if runner.fuse_checks and sql_rules:
+                        fused_groups, sql_rules = runner._group_fusable_checks(plan['table'], sql_rules)
+                        tasks.extend(
+                            self._fused_checks(engine, sync_engine, lender_id, plan, group, table_count) for group in fused_groups
+                        )
+                    tasks.extend(
+                        self._count_check(engine, sync_engine, lender_id, plan, exp_config, table_count) for exp_config in sql_rules
+                    )
+                    for exp_config in level_plan['unsupported_rules']:
+                        level_rows.append(runner._build_result_row(
+                            lender_id, plan['table'], exp_config.get('name') or exp_config['type'], exp_config.get('meta', {}),
+                            "ERROR", 0, table_count,
+                            f"Expectation type '{exp_config['type']}' needs the GX engine; async mode only runs unexpected_rows_expectation rules."
+                        ))
+                    rows.extend(level_rows)
+
+                for task_rows in await asyncio.gather(*tasks):
+                    rows.extend(task_rows)
+                statuses.update(rule_registry.rule_statuses(pd.DataFrame(rows)))
+            return pd.DataFrame(rows)
+
+        except Exception as e:
+            logger.error(f"Async Critical Failure for {lender_id}: {e}")
+            return pd.DataFrame([{
+                "lender": lender_id,
+                "table": "SYSTEM",
+                "status": "CRITICAL_ERROR",
+                "test_description": "Async_Execution",
+                "error_msg": str(e),
+                "severity": "critical",
+                "failed_rows": 0,
+                "total_rows": 0
+            }])
+        finally:
+            runner._deadlines.pop(lender_id, None)
+            if engine is not None:
+                await engine.dispose()
+            if not runner.persistent_engines:
+                runner.dispose_engines(lender_id)
+
+    async def run_all(self, lenders=None, specific_table=None):
+        lenders = lenders or list(self.runner.secrets.keys())
+        frames = await asyncio.gather(*[self.run_lender(lender_id, specific_table) for lender_id in lenders])
+        frames = [frame for frame in frames if not frame.empty]
+        if self.runner.failed_rows_format == "parquet":
+            self.runner.finalize_failed_rows()
+        elif self.runner.failed_row_store is not None:
+            for lender_id in lenders:
+                self.runner.failed_row_store.maybe_compact(lender_id)
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def run(self, lenders=None, specific_table=None):
+        """Validates every lender (or the given ones) concurrently and returns one DataFrame."""
+        return asyncio.run(self.run_all(lenders, specific_table))
@@ -0,0 +1,178 @@
+"""
+Command line entry point.
+
+    python -m src.cli run                                   # the daily job (report + email)
+    python -m src.cli run --lenders acme --rules check_positive_amount
+    python -m src.cli run --tables v73__loan_details --severity critical --engine direct
+    python -m src.cli list --severity critical              # what a run would check, no database
+    python -m src.cli plan --tables v73__loan_details       # EXPLAIN review of the SQL rules (src/query_plan.py)
+    python -m src.cli daemon                                # scheduler daemon (see src/daemon.py)
+
+--lenders, --tables, --rules and --severity take comma-separated names (or repeat
+the option) and combine: a rule runs if it matches every filter given. A filtered
+run is recorded in the results store with source "cli" and prints its results
+instead of writing the summary report and sending the email (--report does both).
+
+Modules are imported only when a command needs them: `list` never loads pandas,
+SQLAlchemy or Great Expectations, and a filtered run with --engine direct never
+loads Great Expectations. Exits with 0 when every check passed (plan: every
+rule's plan is OK), 1 when any did not, and 2 for a config or usage error.
+"""
+import sys
+import argparse
+
+
+def _names(values):
+    """['a,b', 'c'] -> ['a', 'b', 'c']; None when the option was not given."""
+    if not values:
+        return None
+    return [name.strip() for value in values for name in value.split(",") if name.strip()]
+
+
+def _load_selection(args):
+    """(lenders, selection, registry) for the filters; raises ValueError with what is wrong."""
+    import toml
+    from src import rule_registry
+
+    known_lenders = list(toml.load("secrets.toml")['lenders'])
+    lenders = _names(args.lenders)
+    unknown = [lender for lender in lenders or () if lender not in known_lenders]
+    if unknown:
+        raise ValueError(f"Unknown lender(s): {', '.join(unknown)}")
+
+    registry = rule_registry.load("config/gx_rules.yaml")
+    tables, rule_names, severities = _names(args.tables), _names(args.rules), _names(args.severity)
+    selection = None
+    if tables or rule_names or severities:
+        selection = registry.select(tables=tables, rule_names=rule_names, severities=severities)
+        if not selection:
+            raise ValueError("No rules match the given filters.")
+    return lenders or known_lenders, selection, registry
+
+
+def _cmd_list(args, lenders, selection, registry):
+    selection = selection if selection is not None else registry.select()
+    for table_name, rule_names in selection.items():
+        rules = {rule.get('name'): rule for rule in registry.tables[table_name]['rules']}
+        print(table_name)
+        for name in rule_names:
+            rule = rules[name]
+            targets = rule.get('target_lenders')
+            applies = [lender for lender in lenders if not targets or lender in targets]
+            print(f"  {name:<45} {rule['meta'].get('severity', 'warning'):<9} {rule['type']}"
+                  + ("" if len(applies) == len(lenders) else f"  (lenders: {', '.join(applies) or 'none'})"))
+    print(f"{sum(len(names) for names in selection.values())} rules on {len(selection)} tables, "
+          f"{len(lenders)} lender(s).")
+    return 0
+
+
+def _cmd_run(args, lenders, selection, registry):
+    targeted = selection is not None or args.lenders is not None
+
+    import daily_job
+    results = daily_job.main(
+        lenders=lenders,
+        selection=selection,
+        check_engine=args.engine,
+        report=args.report if args.report is not None else not targeted,
+        source="cli" if targeted else "daily_job"
+    )
+    if results is None:
+        return 2
+    if results.empty:
+        print("No results.")
+        return 1
+
+    import pandas as pd
+    columns = [c for c in ['status', 'lender', 'table', 'rule_name', 'failed_rows', 'total_rows', 'error_msg']
+               if c in results.columns]
+    not_passed = results[results['status'] != 'PASS']
+    if targeted or not_passed.empty:
+        shown = results
+    else:
+        shown = not_passed
+    with pd.option_context('display.max_rows', None, 'display.max_colwidth', 80, 'display.width', 200):
+        print(shown[columns].to_string(index=False))
+    print(", ".join(f"{status}: {count}" for status, count in results['status'].value_counts().items()))
+    return 1 if not not_passed.empty else 0
+
+
+def _cmd_plan(args, lenders, selection, registry):
+    import datetime
+    import pandas as pd
+    from src.gx_wrapper import GXRunner
+    from src.logging_setup import configure_logging
+    from src.query_plan import PlanAdvisor
+
+    configure_logging()
+    report = PlanAdvisor(GXRunner()).report(lenders, selection)
+    if report.empty:
+        print("No SQL rules to explain.")
+        return 0
+    output = args.output or f"plan_report_{datetime.datetime.now():%Y%m%d_%H%M%S}.csv"
+    report.to_csv(output, index=False)
+
+    flagged = report[report['verdict'] != 'OK']
+    columns = ['verdict', 'lender', 'table', 'rule_name', 'query_cost', 'rows_examined_est', 'full_scans',
+               'unindexed_joins', 'error_msg']
+    with pd.option_context('display.max_rows', None, 'display.max_colwidth', 60, 'display.width', 250):
+        if not flagged.empty:
+            print(flagged[columns].to_string(index=False))
+    # The same index usually helps every lender with the same schema
+    suggestions = {}
+    for _, row in flagged.iterrows():
+        for statement in filter(None, (row['suggested_indexes'] or "").split("; ")):
+            suggestions.setdefault(statement, set()).add(row['rule_name'])
+    if suggestions:
+        print("\nSuggested indexes:")
+        for statement, rule_names in suggestions.items():
+            print(f"  {statement};  -- {', '.join(sorted(rule_names))}")
+    print("\n" + ", ".join(f"{verdict}: {count}" for verdict, count in report['verdict'].value_counts().items()))
+    print(f"Saved {output}")
+    return 1 if not flagged.empty else 0
+
+
+def _cmd_daemon(args, lenders, selection, registry):
+    from src.daemon import SchedulerDaemon
+    SchedulerDaemon().run_forever()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.cli", description="GX data quality checks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument("--lenders", action="append", help="Lender names from secrets.toml.")
+    filters.add_argument("--tables", action="append", help="Table names from the rules file.")
+    filters.add_argument("--rules", action="append", help="Rule names.")
+    filters.add_argument("--severity", action="append", help="Rule severities, e.g. critical.")
+
+    run_parser = commands.add_parser("run", parents=[filters], help="Run the checks.")
+    run_parser.add_argument("--engine", choices=["gx", "direct"], help="Check engine (default: settings.check_engine).")
+    run_parser.add_argument("--report", action=argparse.BooleanOptionalAction, default=None,
+                            help="Write the summary report and send the email (default: only for unfiltered runs).")
+    run_parser.set_defaults(handler=_cmd_run)
+
+    list_parser = commands.add_parser("list", parents=[filters], help="List the rules a run would check.")
+    list_parser.set_defaults(handler=_cmd_list)
+
+    plan_parser = commands.add_parser("plan", parents=[filters], help="EXPLAIN every SQL rule and flag costly plans.")
+    plan_parser.add_argument("--output", help="CSV report path (default: plan_report_<timestamp>.csv).")
+    plan_parser.set_defaults(handler=_cmd_plan)
+
+    daemon_parser = commands.add_parser("daemon", help="Run rules on their schedules with a warm worker pool.")
+    daemon_parser.set_defaults(handler=_cmd_daemon, lenders=None, tables=None, rules=None, severity=None)
+
+    args = parser.parse_args(argv)
+    try:
+        lenders, selection, registry = _load_selection(args)
+    except (ValueError, OSError, KeyError) as e:
+        # RuleConfigError is a ValueError
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    return args.handler(args, lenders, selection, registry)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
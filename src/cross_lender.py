@@ -0,0 +1,320 @@
+"""
+Cross-lender execution of the YAML SQL checks (settings.execution_mode: cross_lender).
+
+Lenders whose databases live on the same MySQL server under the same credentials
+are validated together: each count-first rule runs once, as a UNION ALL of one
+branch per lender schema tagged with the lender, e.g.
+
+    SELECT 'acme' AS dq_lender, COUNT(*) AS dq_count FROM (<rule on `acme`.tables>) AS dq_unexpected
+    UNION ALL
+    SELECT 'beta' AS dq_lender, COUNT(*) AS dq_count FROM (<rule on `beta`.tables>) AS dq_unexpected
+
+and the combined result is split back into the usual per-lender rows (fused scans,
+see src/sql_fusion.py, are combined the same way). A failing lender's rows are
+still downloaded from its own database. Rules that can't be pointed at another
+schema (see sql_rewrite.qualify_tables), GX checks and unnamed rules' tables run
+per lender with GXRunner.run_validation. Dependency levels run in order and
+SKIPPED works as in the other modes.
+
+Cross-lender runs are full, unsampled scans: incremental watermarks and the
+result cache are not used for the combined checks. Each lender's table row counts
+are fetched once per run and shared by its combined and per-lender checks.
+"""
+import time
+import logging
+import threading
+import functools
+import concurrent.futures
+
+import pandas as pd
+import sqlalchemy
+
+from src import rule_registry
+from src import sql_fusion
+from src import sql_rewrite
+from src.gx_wrapper import GXRunner, QueryTimeout
+
+logger = logging.getLogger('dq_engine')
+
+
+def _url(runner, lender_id):
+    return sqlalchemy.engine.make_url(runner._build_connection_string(runner.secrets[lender_id]))
+
+
+def _server_key(runner, lender_id):
+    """What a lender's connection shares with co-hosted lenders, or None if it can't be combined."""
+    creds = runner.secrets[lender_id]
+    url = _url(runner, lender_id)
+    if url.get_backend_name() != "mysql" or not url.database or creds.get('sql_shim'):
+        return None
+    return (url.drivername, url.host, url.port or 3306, url.username, url.password, tuple(sorted(url.query.items())))
+
+
+def _schema(runner, lender_id):
+    """The database (schema) holding a lender's tables."""
+    return _url(runner, lender_id).database
+
+
+def host_groups(runner, lenders):
+    """Lists of two or more lenders that share a MySQL server and credentials."""
+    groups = {}
+    for lender_id in lenders:
+        key = _server_key(runner, lender_id)
+        if key is not None:
+            groups.setdefault(key, []).append(lender_id)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def _lender_literal(lender_id):
+    return "'" + lender_id.replace("'", "''") + "'"
+
+
+class CrossLenderRunner:
+    def __init__(self, runner=None):
+        # The wrapped GXRunner supplies config, planning, engines, result rows and exports.
+        # It should keep table row counts (cache_table_counts=True), or every per-lender
+        # run_validation of uncombined rules counts the table again.
+        self.runner = runner or GXRunner(cache_table_counts=True)
+        self.settings = self.runner.settings
+        self.tables = list(self.runner.registry.tables.keys())
+        # The GX context is not thread-safe; per-lender GX work of different groups takes turns
+        self._gx_lock = threading.Lock()
+
+    def _movable_query(self, exp_config, table_name, schema):
+        """The rule's SQL reading `schema`'s tables, or None if it can't be moved."""
+        query, _ = self.runner._rule_query(exp_config, table_name)
+        return sql_rewrite.qualify_tables(query, schema, self.tables)
+
+    def _branch(self, lender_id, table_name, rules, fused):
+        """One lender's part of a combined statement: the lender, then its counter column(s)."""
+        schema = _schema(self.runner, lender_id)
+        if fused:
+            parsed = rules[0][1]
+            table = parsed['table']
+            if "." not in table:
+                # The alias keeps `table.column` references working on the qualified name
+                bare = table.replace('`', '')
+                table, parsed = f"`{schema}`.`{bare}`", dict(parsed, alias=parsed['alias'] or bare)
+            query = sql_fusion.build_fused_count_query(
+                table, parsed['alias'], [condition['condition'] for _, condition in rules]
+            )
+            return f"SELECT {_lender_literal(lender_id)} AS dq_lender, {query[len('SELECT '):]}"
+        query = self._movable_query(rules[0], table_name, schema)
+        return (f"SELECT {_lender_literal(lender_id)} AS dq_lender, COUNT(*) AS dq_count "
+                f"FROM (\n{query}\n) AS dq_unexpected")
+
+    def _run_combined(self, lenders, table_name, rules, fused, primary_keys, table_counts):
+        """
+        Counts `rules` for every lender in one statement on the first lender's engine
+        and returns the per-lender result rows. If the statement fails, every lender
+        runs the rules on its own so the error is attributed to the right lender and rule.
+        """
+        runner = self.runner
+        leader = lenders[0]
+        engine = runner._get_engine(leader)
+        configs = [exp_config for exp_config, _ in rules] if fused else rules
+        rule_names = "+".join(exp_config.get('name') or "Custom SQL Check" for exp_config in configs)
+        label = "+".join(lenders)
+        query = "\nUNION ALL\n".join(self._branch(lender_id, table_name, rules, fused) for lender_id in lenders)
+        # The shared statement gets the most generous limit of its lenders and rules
+        timeouts = [runner._query_timeout(lender_id, exp_config) for lender_id in lenders for exp_config in configs]
+        timeout = None if None in timeouts else max(timeouts)
+        start = time.perf_counter()
+
+        try:
+            with runner.profiler.phase("cross_lender_query", label, table_name, rule_names) as timing, \
+                    engine.connect() as conn, runner._watchdog(engine, conn.connection, leader, timeout):
+                counts = {row[0]: row[1:] for row in conn.execute(sqlalchemy.text(runner._timeout_hint(engine, query, timeout)))}
+                timing['rows'] = sum(int(count or 0) for lender_counts in counts.values() for count in lender_counts)
+        except QueryTimeout as e:
+            rows = [
+                runner._build_result_row(
+                    lender_id, table_name, exp_config.get('name') or "Custom SQL Check", exp_config.get('meta', {}),
+                    "TIMEOUT", 0, table_counts[lender_id], str(e)
+                )
+                for lender_id in lenders for exp_config in configs
+            ]
+        except Exception as e:
+            logger.warning(f"[{label}] [{table_name}] Cross-lender scan of {len(configs)} checks failed, running it per lender: {e}")
+            rows = []
+            for lender_id in lenders:
+                lender_engine = runner._get_engine(lender_id)
+                if fused:
+                    rows.extend(runner._run_fused_checks(
+                        lender_engine, lender_id, table_name, rules, primary_keys[lender_id], table_counts[lender_id]
+                    ))
+                else:
+                    rows.append(runner._run_count_check(
+                        lender_engine, lender_id, table_name, rules[0], primary_keys[lender_id], table_counts[lender_id]
+                    ))
+        else:
+            logger.info(f"[{label}] [{table_name}] Counted {len(configs)} checks for {len(lenders)} lenders in one statement.")
+            rows = [
+                runner._finish_count_check(
+                    runner._get_engine(lender_id), lender_id, table_name, exp_config, primary_keys[lender_id],
+                    table_counts[lender_id], int(count or 0)
+                )
+                for lender_id in lenders
+                for exp_config, count in zip(configs, counts[lender_id])
+            ]
+
+        # Lenders and rules that shared the statement split its wall time evenly
+        for row in rows:
+            row['duration_s'] = round((time.perf_counter() - start) / len(rows), 3)
+        return rows
+
+    def _run_lender_rules(self, lender_id, table_name, rule_names, check_engine, deadline, gate_status):
+        """Rules that can't be combined, run for one lender as in the other execution modes."""
+        run = functools.partial(
+            self.runner.run_validation, lender_id, specific_table=table_name, check_engine=check_engine, full_scan=True,
+            rule_names=rule_names, deadline=deadline, gate_status=gate_status
+        )
+        if check_engine == "gx":
+            with self._gx_lock:
+                return run()
+        return run()
+
+    def _critical_row(self, lender_id, error):
+        return {
+            "lender": lender_id,
+            "table": "SYSTEM",
+            "status": "CRITICAL_ERROR",
+            "test_description": "Cross_Lender_Execution",
+            "error_msg": str(error),
+            "severity": "critical",
+            "failed_rows": 0,
+            "total_rows": 0
+        }
+
+    def run_group(self, lenders, selection=None, check_engine=None):
+        """Validates co-hosted `lenders` together; returns their results as one DataFrame."""
+        runner = self.runner
+        check_engine = check_engine or runner.check_engine
+        logger.info(f"Initializing cross-lender run for {', '.join(lenders)}...")
+        # Wall-clock deadlines, shared with the per-lender runs of uncombined rules
+        deadlines = {}
+        with runner._inflight_lock:
+            for lender_id in lenders:
+                runner._active_runs[lender_id] = runner._active_runs.get(lender_id, 0) + 1
+                budget = runner.lender_time_budget(lender_id)
+                if budget:
+                    runner._deadlines[lender_id] = time.monotonic() + budget
+                    deadlines[lender_id] = time.time() + budget
+
+        frames = []
+        try:
+            plans = {}
+            table_counts = {}
+            for lender_id in lenders:
+                runner._reset_table_metadata(lender_id)
+                try:
+                    lender_plans = [
+                        runner._plan_table(lender_id, table_name, check_engine,
+                                           rule_names=selection[table_name] if selection is not None else None)
+                        for table_name in self.tables if selection is None or table_name in selection
+                    ]
+                    lender_plans = [plan for plan in lender_plans if plan and runner._plan_rules(plan)]
+                    metadata = runner.table_metadata(
+                        lender_id, [plan['table'] for plan in lender_plans], runner._get_engine(lender_id)
+                    )
+                except Exception as e:
+                    logger.error(f"Cross-lender Critical Failure for {lender_id}: {e}")
+                    frames.append(pd.DataFrame([self._critical_row(lender_id, e)]))
+                    continue
+                plans[lender_id] = lender_plans
+                table_counts[lender_id] = {table_name: meta['row_count'] for table_name, meta in metadata.items()}
+
+            statuses = {lender_id: {} for lender_id in plans}
+            max_workers = min((runner._max_concurrent_queries(lender_id) for lender_id in plans), default=1)
+            for level in runner._rule_levels([plan for lender_plans in plans.values() for plan in lender_plans]):
+                # (table, rules) -> lenders that run exactly those rules in one statement
+                combined = {}
+                units = []
+                for lender_id, lender_plans in plans.items():
+                    schema = _schema(runner, lender_id)
+                    for plan in lender_plans:
+                        table_name = plan['table']
+                        table_count = table_counts[lender_id][table_name]
+                        level_plan = runner._level_plan(plan, level)
+                        rows = runner._skip_failed_dependencies(lender_id, level_plan, statuses[lender_id], table_count)
+
+                        sql_rules = level_plan['sql_rules']
+                        fused_groups = []
+                        if runner.fuse_checks and sql_rules:
+                            fused_groups, sql_rules = runner._group_fusable_checks(table_name, sql_rules)
+                        for group in fused_groups:
+                            key = (table_name, True, tuple(id(exp_config) for exp_config, _ in group))
+                            combined.setdefault(key, (group, []))[1].append(lender_id)
+                        others = []
+                        for exp_config in sql_rules:
+                            if self._movable_query(exp_config, table_name, schema) is None:
+                                others.append(exp_config)
+                                continue
+                            key = (table_name, False, id(exp_config))
+                            combined.setdefault(key, ([exp_config], []))[1].append(lender_id)
+
+                        others += level_plan['gx_rules'] + level_plan['unsupported_rules']
+                        names = [exp_config.get('name') for exp_config in others]
+                        for exp_config in others:
+                            if not exp_config.get('name'):
+                                rows.append(runner._build_result_row(
+                                    lender_id, table_name, exp_config['type'], exp_config.get('meta', {}), "ERROR", 0,
+                                    table_count, "Unnamed rules can't run in cross_lender mode; give the rule a name."
+                                ))
+                        names = [name for name in names if name]
+                        if names:
+                            units.append(functools.partial(
+                                self._run_lender_rules, lender_id, table_name, names, check_engine,
+                                deadlines.get(lender_id), dict(statuses[lender_id])
+                            ))
+                        if rows:
+                            frames.append(pd.DataFrame(rows))
+                            statuses[lender_id].update(rule_registry.rule_statuses(frames[-1]))
+
+                for (table_name, fused, _), (rules, group_lenders) in combined.items():
+                    units.append(functools.partial(
+                        self._run_combined, group_lenders, table_name, rules, fused,
+                        {lender_id: runner.registry.tables[table_name]['primary_keys'] for lender_id in group_lenders},
+                        {lender_id: table_counts[lender_id][table_name] for lender_id in group_lenders}
+                    ))
+
+                for unit_result in runner._run_units(units, max_workers):
+                    if isinstance(unit_result, list):
+                        unit_result = pd.DataFrame(unit_result)
+                    if unit_result.empty:
+                        continue
+                    frames.append(unit_result)
+                    for lender_id, lender_rows in unit_result.groupby('lender'):
+                        if lender_id in statuses:
+                            statuses[lender_id].update(rule_registry.rule_statuses(lender_rows))
+            return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+        except Exception as e:
+            logger.error(f"Cross-lender Critical Failure for {', '.join(lenders)}: {e}")
+            frames.extend(pd.DataFrame([self._critical_row(lender_id, e)]) for lender_id in lenders)
+            return pd.concat(frames, ignore_index=True)
+        finally:
+            with runner._inflight_lock:
+                for lender_id in lenders:
+                    runner._active_runs[lender_id] -= 1
+                    if not runner._active_runs[lender_id]:
+                        del runner._active_runs[lender_id]
+                        runner._deadlines.pop(lender_id, None)
+            if not runner.persistent_engines:
+                for lender_id in lenders:
+                    runner.dispose_engines(lender_id)
+
+    def run(self, groups, selection=None, check_engine=None):
+        """Validates each group of co-hosted lenders (see host_groups), the groups in parallel."""
+        frames = []
+        if groups:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                frames = list(executor.map(lambda group: self.run_group(group, selection, check_engine), groups))
+        frames = [frame for frame in frames if not frame.empty]
+        if self.runner.failed_rows_format == "parquet":
+            self.runner.finalize_failed_rows()
+        elif self.runner.failed_row_store is not None:
+            for group in groups:
+                for lender_id in group:
+                    self.runner.failed_row_store.maybe_compact(lender_id)
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
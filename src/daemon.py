@@ -0,0 +1,145 @@
+"""
+Long-lived scheduler (settings.scheduler_mode: daemon, or `python scheduler.py --daemon`).
+
+Instead of a cold process pool once a day, the daemon keeps one pool of warm
+workers (engine modules imported, one runner with pooled connections per lender)
+and wakes every daemon_tick_seconds to run the rules that are due by their
+`schedule` (src/rule_schedule.py), e.g. freshness probes every 15 minutes and
+heavy joins nightly. Each wake-up with due rules is one run of daily_job.main():
+recorded with source "daemon", or as "daily_job" with the summary report and
+email when it includes the daily_run_time slot.
+
+A change to gx_rules.yaml or secrets.toml restarts the pool on the next wake-up.
+Last-run times are kept in memory: after a restart, interval rules run at once
+and time-of-day rules wait for their next slot rather than run late.
+"""
+import os
+import hashlib
+import logging
+import datetime
+import functools
+import threading
+import concurrent.futures
+
+from src import rule_schedule
+from src import work_scheduler
+from src.logging_setup import configure_logging
+
+logger = logging.getLogger('dq_engine')
+
+CONFIG_FILES = ("secrets.toml", os.path.join("config", "gx_rules.yaml"))
+DEFAULT_RUN_TIME = "17:10"
+
+
+class SchedulerDaemon:
+    def __init__(self):
+        # (table, rule) -> when the run that last included it started
+        self._last_run = {}
+        self._runner = None
+        self._executor = None
+        self._config_hash = None
+        self._stop = threading.Event()
+
+    def _config_changed(self):
+        digest = hashlib.sha256()
+        for path in CONFIG_FILES:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+        config_hash = digest.hexdigest()
+        changed = config_hash != self._config_hash
+        self._config_hash = config_hash
+        return changed
+
+    def _start_pool(self):
+        from src.gx_wrapper import GXRunner
+
+        self._shutdown_pool()
+        # Table row counts are kept within a run (cross-lender units reuse them); start_run clears them
+        self._runner = GXRunner(persistent_engines=True, cache_table_counts=True)
+        workers = self._runner.settings.get('scheduler_workers', 'auto')
+        workers = max(5, os.cpu_count() or 1) if workers == 'auto' else int(workers)
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=functools.partial(work_scheduler.warm_worker, self._runner.check_engine == "gx")
+        )
+        unnamed = sum(1 for table in self._runner.registry.tables.values() for rule in table['rules'] if not rule.get('name'))
+        if unnamed:
+            logger.warning(f"{unnamed} unnamed rule(s) can't be scheduled by the daemon and will not run; give them a name.")
+        logger.info(f"Scheduler daemon: warm pool of {workers} workers for {len(self._runner.secrets)} lenders.")
+
+    def _shutdown_pool(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+        if self._runner is not None:
+            self._runner.dispose_engines()
+            self._runner = None
+
+    def due(self, registry, now, daily_run_time):
+        """
+        The named rules due at `now`, plus the rules they depend on, as {table: [rule
+        names]}, and whether the daily_run_time slot is among them.
+        """
+        selection = {}
+        daily = False
+        for table_name, table in registry.tables.items():
+            for rule in table['rules']:
+                name = rule.get('name')
+                if not name:
+                    continue
+                key = (table_name, name)
+                if key not in self._last_run and rule['schedule'][0] != "every":
+                    # First seen after its slot today: wait for the next one
+                    self._last_run[key] = now
+                if rule_schedule.is_due(rule['schedule'], self._last_run.get(key), now, daily_run_time):
+                    selection.setdefault(table_name, []).append(name)
+                    daily = daily or rule['schedule'] == rule_schedule.DAILY
+        return registry.with_dependencies(selection), daily
+
+    def run_due(self, now=None):
+        """Runs the rules that are due; returns their results, or None if nothing was due."""
+        config_changed = self._config_changed()
+        if self._executor is None or config_changed:
+            self._start_pool()
+        now = now or datetime.datetime.now()
+        daily_run_time = self._runner.settings.get('daily_run_time', DEFAULT_RUN_TIME)
+        selection, daily = self.due(self._runner.registry, now, daily_run_time)
+        if not selection:
+            return None
+
+        import daily_job
+        logger.info(f"Scheduler daemon: {sum(len(names) for names in selection.values())} rules due on "
+                    f"{len(selection)} tables{' (daily run)' if daily else ''}.")
+        try:
+            return daily_job.main(
+                selection=selection,
+                report=daily,
+                source="daily_job" if daily else "daemon",
+                runner=self._runner,
+                executor=self._executor
+            )
+        finally:
+            # Even a failed run waits for the next slot instead of retrying every tick
+            for table_name, names in selection.items():
+                for name in names:
+                    self._last_run[(table_name, name)] = now
+
+    def run_forever(self):
+        configure_logging()
+        logger.info("=== Scheduler Daemon Started ===")
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.run_due()
+                except Exception as e:
+                    # A crashed worker breaks the pool; it is rebuilt on the next wake-up
+                    logger.error(f"Scheduler daemon run failed: {e}")
+                    self._shutdown_pool()
+                tick = self._runner.settings.get('daemon_tick_seconds', 30) if self._runner else 30
+                self._stop.wait(tick)
+        finally:
+            self._shutdown_pool()
+            logger.info("=== Scheduler Daemon Stopped ===")
+
+    def stop(self):
+        self._stop.set()
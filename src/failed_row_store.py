@@ -0,0 +1,288 @@
+"""
+Delta store for failed rows (settings.failed_rows_format: delta).
+
+Instead of a new CSV of every failing row on every run, each lender gets one
+SQLite file (state/failed_rows/<lender>.db) holding:
+
+    open_failures - the rows currently failing each rule, keyed by the table's
+                    primary_key columns, with the values from when they first failed
+    changes       - per rule run, the rows that started failing ("new") and the
+                    rows that stopped failing ("resolved")
+    rule_runs     - one row per rule per run: new / resolved / persisting counts
+
+A rule's failing rows are streamed into a temporary table, then merged in one
+transaction, so only changes are written and an interrupted export changes
+nothing. Rows are only resolved by a complete result: incremental and sampled
+checks add new failures but never resolve old ones.
+
+History (changes, rule_runs) older than failed_rows_retention_days is dropped,
+and the oldest history goes first while the file is over failed_rows_max_mb.
+The current open failures are always kept.
+"""
+import os
+import json
+import time
+import sqlite3
+import logging
+import datetime
+import threading
+import contextlib
+
+import pandas as pd
+
+logger = logging.getLogger('dq_engine')
+
+DEFAULT_STORE_DIR = os.path.join("state", "failed_rows")
+
+# A lender's store is compacted at most this often per process
+COMPACT_INTERVAL_SECONDS = 3600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS open_failures (
+    table_name     TEXT NOT NULL,
+    rule_name      TEXT NOT NULL,
+    row_key        TEXT NOT NULL,
+    row_json       TEXT,
+    first_seen_run TEXT NOT NULL,
+    first_seen_at  TEXT NOT NULL,
+    PRIMARY KEY (table_name, rule_name, row_key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rule_runs (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id          TEXT NOT NULL,
+    table_name      TEXT NOT NULL,
+    rule_name       TEXT NOT NULL,
+    recorded_at     TEXT NOT NULL,
+    complete        INTEGER NOT NULL,
+    new_rows        INTEGER NOT NULL DEFAULT 0,
+    resolved_rows   INTEGER NOT NULL DEFAULT 0,
+    persisting_rows INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS changes (
+    rule_run_id INTEGER NOT NULL REFERENCES rule_runs(id),
+    row_key     TEXT NOT NULL,
+    change      TEXT NOT NULL,
+    row_json    TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_changes_rule_run ON changes(rule_run_id);
+CREATE INDEX IF NOT EXISTS idx_rule_runs_run ON rule_runs(run_id);
+CREATE INDEX IF NOT EXISTS idx_rule_runs_time ON rule_runs(recorded_at);
+"""
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def row_key(item, primary_keys):
+    """Identity of a failing row: its primary key values, else the whole row."""
+    if isinstance(item, dict) and primary_keys and all(pk in item for pk in primary_keys):
+        return json.dumps([None if item[pk] is None else str(item[pk]) for pk in primary_keys])
+    if isinstance(item, dict):
+        return json.dumps(item, sort_keys=True, default=str)
+    return json.dumps(item, default=str)
+
+
+class FailedRowStore:
+    def __init__(self, store_dir=DEFAULT_STORE_DIR, retention_days=30, max_mb=500):
+        self.store_dir = store_dir
+        self.retention_days = retention_days
+        self.max_mb = max_mb
+        self._initialised = set()
+        self._last_compaction = {}
+        self._lock = threading.Lock()
+
+    def _path(self, lender_id):
+        safe_lender = "".join([c if c.isalnum() or c in "-_" else "_" for c in lender_id])
+        return os.path.join(self.store_dir, f"{safe_lender}.db")
+
+    @contextlib.contextmanager
+    def _connect(self, lender_id):
+        path = self._path(lender_id)
+        # Transactions are managed explicitly (BEGIN IMMEDIATE for the merge)
+        conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with self._lock:
+                if path not in self._initialised:
+                    conn.executescript(_SCHEMA)
+                    self._initialised.add(path)
+            yield conn
+        finally:
+            conn.close()
+
+    def apply(self, run_id, lender_id, table_name, rule_name, primary_keys, item_batches, complete=True):
+        """
+        Records this run's failing rows of one rule as changes against the open failures.
+        complete=False (incremental/sampled results) never resolves rows missing from the batches.
+        Returns (new, resolved, persisting).
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        with self._connect(lender_id) as conn:
+            # Streamed outside the write lock: other units of the lender keep writing meanwhile
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS seen (row_key TEXT PRIMARY KEY, row_json TEXT)")
+            conn.execute("DELETE FROM temp.seen")
+            for batch in item_batches:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO temp.seen (row_key, row_json) VALUES (?, ?)",
+                    [(row_key(item, primary_keys), json.dumps(item, default=str)) for item in batch]
+                )
+            seen_count = conn.execute("SELECT COUNT(*) FROM temp.seen").fetchone()[0]
+
+            rule = (table_name, rule_name)
+            if not seen_count and not conn.execute(
+                "SELECT 1 FROM open_failures WHERE table_name = ? AND rule_name = ? LIMIT 1", rule
+            ).fetchone():
+                # Passing and nothing to resolve: no change to record
+                return 0, 0, 0
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = _now()
+                rule_run_id = conn.execute(
+                    """INSERT INTO rule_runs (run_id, table_name, rule_name, recorded_at, complete)
+                       VALUES (?, ?, ?, ?, ?)""",
+                    (run_id, table_name, rule_name, now, int(complete))
+                ).lastrowid
+
+                new_rows = conn.execute(
+                    """INSERT INTO changes (rule_run_id, row_key, change, row_json)
+                       SELECT ?, s.row_key, 'new', s.row_json FROM temp.seen s
+                       WHERE NOT EXISTS (SELECT 1 FROM open_failures o
+                                         WHERE o.table_name = ? AND o.rule_name = ? AND o.row_key = s.row_key)""",
+                    (rule_run_id, *rule)
+                ).rowcount
+                conn.execute(
+                    """INSERT OR IGNORE INTO open_failures
+                       (table_name, rule_name, row_key, row_json, first_seen_run, first_seen_at)
+                       SELECT ?, ?, row_key, row_json, ?, ? FROM temp.seen""",
+                    (*rule, run_id, now)
+                )
+
+                resolved_rows = 0
+                if complete:
+                    resolved_rows = conn.execute(
+                        """INSERT INTO changes (rule_run_id, row_key, change, row_json)
+                           SELECT ?, o.row_key, 'resolved', o.row_json FROM open_failures o
+                           WHERE o.table_name = ? AND o.rule_name = ?
+                             AND o.row_key NOT IN (SELECT row_key FROM temp.seen)""",
+                        (rule_run_id, *rule)
+                    ).rowcount
+                    conn.execute(
+                        """DELETE FROM open_failures WHERE table_name = ? AND rule_name = ?
+                           AND row_key NOT IN (SELECT row_key FROM temp.seen)""",
+                        rule
+                    )
+
+                persisting_rows = seen_count - new_rows
+                conn.execute(
+                    "UPDATE rule_runs SET new_rows = ?, resolved_rows = ?, persisting_rows = ? WHERE id = ?",
+                    (new_rows, resolved_rows, persisting_rows, rule_run_id)
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.execute("DROP TABLE IF EXISTS temp.seen")
+
+        logger.info(f"[{lender_id}] [{table_name}] {rule_name}: {new_rows} new, {resolved_rows} resolved, "
+                    f"{persisting_rows} persisting failed rows.")
+        return new_rows, resolved_rows, persisting_rows
+
+    def maybe_compact(self, lender_id):
+        """Compacts the lender's store if it hasn't been in the last COMPACT_INTERVAL_SECONDS."""
+        with self._lock:
+            last = self._last_compaction.get(lender_id)
+            if last is not None and time.monotonic() - last < COMPACT_INTERVAL_SECONDS:
+                return
+            self._last_compaction[lender_id] = time.monotonic()
+        if os.path.exists(self._path(lender_id)):
+            try:
+                self.compact(lender_id)
+            except Exception as e:
+                logger.warning(f"[{lender_id}] Could not compact the failed-row store: {e}")
+
+    def compact(self, lender_id):
+        """
+        Drops history older than retention_days, then the oldest history while the
+        file is over max_mb. Returns the number of rule runs removed.
+        """
+        removed = 0
+        with self._connect(lender_id) as conn:
+            if self.retention_days:
+                cutoff = (datetime.datetime.now() - datetime.timedelta(days=self.retention_days)).isoformat(timespec="seconds")
+                removed += self._drop_history(conn, "recorded_at < ?", (cutoff,))
+
+            budget = self.max_mb * 1048576 if self.max_mb else None
+            while budget and self._used_bytes(conn) > budget:
+                # Oldest tenth of the remaining history at a time
+                oldest = conn.execute(
+                    "SELECT id FROM rule_runs ORDER BY id LIMIT 1 OFFSET (SELECT COUNT(*) / 10 FROM rule_runs)"
+                ).fetchone()
+                if oldest is None:
+                    break
+                dropped = self._drop_history(conn, "id <= ?", (oldest[0],))
+                if not dropped:
+                    break
+                removed += dropped
+
+            if removed:
+                conn.execute("VACUUM")
+                logger.info(f"[{lender_id}] Compacted the failed-row store: dropped {removed} rule runs of history.")
+        return removed
+
+    def _drop_history(self, conn, condition, params):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"DELETE FROM changes WHERE rule_run_id IN (SELECT id FROM rule_runs WHERE {condition})", params)
+            removed = conn.execute(f"DELETE FROM rule_runs WHERE {condition}", params).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return removed
+
+    def _used_bytes(self, conn):
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return pages * page_size
+
+    def _read(self, lender_id, query, params=()):
+        if not os.path.exists(self._path(lender_id)):
+            return pd.DataFrame()
+        with self._connect(lender_id) as conn:
+            return pd.read_sql_query(query, conn, params=params)
+
+    def open_failures(self, lender_id, table_name=None, rule_name=None):
+        """Rows currently failing, with the row as it was when it first failed."""
+        query = "SELECT table_name, rule_name, row_key, row_json, first_seen_run, first_seen_at FROM open_failures WHERE 1 = 1"
+        params = []
+        if table_name:
+            query += " AND table_name = ?"
+            params.append(table_name)
+        if rule_name:
+            query += " AND rule_name = ?"
+            params.append(rule_name)
+        return self._read(lender_id, query, params)
+
+    def run_changes(self, lender_id, run_id):
+        """Rows that started or stopped failing in a run."""
+        return self._read(
+            lender_id,
+            """SELECT r.table_name, r.rule_name, c.change, c.row_key, c.row_json, r.recorded_at
+               FROM changes c JOIN rule_runs r ON r.id = c.rule_run_id
+               WHERE r.run_id = ? ORDER BY r.table_name, r.rule_name, c.change""",
+            [run_id]
+        )
+
+    def run_summary(self, lender_id, run_id):
+        """new/resolved/persisting counts per rule for a run."""
+        return self._read(
+            lender_id,
+            """SELECT table_name, rule_name, SUM(new_rows) AS new_rows, SUM(resolved_rows) AS resolved_rows,
+                      MAX(persisting_rows) AS persisting_rows
+               FROM rule_runs WHERE run_id = ? GROUP BY table_name, rule_name
+               ORDER BY table_name, rule_name""",
+            [run_id]
+        )
@@ -1,155 +1,1044 @@
-import great_expectations as gx
 import toml
-import yaml
 import pandas as pd
 import logging
-import logging.config
 import os
 import warnings
 import sqlalchemy
 import datetime
+import csv
+import re
+import copy
+import threading
+import time
+import functools
+import importlib
+import contextlib
+import concurrent.futures
 from urllib.parse import quote_plus
+from src import parquet_export
+from src import rule_registry
+from src import rule_schedule
+from src import sampling
+from src import sql_fusion
+from src import sql_rewrite
+from src.failed_row_store import FailedRowStore, DEFAULT_STORE_DIR as FAILED_ROW_STORE_DIR
+from src.profiling import Profiler, PROFILE_ROOT
+from src.result_cache import ResultCache
+from src.watermarks import WatermarkStore
 
-# Ensure logs dir exists
-if not os.path.exists('logs'):
-    os.makedirs('logs')
-
-logging.config.fileConfig('config/logging.conf')
+# Logging is configured by the entry point (src/logging_setup.py), not on import
 logger = logging.getLogger('dq_engine')
 
+# MySQL: 3024 = max_execution_time exceeded, 1317 = interrupted by KILL QUERY
+_TIMEOUT_CODES = (3024, 1317)
+# The same codes in an error's text, as pymysql/mysqlclient "(3024, '...')" or
+# mysql-connector "3024 (HY000): ..."
+_TIMEOUT_MESSAGE = re.compile(r"\((?:3024|1317),\s|(?:^|\)\s)(?:3024|1317) \(\w+\):")
+
+
+def _mysql_error_code(error):
+    """The driver's numeric error code of a (SQLAlchemy-wrapped) DBAPI error, or None."""
+    orig = getattr(error, 'orig', error)
+    return getattr(orig, 'errno', None) or next(iter(getattr(orig, 'args', None) or ()), None)
+
+
+def is_timeout_error(error):
+    """
+    True if the server stopped a statement for running too long. GX only reports an
+    error's text; then the driver's message is checked, never the SQL that follows it.
+    SQLite interrupts are recognised by the watchdog that fired them, not here.
+    """
+    if isinstance(error, str):
+        return bool(_TIMEOUT_MESSAGE.search(error.split("[SQL:", 1)[0]))
+    return _mysql_error_code(error) in _TIMEOUT_CODES
+
+
+def is_duplicate_column_error(error):
+    """True if MySQL rejected a derived table for repeating a column name (error 1060)."""
+    return _mysql_error_code(getattr(error, 'orig', None)) == 1060
+
+
+class QueryTimeout(Exception):
+    """A statement was stopped for exceeding its time limit, or the lender's budget ran out."""
+
+
 class GXRunner:
-    def __init__(self, secrets_path="secrets.toml", rules_path="config/gx_rules.yaml"):
+    def __init__(self, secrets_path="secrets.toml", rules_path="config/gx_rules.yaml", count_first=None,
+                 persistent_engines=False, run_id=None, cache_table_counts=False, cache_results=False):
         self.secrets = toml.load(secrets_path)['lenders']
-        with open(rules_path, 'r') as f:
-            self.rules = yaml.safe_load(f)
+
+        # Rules are parsed, validated and cached once per version of the YAML
+        # (see src/rule_registry.py); a bad config fails here, before any connection
+        self.registry = rule_registry.load(rules_path)
+        self.rules = self.registry.raw
+        self.registry.resolve_lenders(self.secrets)
+
+        # Optional runner settings live next to the rules in the YAML
+        self.settings = self.registry.settings
+        
+        # Count-first: run SQL checks as a server-side COUNT(*) and only pull
+        # row detail (for the CSV) when a check actually fails
+        if count_first is None:
+            count_first = self.settings.get('count_first', False)
+        self.count_first = bool(count_first)
+
+        # Count compatible SQL checks of a table in one shared scan
+        self.fuse_checks = bool(self.settings.get('fuse_checks', False))
+
+        # Incremental mode: tables with a watermark_column only validate rows past
+        # the last validated high-water mark, with a periodic full scan
+        self.incremental = bool(self.settings.get('incremental', False))
+        self.watermarks = WatermarkStore(self.settings.get('watermark_state_dir', os.path.join("state", "watermarks")))
+
+        # "gx" runs rules through a GX checkpoint; "direct" runs SQL rules straight
+        # through SQLAlchemy and never imports great_expectations
+        self.check_engine = self.settings.get('check_engine', 'gx')
+
+        # One pooled engine per lender, shared by GX, row counts and CSV re-fetches.
+        # Long-lived callers (dashboard, daemons) can keep them between runs.
+        self.persistent_engines = persistent_engines
+        self._engines = {}
+        # Concurrent runs (dashboard jobs) must not each create a lender's engine
+        self._engines_lock = threading.Lock()
+        # Engine -> its lender's sql_shim rewrite(sql), see _register_sql_shim
+        self._query_rewriters = {}
+
+        # Row counts, sizes and update times of each lender's tables, fetched in one
+        # round trip (see table_metadata) and kept for the run. Workers that run one
+        # run's tables piecemeal (see src/work_scheduler.py) keep them for their lifetime.
+        self._table_metadata = {}
+        self.keep_table_metadata = cache_table_counts
+        self._metadata_lock = threading.Lock()
+
+        # Long-lived callers (the dashboard) answer re-runs of unchanged tables from
+        # memory; see src/result_cache.py and _table_fingerprints
+        self.result_cache = None
+        if cache_results:
+            self.result_cache = ResultCache(
+                max_entries=int(self.settings.get('result_cache_max_entries', 500)),
+                ttl_seconds=self.settings.get('result_cache_ttl_seconds', 3600)
+            )
+            # Tables with rules that read the clock are re-checked at least this often
+            self.result_cache_clock_seconds = int(self.settings.get('result_cache_clock_seconds', 900))
+
+        # GX contexts are not thread-safe; concurrent table runs take turns on them
+        self._gx_lock = threading.Lock()
+
+        # Time limits: per statement (settings.query_timeout_seconds, or a rule's
+        # timeout_seconds) and per lender run (lender_time_budget_seconds).
+        # _deadlines holds each running lender's monotonic deadline; _inflight the
+        # kill callbacks of its running statements, so cancel() can stop them.
+        # A lender's deadline is dropped when the last of its concurrent runs ends.
+        self._deadlines = {}
+        self._active_runs = {}
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+        # Groups the failed-row files of one run (Parquet partitions and manifest)
+        self.run_id = run_id or datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        self.failed_rows_format = self.settings.get('failed_rows_format', 'csv')
+        if self.failed_rows_format == "parquet" and not parquet_export.parquet_available():
+            logger.warning("failed_rows_format is 'parquet' but pyarrow is not installed. Falling back to CSV.")
+            self.failed_rows_format = "csv"
+        self.failed_row_store = None
+        if self.failed_rows_format == "delta":
+            self.failed_row_store = FailedRowStore(
+                self.settings.get('failed_rows_store_dir', FAILED_ROW_STORE_DIR),
+                retention_days=self.settings.get('failed_rows_retention_days', 30),
+                max_mb=self.settings.get('failed_rows_max_mb', 500)
+            )
+
+        # Per-phase timings as JSON lines under logs/profile/run=<run_id>/
+        self.profiler = Profiler(
+            self.run_id,
+            root=self.settings.get('profile_dir', PROFILE_ROOT),
+            enabled=bool(self.settings.get('profiling', True))
+        )
 
     def _build_connection_string(self, creds):
+        # A full SQLAlchemy URL (e.g. a local MariaDB or SQLite stand-in) replaces the MySQL fields
+        if creds.get('url'):
+            return creds['url']
         safe_user = quote_plus(creds['user'])
         safe_password = quote_plus(creds['password'])
         return f"mysql+mysqlconnector://{safe_user}:{safe_password}@{creds['host']}:{creds.get('port', 3306)}/{creds['db']}"
 
-    def _get_table_count(self, creds, table_name):
+    def lender_host(self, lender_id):
+        """The database host a lender runs on, for per-host limits (the lender itself if unknown)."""
+        creds = self.secrets[lender_id]
+        if creds.get('url'):
+            return sqlalchemy.engine.make_url(creds['url']).host or lender_id
+        return creds.get('host', lender_id)
+
+    def check_connection(self, lender_id, timeout=None):
+        """
+        Connectivity gate: None if the lender's database answers SELECT 1 within
+        `timeout` seconds (settings.connectivity_timeout_seconds), else the reason.
+        A probe that hangs is abandoned rather than waited for.
+        """
+        timeout = float(timeout or self.settings.get('connectivity_timeout_seconds', 30))
+
+        def _probe():
+            with self._get_engine(lender_id).connect() as conn:
+                conn.execute(sqlalchemy.text("SELECT 1"))
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            executor.submit(_probe).result(timeout=timeout)
+            return None
+        except concurrent.futures.TimeoutError:
+            return f"No answer from the database within {timeout:g}s"
+        except Exception as e:
+            return str(e)
+        finally:
+            executor.shutdown(wait=False)
+
+    def _get_engine(self, lender_id):
+        """Returns the lender's pooled engine, creating it on first use."""
+        engine = self._engines.get(lender_id)
+        if engine is not None:
+            return engine
+        with self._engines_lock:
+            engine = self._engines.get(lender_id)
+            if engine is None:
+                creds = self.secrets[lender_id]
+                engine = sqlalchemy.create_engine(
+                    self._build_connection_string(creds),
+                    # Never fewer pooled connections than queries allowed in flight
+                    pool_size=max(self.settings.get('pool_size', 5), self._max_concurrent_queries(lender_id)),
+                    max_overflow=self.settings.get('pool_max_overflow', 5),
+                    pool_recycle=self.settings.get('pool_recycle_seconds', 3600),
+                    pool_pre_ping=True
+                )
+                self._register_session_setup(engine)
+                self._register_sql_shim(engine, creds.get('sql_shim'))
+                self._engines[lender_id] = engine
+            return engine
+
+    def _register_sql_shim(self, engine, module_name):
+        """
+        A lender's `sql_shim` (secrets.toml) names a module that adapts the MySQL rules to
+        another database, e.g. benchmarks.sqlite_shim. Its optional on_connect(dbapi_conn)
+        runs on every new connection and rewrite(sql) on every statement of this engine.
+        _run_gx_table attaches the same rewrite to the GX execution engine.
+        """
+        if not module_name:
+            return
+        shim = importlib.import_module(module_name)
+        if hasattr(shim, "on_connect"):
+            sqlalchemy.event.listen(engine, "connect", lambda dbapi_conn, connection_record: shim.on_connect(dbapi_conn))
+        if hasattr(shim, "rewrite"):
+            self._query_rewriters[engine] = shim.rewrite
+            self._listen_rewrite(engine, shim.rewrite)
+
+    def _listen_rewrite(self, engine, rewrite):
+        @sqlalchemy.event.listens_for(engine, "before_cursor_execute", retval=True)
+        def _rewrite(conn, cursor, statement, parameters, context, executemany):
+            return rewrite(statement), parameters
+
+    def _register_session_setup(self, engine):
+        """
+        Every new MySQL connection gets settings.query_timeout_seconds as its server-side
+        max_execution_time (this also bounds GX queries, which borrow these connections)
+        and remembers its CONNECTION_ID() so a runaway query can be killed.
+        """
+        if engine.dialect.name != "mysql":
+            return
+        default_ms = int(float(self.settings.get('query_timeout_seconds') or 0) * 1000)
+
+        @sqlalchemy.event.listens_for(engine, "connect")
+        def _on_connect(dbapi_conn, connection_record):
+            cursor = dbapi_conn.cursor()
+            try:
+                cursor.execute(f"SET SESSION max_execution_time = {default_ms}")
+                cursor.execute("SELECT CONNECTION_ID()")
+                connection_record.info['connection_id'] = cursor.fetchall()[0][0]
+            finally:
+                cursor.close()
+
+    def lender_time_budget(self, lender_id):
+        """Per-lender budget from secrets.toml, falling back to settings. None = unlimited."""
+        creds = self.secrets.get(lender_id, {})
+        budget = creds.get('time_budget_seconds', self.settings.get('lender_time_budget_seconds'))
+        return float(budget) if budget else None
+
+    def _query_timeout(self, lender_id, exp_config=None):
+        """
+        Seconds a statement may still run: the rule's timeout_seconds or
+        settings.query_timeout_seconds, capped by what is left of the lender's budget.
+        None means unlimited; zero or less means the budget is already spent.
+        """
+        timeout = self.settings.get('query_timeout_seconds') or None
+        if exp_config and exp_config.get('timeout_seconds'):
+            timeout = exp_config['timeout_seconds']
+        deadline = self._deadlines.get(lender_id)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            timeout = remaining if timeout is None else min(float(timeout), remaining)
+        return float(timeout) if timeout is not None else None
+
+    def _timeout_hint(self, engine, query, timeout):
+        """Adds MySQL's MAX_EXECUTION_TIME optimizer hint to a SELECT statement."""
+        if timeout is None or engine.dialect.name != "mysql":
+            return query
+        return re.sub(
+            r"^\s*SELECT\b", f"SELECT /*+ MAX_EXECUTION_TIME({max(1, int(timeout * 1000))}) */", query,
+            count=1, flags=re.IGNORECASE
+        )
+
+    def _query_killer(self, engine, proxied_conn):
+        """A callable that stops the statement running on a pooled connection, if the dialect allows it."""
+        if engine.dialect.name == "mysql":
+            connection_id = proxied_conn.info.get('connection_id')
+            if connection_id is None:
+                return None
+
+            def _kill():
+                with engine.connect() as kill_conn:
+                    kill_conn.exec_driver_sql(f"KILL QUERY {int(connection_id)}")
+            return _kill
+        if engine.dialect.name == "sqlite":
+            return proxied_conn.driver_connection.interrupt
+        return None
+
+    @contextlib.contextmanager
+    def _watchdog(self, engine, proxied_conn, lender_id, timeout):
+        """
+        Runner-side enforcement of a statement time limit: if the block is still running
+        settings.kill_grace_seconds after `timeout`, its query is killed (KILL QUERY on
+        MySQL). Raises QueryTimeout when a statement was stopped for running too long,
+        whether by the server or by the runner, or when no time is left at all.
+        """
+        if timeout is None:
+            yield
+            return
+        if timeout <= 0:
+            raise QueryTimeout("Skipped: lender time budget exhausted or run cancelled")
+
+        fired = threading.Event()
+        killer = self._query_killer(engine, proxied_conn)
+
+        def _kill():
+            fired.set()
+            try:
+                killer()
+            except Exception as e:
+                logger.error(f"[{lender_id}] Could not kill a runaway query: {e}")
+
+        timer = None
+        if killer:
+            timer = threading.Timer(timeout + float(self.settings.get('kill_grace_seconds', 5)), _kill)
+            timer.daemon = True
+            timer.start()
+            with self._inflight_lock:
+                self._inflight.setdefault(lender_id, set()).add(_kill)
+        try:
+            yield
+        except Exception as e:
+            if fired.is_set() or is_timeout_error(e):
+                raise QueryTimeout(f"Query stopped after exceeding its time limit ({timeout:.1f}s)") from e
+            raise
+        finally:
+            if timer:
+                timer.cancel()
+                with self._inflight_lock:
+                    self._inflight.get(lender_id, set()).discard(_kill)
+
+    def cancel(self, lender_id=None):
+        """
+        Stops a running validation: checks that have not started yet are reported as
+        TIMEOUT and statements in flight are killed. GX checkpoints already running
+        finish on their own (bounded by the server-side statement timeout).
+        """
+        lender_ids = [lender_id] if lender_id else list(self._deadlines.keys())
+        for lid in lender_ids:
+            self._deadlines[lid] = time.monotonic()
+            with self._inflight_lock:
+                killers = list(self._inflight.get(lid, ()))
+            logger.warning(f"[{lid}] Cancelling run ({len(killers)} queries in flight).")
+            for kill in killers:
+                kill()
+
+    def dispose_engines(self, lender_id=None):
+        """Closes pooled connections for one lender, or for all of them."""
+        lender_ids = [lender_id] if lender_id else list(self._engines.keys())
+        for lid in lender_ids:
+            with self._engines_lock:
+                engine = self._engines.pop(lid, None)
+            if engine is not None:
+                self._query_rewriters.pop(engine, None)
+                engine.dispose()
+
+    def _gx_engine_kwargs(self, engine):
+        """
+        create_engine kwargs for the GX datasource so it borrows connections from
+        the lender's shared pool instead of opening its own.
+        """
+        gx_kwargs = {"creator": engine.raw_connection}
+        if engine.dialect.name == "mysql":
+            # Hand every connection straight back to the shared pool after use
+            gx_kwargs["poolclass"] = sqlalchemy.pool.NullPool
+        return gx_kwargs
+
+    def table_metadata(self, lender_id, tables=None, engine=None, row_count_mode=None):
+        """
+        {table: {"row_count", "row_count_estimated", "data_bytes", "index_bytes", "update_time"}}
+        for the given tables (default: every configured table). Tables not fetched yet in
+        this run are fetched together, on one connection; unknown values are None.
+        settings.row_count_mode "estimate" takes row counts from information_schema
+        (MySQL InnoDB estimates) instead of scanning with COUNT(*).
+        """
+        tables = list(tables) if tables is not None else list(self.registry.tables)
+        mode = row_count_mode or self.settings.get('row_count_mode', 'exact')
+        with self._metadata_lock:
+            known = self._table_metadata.setdefault((lender_id, mode), {})
+            missing = [t for t in tables if t not in known]
+            if missing:
+                known.update(self._fetch_table_metadata(engine or self._get_engine(lender_id), lender_id, missing, mode))
+            return {t: known[t] for t in tables}
+
+    def _fetch_table_metadata(self, engine, lender_id, tables, mode):
+        metadata = {
+            t: {"row_count": None, "row_count_estimated": False, "data_bytes": None, "index_bytes": None,
+                "update_time": None}
+            for t in tables
+        }
+        timeout = self._query_timeout(lender_id)
+        with self.profiler.phase("metadata", lender_id) as timing:
+            if engine.dialect.name == "mysql":
+                query = sqlalchemy.text(
+                    "SELECT TABLE_NAME, TABLE_ROWS, DATA_LENGTH, INDEX_LENGTH, UPDATE_TIME FROM information_schema.TABLES "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN :names"
+                ).bindparams(sqlalchemy.bindparam('names', expanding=True))
+                try:
+                    with engine.connect() as conn, self._watchdog(engine, conn.connection, lender_id, timeout):
+                        for name, table_rows, data_bytes, index_bytes, update_time in conn.execute(query, {"names": tables}):
+                            if name not in metadata:
+                                continue
+                            metadata[name].update(data_bytes=data_bytes, index_bytes=index_bytes, update_time=update_time)
+                            # Views have no TABLE_ROWS; they are counted below
+                            if mode == "estimate" and table_rows is not None:
+                                metadata[name].update(row_count=int(table_rows), row_count_estimated=True)
+                except Exception as e:
+                    logger.warning(f"[{lender_id}] Could not read table metadata from information_schema: {e}")
+
+            # Exact counts (or estimates that were unavailable): every table in one statement
+            to_count = [t for t in tables if metadata[t]['row_count'] is None]
+            if to_count:
+                for table_name, count in self._count_rows(engine, lender_id, to_count, timeout).items():
+                    metadata[table_name]['row_count'] = count
+            timing['rows'] = sum(m['row_count'] or 0 for m in metadata.values())
+        return metadata
+
+    def _count_rows(self, engine, lender_id, tables, timeout):
+        """Exact COUNT(*) of several tables as one UNION ALL; table by table if that fails."""
+        query = "\nUNION ALL\n".join(
+            f"SELECT {sql_rewrite.sql_literal(t)} AS table_name, COUNT(*) AS row_count FROM {t}" for t in tables
+        )
         try:
-            conn_str = self._build_connection_string(creds)
-            engine = sqlalchemy.create_engine(conn_str)
-            with engine.connect() as conn:
-                query = sqlalchemy.text(f"SELECT COUNT(*) FROM {table_name}")
-                result = conn.execute(query).scalar()
-                return int(result)
+            with engine.connect() as conn, self._watchdog(engine, conn.connection, lender_id, timeout):
+                return {name: int(count) for name, count in conn.execute(sqlalchemy.text(query))}
+        except QueryTimeout as e:
+            logger.warning(f"[{lender_id}] Row counts timed out: {e}")
+            return {}
         except Exception as e:
-            logger.warning(f"Could not fetch row count for {table_name}: {e}")
-            return 0 
+            if len(tables) == 1:
+                logger.warning(f"Could not fetch row count for {tables[0]}: {e}")
+                return {}
+        # One missing or broken table must not cost the others their counts
+        counts = {}
+        for table_name in tables:
+            counts.update(self._count_rows(engine, lender_id, [table_name], timeout))
+        return counts
+
+    def _reset_table_metadata(self, lender_id):
+        """Every run sees fresh row counts, except in workers that keep them for their lifetime."""
+        if self.keep_table_metadata:
+            return
+        with self._metadata_lock:
+            for key in [key for key in self._table_metadata if key[0] == lender_id]:
+                del self._table_metadata[key]
+
+    def _get_table_count(self, engine, lender_id, table_name):
+        """Row count from the run's table metadata; None if it could not be fetched."""
+        return self.table_metadata(lender_id, [table_name], engine)[table_name]['row_count']
+
+    def _prepare_query(self, query, table_name):
+        """
+        Makes a YAML unexpected_rows_query safe to embed in another statement:
+        drops the trailing semicolon and resolves GX's optional {batch} placeholder.
+        """
+        query = query.strip().rstrip(';').strip()
+        return query.replace("{batch}", table_name)
+
+    def _count_query(self, query, table_name):
+        """Wraps an unexpected_rows_query so the server only returns the number of offending rows."""
+        return f"SELECT COUNT(*) FROM (\n{self._prepare_query(query, table_name)}\n) AS dq_unexpected"
+
+    def _rule_query(self, exp_config, table_name, restriction=None):
+        """
+        The SQL a count-first rule runs. With an incremental restriction the rule's
+        main table is narrowed to new rows when that is safe (see src/sql_rewrite.py);
+        rules can opt out with `incremental: false`.
+        Returns (query, is_incremental).
+        """
+        query = exp_config.get('sql') or self._prepare_query(exp_config['kwargs']['unexpected_rows_query'], table_name)
+        if restriction and exp_config.get('incremental', True):
+            restricted = sql_rewrite.restrict_table(query, table_name, restriction)
+            if restricted:
+                return restricted, True
+        return query, False
+
+    def _run_count_check(self, engine, lender_id, table_name, exp_config, primary_keys, table_count, restriction=None):
+        """
+        Count-first execution of an unexpected_rows_expectation.
+        Only the COUNT(*) travels over the wire; failing rows are fetched for the CSV
+        only when the count is non-zero.
+        """
+        meta = exp_config.get('meta', {})
+        display_name = exp_config.get('name') or "Custom SQL Check"
+        query, _ = self._rule_query(exp_config, table_name, restriction)
+        timeout = self._query_timeout(lender_id, exp_config)
+
+        try:
+            unexpected_count = self._count_unexpected(engine, lender_id, table_name, display_name, query, timeout)
+        except QueryTimeout as e:
+            return self._build_result_row(lender_id, table_name, display_name, meta, "TIMEOUT", 0, table_count, str(e))
+        except Exception as e:
+            return self._build_result_row(lender_id, table_name, display_name, meta, "ERROR", 0, table_count, str(e)[:2000])
+
+        return self._finish_count_check(
+            engine, lender_id, table_name, exp_config, primary_keys, table_count, unexpected_count, restriction
+        )
+
+    def _count_unexpected(self, engine, lender_id, table_name, display_name, query, timeout):
+        """Server-side count of the rows a rule query returns."""
+        with self.profiler.phase("query", lender_id, table_name, display_name) as timing, engine.connect() as conn, \
+                self._watchdog(engine, conn.connection, lender_id, timeout):
+            try:
+                count_query = self._timeout_hint(engine, self._count_query(query, table_name), timeout)
+                unexpected_count = int(conn.execute(sqlalchemy.text(count_query)).scalar() or 0)
+            except Exception as count_err:
+                # A derived table must have unique column names (MySQL 1060);
+                # such queries are counted client-side instead
+                if not is_duplicate_column_error(count_err):
+                    raise
+                conn.rollback()
+                result = conn.execute(sqlalchemy.text(self._timeout_hint(engine, query, timeout)))
+                unexpected_count = sum(1 for _ in result)
+            timing['rows'] = unexpected_count
+        return unexpected_count
+
+    def _run_sampled_check(self, engine, lender_id, table_name, exp_config, primary_keys, table_count, restriction=None):
+        """
+        A `mode: sample` rule in a sampled run: the rule's main table is narrowed to a
+        key-hash sample (see src/sampling.py) and the failure count is scaled up to the
+        table, with confidence bounds. Falls back to a full count when the rule or the
+        database can't be sampled.
+        """
+        meta = exp_config.get('meta', {})
+        display_name = exp_config.get('name') or "Custom SQL Check"
+        if not exp_config.get('incremental', True):
+            restriction = None
+
+        fraction = sampling.sample_fraction(exp_config, table_count, self.settings)
+        predicate = sampling.sample_predicate(engine.dialect.name, primary_keys, fraction) if fraction else None
+        query = None
+        if predicate:
+            scope = f"({restriction}) AND ({predicate})" if restriction else predicate
+            query = sql_rewrite.restrict_table(exp_config['sql'], table_name, scope)
+        if query is None:
+            reason = "no sampling needed" if not fraction else "rule or database can't be sampled"
+            logger.info(f"[{lender_id}] [{table_name}] {display_name}: full check ({reason}).")
+            return self._run_count_check(engine, lender_id, table_name, exp_config, primary_keys, table_count, restriction)
+
+        timeout = self._query_timeout(lender_id, exp_config)
+        try:
+            # Rows in scope and rows in the sample, from one pass over the main table
+            size_query = (
+                f"SELECT COUNT(*), COALESCE(SUM(CASE WHEN {predicate} THEN 1 ELSE 0 END), 0) FROM {table_name}"
+                + (f" WHERE {restriction}" if restriction else "")
+            )
+            with self.profiler.phase("sample_size", lender_id, table_name, display_name), engine.connect() as conn, \
+                    self._watchdog(engine, conn.connection, lender_id, timeout):
+                population, sample_size = conn.execute(sqlalchemy.text(self._timeout_hint(engine, size_query, timeout))).one()
+            sampled_failures = self._count_unexpected(engine, lender_id, table_name, display_name, query, timeout)
+        except QueryTimeout as e:
+            return self._build_result_row(lender_id, table_name, display_name, meta, "TIMEOUT", 0, table_count, str(e))
+        except Exception as e:
+            return self._build_result_row(lender_id, table_name, display_name, meta, "ERROR", 0, table_count, str(e)[:2000])
+
+        population, sample_size = int(population), int(sample_size or 0)
+        confidence = float(self.settings.get('sample_confidence', 0.95))
+        estimate, low, high = sampling.estimate_failures(sampled_failures, sample_size, population, confidence)
+        share = f"{sample_size / population:.1%}" if population else "0%"
+        if sampled_failures:
+            status = "FAIL"
+            error_msg = (f"Estimated {estimate} data failures ({confidence:.0%} CI {low}-{high}) "
+                         f"from a {share} sample: {sampled_failures} in {sample_size} sampled rows")
+        else:
+            status = "PASS"
+            error_msg = f"No failures in a {share} sample of {sample_size} rows ({confidence:.0%} upper bound: {high})"
+        if restriction:
+            error_msg += " (incremental: new/changed rows only)"
+
+        row = self._build_result_row(lender_id, table_name, display_name, meta, status, estimate, table_count, error_msg)
+        row.update(failed_rows_low=low, failed_rows_high=high,
+                   sample_fraction=round(sample_size / population, 6) if population else None)
+        if sampled_failures:
+            description = f"{meta.get('description', 'Pass Expectation')} (sampled rows only)"
+            self._export_query_failures(
+                lender_id, table_name, display_name, query, primary_keys, description, engine, complete=False
+            )
+        return row
+
+    def _finish_count_check(self, engine, lender_id, table_name, exp_config, primary_keys, table_count, unexpected_count,
+                            restriction=None):
+        """Turns a server-side count into a result row, downloading the failing rows if there are any."""
+        meta = exp_config.get('meta', {})
+        display_name = exp_config.get('name') or "Custom SQL Check"
+        query, is_incremental = self._rule_query(exp_config, table_name, restriction)
+
+        if unexpected_count == 0:
+            if not is_incremental:
+                self._clear_failed_rows(lender_id, table_name, display_name)
+            return self._build_result_row(lender_id, table_name, display_name, meta, "PASS", 0, table_count, "")
+
+        error_msg = f"Found {unexpected_count} data failures"
+        if is_incremental:
+            error_msg += " (incremental: new/changed rows only)"
+        row = self._build_result_row(
+            lender_id, table_name, display_name, meta, "FAIL", unexpected_count, table_count, error_msg
+        )
+        description = meta.get('description', 'Pass Expectation')
+        self._export_query_failures(
+            lender_id, table_name, display_name, query, primary_keys, description, engine, complete=not is_incremental
+        )
+        return row
+
+    def _group_fusable_checks(self, table_name, sql_rules, restriction=None):
+        """
+        Splits a table's count-first rules into groups that can share one scan
+        (see src/sql_fusion.py) and rules that must run on their own.
+        Incremental rules only share a scan with other incremental rules.
+        """
+        groups = {}
+        singles = []
+        for exp_config in sql_rules:
+            # Parsed once when the registry was compiled; copied because 'where' is per run
+            parsed = dict(exp_config['fusion']) if exp_config.get('fusion') else None
+            if parsed is None:
+                singles.append(exp_config)
+                continue
+            _, is_incremental = self._rule_query(exp_config, table_name, restriction)
+            parsed['where'] = restriction if is_incremental else None
+            groups.setdefault((sql_fusion.fusion_key(parsed), is_incremental), []).append((exp_config, parsed))
+
+        fused = []
+        for group in groups.values():
+            if len(group) == 1:
+                singles.append(group[0][0])
+            else:
+                fused.append(group)
+        return fused, singles
+
+    def _run_fused_checks(self, engine, lender_id, table_name, group, primary_keys, table_count, restriction=None):
+        """
+        Counts every rule of a fusable group in a single table scan, then reports them one by one.
+        If the fused statement fails (e.g. one rule has a typo) each rule runs on its own,
+        so the error is attributed to the right rule.
+        """
+        first = group[0][1]
+        fused_query = sql_fusion.build_fused_count_query(
+            first['table'], first['alias'], [parsed['condition'] for _, parsed in group], where=first['where']
+        )
+        rule_names = "+".join(exp_config.get('name') or "Custom SQL Check" for exp_config, _ in group)
+        # The shared scan gets the most generous limit of its rules
+        timeouts = [self._query_timeout(lender_id, exp_config) for exp_config, _ in group]
+        timeout = None if None in timeouts else max(timeouts)
+        try:
+            with self.profiler.phase("fused_query", lender_id, table_name, rule_names) as timing, engine.connect() as conn, \
+                    self._watchdog(engine, conn.connection, lender_id, timeout):
+                counts = conn.execute(sqlalchemy.text(self._timeout_hint(engine, fused_query, timeout))).fetchone()
+                timing['rows'] = sum(int(count or 0) for count in counts)
+        except QueryTimeout as e:
+            # The rules scan the same table, so running them one by one would not be faster
+            return [
+                self._build_result_row(
+                    lender_id, table_name, exp_config.get('name') or "Custom SQL Check", exp_config.get('meta', {}),
+                    "TIMEOUT", 0, table_count, str(e)
+                )
+                for exp_config, _ in group
+            ]
+        except Exception as e:
+            logger.warning(f"[{lender_id}] [{table_name}] Fused scan of {len(group)} checks failed, running them one by one: {e}")
+            return [
+                self._run_count_check(engine, lender_id, table_name, exp_config, primary_keys, table_count, restriction)
+                for exp_config, _ in group
+            ]
+
+        logger.info(f"[{lender_id}] [{table_name}] Counted {len(group)} checks in one scan.")
+        return [
+            self._finish_count_check(
+                engine, lender_id, table_name, exp_config, primary_keys, table_count, int(count or 0), restriction
+            )
+            for (exp_config, _), count in zip(group, counts)
+        ]
+
+    def _build_result_row(self, lender_id, table_name, display_name, meta, status, unexpected_count, element_count, error_msg):
+        severity = meta.get('severity', 'warning')
+        
+        # --- Detailed Logging ---
+        log_msg = f"[{lender_id}] [{table_name}] Test: {display_name} | Status: {status}"
+        if status in ["FAIL", "ERROR", "TIMEOUT"]:
+            logger.warning(f"{log_msg} - {error_msg}")
+        else:
+            logger.info(log_msg)
+
+        return {
+            "lender": lender_id,
+            "table": table_name,
+            "rule_name": display_name,
+            "test_description": meta.get('description', display_name),
+            "status": status,
+            "failed_rows": unexpected_count,
+            "total_rows": element_count,
+            "severity": severity,
+            "error_msg": error_msg
+        }
     
 
-    def run_validation(self, lender_id, specific_table=None):
-        logger.info(f"Initializing GX for {lender_id}...")
+    def _max_concurrent_queries(self, lender_id):
+        """Per-lender cap from secrets.toml, falling back to settings in the rules YAML."""
+        creds = self.secrets.get(lender_id, {})
+        return max(1, int(creds.get('max_concurrent_queries', self.settings.get('max_concurrent_queries', 1))))
+
+    def _run_units(self, units, max_workers):
+        """
+        Runs zero-argument callables and returns their results in submission order.
+        Units run on a thread pool when the lender allows more than one query in flight.
+        """
+        if max_workers <= 1 or len(units) <= 1:
+            return [unit() for unit in units]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(unit) for unit in units]
+            return [future.result() for future in futures]
+
+    def _timed_unit(self, unit):
+        start = time.perf_counter()
+        result = unit()
+        return result, time.perf_counter() - start
+
+    def _plan_table(self, lender_id, table_name, check_engine, rule_names=None):
+        """
+        Resolves a table's PKs and splits its rules into count-first SQL checks and GX checks.
+        `rule_names` restricts the plan to those rules.
+        """
+        table = self.registry.tables[table_name]
+
+        gx_rules = []
+        sql_rules = []
+        unsupported_rules = []
+        # target_lenders is already resolved by the registry
+        for exp_config in self.registry.lender_rules(lender_id, table_name):
+            if rule_names is not None and exp_config.get('name') not in rule_names:
+                continue
+
+            if exp_config['type'] == "unexpected_rows_expectation" and (self.count_first or check_engine == "direct"):
+                sql_rules.append(exp_config)
+            elif check_engine == "direct":
+                unsupported_rules.append(exp_config)
+            else:
+                gx_rules.append(exp_config)
+
+        return {
+            "table": table_name,
+            "watermark_column": table['watermark_column'],
+            "primary_keys": table['primary_keys'],
+            "source_tables": table['source_tables'],
+            "rules_hash": table['rules_hash'],
+            "sql_rules": sql_rules,
+            "gx_rules": gx_rules,
+            "unsupported_rules": unsupported_rules
+        }
+
+    def _plan_rules(self, plan):
+        return plan['sql_rules'] + plan['gx_rules'] + plan['unsupported_rules']
+
+    def _rule_levels(self, plans):
+        """The dependency levels (see RuleRegistry) of the planned rules, in run order."""
+        return sorted({rule.get('level', 0) for plan in plans for rule in self._plan_rules(plan)})
+
+    def _level_plan(self, plan, level):
+        """A copy of the plan with only its rules on `level`."""
+        return dict(plan, level=level, **{
+            key: [rule for rule in plan[key] if rule.get('level', 0) == level]
+            for key in ("sql_rules", "gx_rules", "unsupported_rules")
+        })
+
+    def _skip_failed_dependencies(self, lender_id, plan, statuses, table_count):
+        """
+        Takes the rules with a dependency that did not pass out of the plan and returns
+        their SKIPPED rows; their status is added to `statuses` so dependents skip too.
+        With settings.skip_dependents false they run anyway (still after their dependencies).
+        """
+        rows = []
+        if not self.settings.get('skip_dependents', True):
+            return rows
+        for key in ("sql_rules", "gx_rules", "unsupported_rules"):
+            runnable = []
+            for exp_config in plan[key]:
+                failed = rule_registry.failed_dependency(exp_config, statuses)
+                if failed is None:
+                    runnable.append(exp_config)
+                    continue
+                dependency_table, dependency_name, status = failed
+                display_name = exp_config.get('name') or exp_config['type']
+                dependency = dependency_name if dependency_table == plan['table'] else f"{dependency_table}.{dependency_name}"
+                rows.append(self._build_result_row(
+                    lender_id, plan['table'], display_name, exp_config.get('meta', {}), "SKIPPED", 0, table_count,
+                    f"Skipped: depends on '{dependency}', which did not pass ({status})."
+                ))
+                statuses[(plan['table'], display_name)] = "SKIPPED"
+            plan[key] = runnable
+        return rows
+
+    def _table_units(self, gx_state, lender_id, creds, engine, plan, table_count, depth):
+        """
+        The units (zero-argument callables) that check a planned table, and the rows of
+        rules that need no query (rules the direct engine can't run).
+        """
+        units = []
+        rows = []
+        sql_rules = plan['sql_rules']
+        restriction = plan.get('restriction')
+        if depth == "sample":
+            sampled_rules = [r for r in sql_rules if r.get('mode') == "sample"]
+            sql_rules = [r for r in sql_rules if r.get('mode') != "sample"]
+            for exp_config in sampled_rules:
+                units.append(functools.partial(
+                    self._run_sampled_check, engine, lender_id, plan['table'], exp_config,
+                    plan['primary_keys'], table_count, restriction
+                ))
+            # Rows outside the sample were not checked; the next full run must still see them
+            plan['sampled'] = bool(sampled_rules)
+        if self.fuse_checks and sql_rules:
+            fused_groups, sql_rules = self._group_fusable_checks(plan['table'], sql_rules, restriction)
+            for group in fused_groups:
+                units.append(functools.partial(
+                    self._run_fused_checks, engine, lender_id, plan['table'], group,
+                    plan['primary_keys'], table_count, restriction
+                ))
+        for exp_config in sql_rules:
+            units.append(functools.partial(
+                self._run_count_check, engine, lender_id, plan['table'], exp_config,
+                plan['primary_keys'], table_count, restriction
+            ))
+        if plan['gx_rules']:
+            units.append(functools.partial(self._run_gx_table, gx_state, lender_id, creds, engine, plan))
+        for exp_config in plan['unsupported_rules']:
+            display_name = exp_config.get('name') or exp_config['type']
+            rows.append(self._build_result_row(
+                lender_id, plan['table'], display_name, exp_config.get('meta', {}), "ERROR", 0, table_count,
+                f"Expectation type '{exp_config['type']}' needs the GX engine; the direct engine only runs unexpected_rows_expectation rules."
+            ))
+        return units, rows
+
+    def plan_units(self, lender_id, check_engine=None, selection=None):
+        """
+        Splits a lender's work into pieces an external scheduler can run independently
+        with run_validation(lender_id, specific_table=table, rule_names=rules):
+        one per fused scan, per remaining count-first rule and per table's GX checkpoint.
+        Every rule of an incremental table stays in one piece so the table's watermark
+        is read and advanced once. Otherwise a piece only holds rules of one dependency
+        level, so it never waits on a piece that waits on it. `selection` ({table:
+        [rule names]}, see RuleRegistry.select) limits the plan to those rules.
+        Returns a list of (table, [rule names] or None for the whole table, queries), where
+        `queries` is how many statements the piece can have in flight at once.
+        """
+        check_engine = check_engine or self.check_engine
+        units = []
+        for table_name in self.registry.tables:
+            if selection is not None and table_name not in selection:
+                continue
+            plan = self._plan_table(lender_id, table_name, check_engine,
+                                    rule_names=selection[table_name] if selection is not None else None)
+            if not plan:
+                continue
+            all_rules = plan['sql_rules'] + plan['gx_rules'] + plan['unsupported_rules']
+            if not all_rules:
+                continue
+            names = [r.get('name') for r in all_rules]
+            # A whole table runs its SQL checks on the lender's thread pool
+            table_queries = max(1, min(self._max_concurrent_queries(lender_id), len(plan['sql_rules'])))
+            if not all(names):
+                # Unnamed rules can't be picked out one by one
+                units.append((table_name, None, table_queries))
+                continue
+            if self.incremental and plan['watermark_column']:
+                units.append((table_name, names, table_queries))
+                continue
+
+            for level in self._rule_levels([plan]):
+                level_plan = self._level_plan(plan, level)
+                sql_rules = level_plan['sql_rules']
+                if self.fuse_checks and sql_rules:
+                    fused_groups, sql_rules = self._group_fusable_checks(table_name, sql_rules)
+                    units.extend((table_name, [r['name'] for r, _ in group], 1) for group in fused_groups)
+                units.extend((table_name, [r['name']], 1) for r in sql_rules)
+                other_rules = level_plan['gx_rules'] + level_plan['unsupported_rules']
+                if other_rules:
+                    units.append((table_name, [r['name'] for r in other_rules], 1))
+        return units
+
+    def run_validation(self, lender_id, specific_table=None, check_engine=None, full_scan=False, rule_names=None,
+                       deadline=None, refresh=False, depth=None, gate_status=None, max_queries=None):
+        """
+        Validates one lender (or one of its tables) and returns one row per rule.
+        With a result cache, tables unchanged since their cached run are not re-checked
+        unless refresh=True. depth="sample" runs `mode: sample` count-first rules on a
+        key-hash sample (settings.run_depth is the default). `gate_status` maps
+        (table, rule) to the status of rules run before this call (other units of a
+        scheduled run); rules depending on one that did not pass are SKIPPED.
+        `max_queries` lowers the lender's max_concurrent_queries for this call (a
+        scheduler's share of the host).
+        """
+        check_engine = check_engine or self.check_engine
+        if check_engine not in ("gx", "direct"):
+            raise ValueError(f"Unknown check_engine '{check_engine}'. Use 'gx' or 'direct'.")
+        depth = depth or self.settings.get('run_depth', 'full')
+        if depth not in sampling.DEPTHS:
+            raise ValueError(f"Unknown depth '{depth}'. Use {' or '.join(repr(d) for d in sampling.DEPTHS)}.")
+
+        logger.info(f"Initializing {check_engine} engine for {lender_id}...")
         all_results = []
-        
+
+        with self._inflight_lock:
+            self._active_runs[lender_id] = self._active_runs.get(lender_id, 0) + 1
+            if deadline is not None:
+                # Wall-clock deadline shared by every piece of a scheduled lender run
+                self._deadlines[lender_id] = time.monotonic() + (deadline - time.time())
+            else:
+                budget = self.lender_time_budget(lender_id)
+                if budget:
+                    self._deadlines[lender_id] = time.monotonic() + budget
+
+        self._reset_table_metadata(lender_id)
+
         try:
-            context = gx.get_context(mode="ephemeral")
             creds = self.secrets[lender_id]
-            ds_name = f"ds_{lender_id}"
-            
-            conn_str = self._build_connection_string(creds)
-            data_source = context.data_sources.add_sql(name=ds_name, connection_string=conn_str)
+            engine = self._get_engine(lender_id)
+            with self.profiler.phase("connect", lender_id), engine.connect():
+                pass
             
             if specific_table:
-                if specific_table not in self.rules['tables']:
+                if specific_table not in self.registry.tables:
                     logger.warning(f"Table {specific_table} requested but not found in rules YAML.")
                     return pd.DataFrame()
                 target_tables = [specific_table]
             else:
-                target_tables = list(self.rules['tables'].keys())
-            
+                target_tables = list(self.registry.tables.keys())
+
+            table_plans = []
             for table_name in target_tables:
                 logger.info(f"[{lender_id}] Starting validation for table: {table_name}")
-                asset_name = f"asset_{lender_id}_{table_name}"
-                try:
-                    data_asset = data_source.get_asset(asset_name)
-                except LookupError:
-                    data_asset = data_source.add_table_asset(name=asset_name, table_name=table_name)
-                
-                batch_def = data_asset.add_batch_definition_whole_table(f"batch_{table_name}")
-                suite_name = f"suite_{lender_id}_{table_name}"
-                suite = context.suites.add(gx.ExpectationSuite(name=suite_name))
-                
-                table_config = self.rules['tables'][table_name]
-                
-                # Strict enforcement: Config MUST be a dictionary with 'primary_key'
-                if not isinstance(table_config, dict):
-                    logger.error(f"Invalid configuration for table {table_name}. Must be a dictionary with 'primary_key'.")
-                    continue
-                    
-                table_rules = table_config.get('expectations', [])
-                pk_config = table_config.get('primary_key')
-                
-                if not pk_config:
-                    logger.error(f"Table {table_name} missing 'primary_key' configuration.")
-                    continue
-                    
-                if isinstance(pk_config, list):
-                    primary_keys = pk_config
-                else:
-                    primary_keys = [pk_config]
+                table_plans.append(self._plan_table(lender_id, table_name, check_engine, rule_names))
+            table_plans = [plan for plan in table_plans if plan]
+            max_workers = min(self._max_concurrent_queries(lender_id), max_queries or float('inf'))
 
-                from great_expectations import expectations as gxe
-                
-                with warnings.catch_warnings():
-                    warnings.filterwarnings("ignore", message=".*unexpected_rows_query should contain the {batch} parameter.*")
-                    
-                    for exp_config in table_rules:
-                        # Check if this expectation has specific target lenders
-                        target_lenders = exp_config.get('target_lenders')
-                        if target_lenders and lender_id not in target_lenders:
-                            logger.info(f"[{lender_id}] Skipping test '{exp_config.get('name')}' as lender is not in target_lenders.")
-                            continue
+            # Tables whose data and rules are unchanged since a cached run are answered from the cache
+            cache_entries = {}
+            if self.result_cache is not None and table_plans:
+                fingerprints = self._table_fingerprints(engine, lender_id, table_plans)
+                rule_key = tuple(rule_names) if rule_names else None
+                remaining_plans = []
+                for plan in table_plans:
+                    key = (lender_id, plan['table'], plan['rules_hash'], check_engine, self.count_first, rule_key, depth)
+                    cached = None if refresh else self.result_cache.get(key, fingerprints[plan['table']])
+                    if cached is None:
+                        # A rule the direct engine can't run errors the same way every time
+                        expected_errors = {r.get('name') or r['type'] for r in plan['unsupported_rules']}
+                        cache_entries[plan['table']] = (key, fingerprints[plan['table']], expected_errors)
+                        remaining_plans.append(plan)
+                        continue
+                    logger.info(f"[{lender_id}] [{plan['table']}] Unchanged since the last run, using cached results.")
+                    cached['cached'] = True
+                    # Not a real run: keep it out of the scheduler's duration history
+                    cached['duration_s'] = None
+                    all_results.append(cached)
+                table_plans = remaining_plans
 
-                        meta_data = exp_config.get('meta', {})
-                        meta_data['test_alias'] = exp_config.get('name') 
-                        
-                        # Store PK config for CSV generation
-                        meta_data['primary_keys'] = primary_keys
-
-                        if exp_config['type'] == "unexpected_rows_expectation":
-                            exp_instance = gxe.UnexpectedRowsExpectation(**exp_config['kwargs'])
-                            exp_instance.meta = meta_data
-                            suite.add_expectation(exp_instance)
-                        else:
-                            camel_name = "".join([x.capitalize() for x in exp_config['type'].split('_')])
-                            if hasattr(gxe, camel_name):
-                                exp_class = getattr(gxe, camel_name)
-                                exp_instance = exp_class(**exp_config['kwargs'])
-                                exp_instance.meta = meta_data
-                                suite.add_expectation(exp_instance)
-                            else:
-                                logger.warning(f"Expectation {camel_name} not found.")
+            # Statuses of the rules this run's dependencies refer to: from other units of
+            # a scheduled run, then from this one as it goes. Rules whose dependency
+            # already failed elsewhere are skipped before their table is counted.
+            statuses = dict(gate_status or {})
+            for cached in all_results:
+                statuses.update(rule_registry.rule_statuses(cached))
+            skipped_tables = set()
+            for plan in table_plans:
+                skipped = self._skip_failed_dependencies(lender_id, plan, statuses, None)
+                if skipped:
+                    all_results.append(pd.DataFrame(skipped))
+                    skipped_tables.add(plan['table'])
+            table_plans = [p for p in table_plans if p['table'] not in skipped_tables or self._plan_rules(p)]
 
-                    val_def = context.validation_definitions.add(
-                        gx.ValidationDefinition(data=batch_def, suite=suite, name=f"val_{lender_id}_{table_name}")
-                    )
-                    
-                    checkpoint = context.checkpoints.add(
-                        gx.Checkpoint(
-                            name=f"chk_{lender_id}_{table_name}", 
-                            validation_definitions=[val_def], 
-                            result_format={
-                                "result_format": "COMPLETE",
-                                "unexpected_index_column_names": primary_keys,
-                                "partial_unexpected_count": 5000
-                            }
-                        )
-                    )
-                    
-                    result = checkpoint.run()
+            # Row counts (and sizes) of every table first, in one round trip, so each check
+            # and the GX parser can report total_rows. Workers fetch all configured tables at once.
+            metadata = self.table_metadata(
+                lender_id, None if self.keep_table_metadata else [plan['table'] for plan in table_plans], engine
+            )
+            table_counts = {table_name: meta['row_count'] for table_name, meta in metadata.items()}
+
+            # Incremental mode narrows count-first rules to rows past the stored watermark
+            if self.incremental and not full_scan:
+                wm_plans = [plan for plan in table_plans if plan['sql_rules'] and plan['watermark_column']]
+                new_marks = self._run_units(
+                    [functools.partial(self._get_max_watermark, engine, lender_id, p['table'], p['watermark_column'])
+                     for p in wm_plans],
+                    max_workers
+                )
+                for plan, new_mark in zip(wm_plans, new_marks):
+                    self._plan_incremental(lender_id, plan, new_mark)
 
-                # Pass table_name to parse_results for better logging context
-                # Pass creds so we can re-run queries if needed
-                df = self._parse_results(lender_id, result, table_name, creds)
-                all_results.append(df)
+            # Levels run in order (gates first); a rule whose dependency did not pass is
+            # SKIPPED. Without depends_on/gates every rule is on level 0.
+            # The GX context is built lazily, by the first table that still has GX rules
+            gx_state = {}
+            for level in self._rule_levels(table_plans):
+                units = []
+                for plan in table_plans:
+                    level_plan = self._level_plan(plan, level)
+                    table_count = table_counts[plan['table']]
+                    skipped = self._skip_failed_dependencies(lender_id, level_plan, statuses, table_count)
+                    if skipped:
+                        all_results.append(pd.DataFrame(skipped))
+                    table_units, rows = self._table_units(gx_state, lender_id, creds, engine, level_plan, table_count, depth)
+                    units.extend(table_units)
+                    if rows:
+                        all_results.append(pd.DataFrame(rows))
+                        statuses.update(rule_registry.rule_statuses(all_results[-1]))
+                    if level_plan.get('sampled'):
+                        plan['sampled'] = True
 
-            if all_results:
-                return pd.concat(all_results, ignore_index=True)
-            return pd.DataFrame()
+                timed_units = [functools.partial(self._timed_unit, unit) for unit in units]
+                for unit_result, elapsed in self._run_units(timed_units, max_workers):
+                    if isinstance(unit_result, dict):
+                        unit_result = pd.DataFrame([unit_result])
+                    elif isinstance(unit_result, list):
+                        unit_result = pd.DataFrame(unit_result)
+                    if not unit_result.empty:
+                        # Rules that shared a scan/checkpoint split its wall time evenly
+                        unit_result['duration_s'] = round(elapsed / len(unit_result), 3)
+                    all_results.append(unit_result)
+                    statuses.update(rule_registry.rule_statuses(unit_result))
+
+            if not all_results:
+                return pd.DataFrame()
+            final_df = pd.concat(all_results, ignore_index=True)
+            self._save_watermarks(lender_id, table_plans, final_df)
+            self._cache_results(cache_entries, final_df)
+            return final_df
 
         except Exception as e:
             logger.error(f"GX Critical Failure for {lender_id}: {e}")
@@ -163,6 +1052,280 @@ class GXRunner:
                 "failed_rows": 0,
                 "total_rows": 0
             }])
+        finally:
+            with self._inflight_lock:
+                self._active_runs[lender_id] -= 1
+                if not self._active_runs[lender_id]:
+                    del self._active_runs[lender_id]
+                    self._deadlines.pop(lender_id, None)
+            if not self.persistent_engines:
+                self.dispose_engines(lender_id)
+            if self.failed_rows_format == "parquet":
+                self.finalize_failed_rows()
+            elif self.failed_row_store is not None:
+                self.failed_row_store.maybe_compact(lender_id)
+
+    def _table_fingerprints(self, engine, lender_id, plans):
+        """
+        A value per table that changes whenever the data its rules read changes, or None
+        when that can't be told cheaply (the table is then never served from cache).
+        MySQL: information_schema.TABLES.UPDATE_TIME of every table the rules read, in one
+        query. Otherwise, or when UPDATE_TIME is NULL (e.g. InnoDB after a restart): the row
+        count and MAX(watermark_column), for tables whose rules only read the table itself.
+        """
+        update_times = {}
+        if engine.dialect.name == "mysql":
+            names = sorted({name.split('.')[-1].lower() for plan in plans for name in plan['source_tables']})
+            query = sqlalchemy.text(
+                "SELECT TABLE_SCHEMA, TABLE_NAME, UPDATE_TIME, DATABASE() FROM information_schema.TABLES "
+                "WHERE LOWER(TABLE_NAME) IN :names"
+            ).bindparams(sqlalchemy.bindparam('names', expanding=True))
+            try:
+                with self.profiler.phase("fingerprint", lender_id), engine.connect() as conn:
+                    for schema, name, update_time, current_schema in conn.execute(query, {"names": names}):
+                        if update_time is None:
+                            continue
+                        update_times[f"{schema}.{name}".lower()] = update_time
+                        if schema == current_schema:
+                            update_times[name.lower()] = update_time
+            except Exception as e:
+                logger.warning(f"[{lender_id}] Could not read table update times: {e}")
+
+        fingerprints = {}
+        for plan in plans:
+            table_name = plan['table']
+            sources = [name.lower() for name in plan['source_tables']]
+            fingerprints[table_name] = None
+            if all(name in update_times for name in sources):
+                fingerprints[table_name] = tuple((name, str(update_times[name])) for name in sources)
+            elif sources == [table_name.lower()] and plan['watermark_column']:
+                mark = self._get_max_watermark(engine, lender_id, table_name, plan['watermark_column'])
+                row_count = self._get_table_count(engine, lender_id, table_name) if mark is not None else None
+                if row_count is not None:
+                    fingerprints[table_name] = ("rows", row_count, str(mark))
+            bucket = self._clock_bucket_seconds(plan)
+            if fingerprints[table_name] is not None and bucket:
+                fingerprints[table_name] += (("clock", int(time.time() // bucket)),)
+        return fingerprints
+
+    def _clock_bucket_seconds(self, plan):
+        """
+        How long a table's cached results may stand without any data change, or None if
+        only a data change (or the TTL) expires them. Rules that read the clock (e.g. the
+        *_table_refreshing gates) can fail on unchanged data, and rules scheduled more often
+        than the TTL expect to be re-checked at that interval.
+        """
+        ttl = self.result_cache.ttl_seconds
+        buckets = []
+        for rule in self._plan_rules(plan):
+            kind, interval = rule.get('schedule') or rule_schedule.DAILY
+            every = interval if kind == "every" else None
+            if rule.get('reads_clock'):
+                buckets.append(min(every or self.result_cache_clock_seconds, self.result_cache_clock_seconds))
+            elif every and (not ttl or every < ttl):
+                buckets.append(every)
+        return max(1, min(buckets)) if buckets else None
+
+    def _cache_results(self, cache_entries, results_df):
+        """
+        Stores each freshly validated table's rows. Tables with TIMEOUT or unexpected
+        ERROR rows are not cached, so the next run tries them again.
+        """
+        if not cache_entries or 'table' not in results_df.columns:
+            return
+        for table_name, (key, fingerprint, expected_errors) in cache_entries.items():
+            table_df = results_df[results_df['table'] == table_name]
+            if 'cached' in table_df.columns:
+                table_df = table_df[table_df['cached'] != True]
+            settled = table_df['status'].isin(["PASS", "FAIL"]) | (
+                (table_df['status'] == "ERROR") & table_df['rule_name'].isin(expected_errors)
+            )
+            if table_df.empty or not settled.all():
+                continue
+            self.result_cache.put(key, fingerprint, table_df.drop(columns=['cached'], errors='ignore'))
+
+    def _get_max_watermark(self, engine, lender_id, table_name, column):
+        try:
+            with self.profiler.phase("watermark", lender_id, table_name), engine.connect() as conn, \
+                    self._watchdog(engine, conn.connection, lender_id, self._query_timeout(lender_id)):
+                return conn.execute(sqlalchemy.text(f"SELECT MAX({column}) FROM {table_name}")).scalar()
+        except Exception as e:
+            logger.warning(f"Could not read watermark {table_name}.{column}: {e}")
+            return None
+
+    def _plan_incremental(self, lender_id, plan, new_mark):
+        """
+        Decides between an incremental and a full scan for one table and records the
+        decision on the plan. A full scan runs when there is no usable stored mark or
+        the last full scan is older than settings.full_scan_interval_days.
+        """
+        table_name = plan['table']
+        column = plan['watermark_column']
+        if new_mark is None:
+            return
+
+        state = self.watermarks.get(lender_id, table_name)
+        interval_days = self.settings.get('full_scan_interval_days', 7)
+        full_scan_due = True
+        if state and state.get('column') == column and state.get('last_full_scan'):
+            last_full_scan = datetime.datetime.fromisoformat(state['last_full_scan'])
+            full_scan_due = datetime.datetime.now() - last_full_scan >= datetime.timedelta(days=interval_days)
+
+        plan['watermark'] = {"column": column, "value": new_mark, "full_scan": full_scan_due}
+        if full_scan_due:
+            logger.info(f"[{lender_id}] [{table_name}] Full scan (watermark {column}).")
+            return
+
+        plan['restriction'] = (
+            f"{column} > {state['high_water_mark_sql']} AND {column} <= {sql_rewrite.sql_literal(new_mark)}"
+        )
+        logger.info(f"[{lender_id}] [{table_name}] Incremental scan: {column} > {state['high_water_mark']}")
+
+    def _save_watermarks(self, lender_id, table_plans, results_df):
+        """Advances a table's watermark only if none of its checks errored or was skipped, so no row is missed."""
+        for plan in table_plans:
+            mark = plan.get('watermark')
+            if not mark:
+                continue
+            if plan.get('sampled'):
+                logger.info(f"[{lender_id}] [{plan['table']}] Sampled run; watermark not advanced.")
+                continue
+            table_rows = results_df[results_df['table'] == plan['table']]
+            if table_rows['status'].isin(["ERROR", "TIMEOUT", "SKIPPED"]).any():
+                logger.warning(f"[{lender_id}] [{plan['table']}] Errors or skipped checks in run; watermark not advanced.")
+                continue
+            try:
+                self.watermarks.save(lender_id, plan['table'], mark['column'], mark['value'], mark['full_scan'])
+            except Exception as e:
+                logger.error(f"Could not save watermark for {lender_id}/{plan['table']}: {e}")
+
+    def start_run(self, run_id):
+        """
+        Reuses this runner, with its open engines, for another run (the scheduler
+        daemon's warm workers): new run_id and profiler, and fresh table metadata.
+        """
+        self.run_id = run_id
+        self.profiler = Profiler(run_id, root=self.profiler.root, enabled=self.profiler.enabled)
+        with self._metadata_lock:
+            self._table_metadata.clear()
+
+    def for_run(self, run_id):
+        """
+        A view of this runner for one of several concurrent runs (dashboard jobs): it
+        shares the engines, table metadata and result cache, but has its own run_id and
+        profiler, and its own lender deadlines and in-flight queries for time budgets
+        and cancel().
+        """
+        view = copy.copy(self)
+        view.run_id = run_id
+        view.profiler = Profiler(run_id, root=self.profiler.root, enabled=self.profiler.enabled)
+        view._deadlines = {}
+        view._active_runs = {}
+        view._inflight = {}
+        view._inflight_lock = threading.Lock()
+        return view
+
+    def finalize_failed_rows(self):
+        """Rewrites the run's Parquet manifest from every file written so far."""
+        try:
+            manifest_path = parquet_export.finalize_run_manifest(self.run_id)
+            if manifest_path:
+                logger.info(f"Updated failed-rows manifest: {manifest_path}")
+        except Exception as e:
+            logger.error(f"Failed to write failed-rows manifest for run {self.run_id}: {e}")
+
+    def _run_gx_table(self, gx_state, lender_id, creds, engine, plan):
+        """
+        Builds and runs the GX checkpoint for one table's remaining rules.
+        GX contexts are not thread-safe, so everything touching the context is serialised.
+        """
+        import great_expectations as gx
+
+        table_name = plan['table']
+        primary_keys = plan['primary_keys']
+
+        with self._gx_lock:
+            # Waiting for the lock may have used up the lender's budget
+            timeout = self._query_timeout(lender_id)
+            if timeout is not None and timeout <= 0:
+                return [
+                    self._build_result_row(
+                        lender_id, table_name, exp_config.get('name') or exp_config['type'], exp_config.get('meta', {}),
+                        "TIMEOUT", 0, 0, "Skipped: lender time budget exhausted or run cancelled"
+                    )
+                    for exp_config in plan['gx_rules']
+                ]
+
+            if 'data_source' not in gx_state:
+                with self.profiler.phase("gx_context", lender_id):
+                    context = gx.get_context(mode="ephemeral")
+                    conn_str = self._build_connection_string(creds)
+                    gx_state['context'] = context
+                    gx_state['data_source'] = context.data_sources.add_sql(
+                        name=f"ds_{lender_id}", connection_string=conn_str, kwargs=self._gx_engine_kwargs(engine)
+                    )
+                    if engine in self._query_rewriters:
+                        # Expectations run on the execution engine's own SQLAlchemy engine
+                        # (on the shared pool's connections), not on data_source.get_engine()
+                        execution_engine = gx_state['data_source'].get_execution_engine()
+                        self._listen_rewrite(execution_engine.engine, self._query_rewriters[engine])
+            context = gx_state['context']
+            data_source = gx_state['data_source']
+
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", message=".*unexpected_rows_query should contain the {batch} parameter.*")
+                with self.profiler.phase("suite_build", lender_id, table_name):
+                    asset_name = f"asset_{lender_id}_{table_name}"
+                    try:
+                        data_asset = data_source.get_asset(asset_name)
+                    except LookupError:
+                        data_asset = data_source.add_table_asset(name=asset_name, table_name=table_name)
+            
+                    # One checkpoint per dependency level on the same context: names must not repeat
+                    suffix = f"_level{plan['level']}" if plan.get('level') else ""
+                    batch_def = data_asset.add_batch_definition_whole_table(f"batch_{table_name}{suffix}")
+                    suite_name = f"suite_{lender_id}_{table_name}{suffix}"
+                    suite = context.suites.add(gx.ExpectationSuite(name=suite_name))
+
+                    from great_expectations import expectations as gxe
+
+                    for exp_config in plan['gx_rules']:
+                        # meta already carries test_alias and the table's primary_keys (for the CSV);
+                        # the compiled rule is shared, so each expectation gets its own copy
+                        meta_data = dict(exp_config['meta'])
+
+                        exp_class = getattr(gxe, exp_config['expectation_class'], None)
+                        if exp_class is None:
+                            logger.warning(f"Expectation {exp_config['expectation_class']} not found.")
+                            continue
+                        exp_instance = exp_class(**exp_config['kwargs'])
+                        exp_instance.meta = meta_data
+                        suite.add_expectation(exp_instance)
+
+                    val_def = context.validation_definitions.add(
+                        gx.ValidationDefinition(data=batch_def, suite=suite, name=f"val_{lender_id}_{table_name}{suffix}")
+                    )
+                
+                    checkpoint = context.checkpoints.add(
+                        gx.Checkpoint(
+                            name=f"chk_{lender_id}_{table_name}{suffix}",
+                            validation_definitions=[val_def], 
+                            result_format={
+                                "result_format": "COMPLETE",
+                                "unexpected_index_column_names": primary_keys,
+                                "partial_unexpected_count": 5000
+                            }
+                        )
+                    )
+
+                gx_rule_names = "+".join(exp_config.get('name') or exp_config['type'] for exp_config in plan['gx_rules'])
+                with self.profiler.phase("checkpoint", lender_id, table_name, gx_rule_names):
+                    result = checkpoint.run()
+
+        # Pass table_name to parse_results for better logging context
+        # Pass the engine so we can re-run queries if needed
+        with self.profiler.phase("parse", lender_id, table_name):
+            return self._parse_results(lender_id, result, table_name, engine)
 
     def _extract_error_message(self, info_dict):
         if not isinstance(info_dict, dict):
@@ -178,7 +1341,7 @@ class GXRunner:
                     return found
         return None
 
-    def _parse_results(self, lender_id, checkpoint_result, table_name, creds):
+    def _parse_results(self, lender_id, checkpoint_result, table_name, engine):
         parsed_rows = []
         
         run_result = list(checkpoint_result.run_results.values())[0]
@@ -186,9 +1349,8 @@ class GXRunner:
             validation_result = run_result['validation_result']
         else:
             validation_result = run_result
-        
-        cached_table_count = None
-        
+
+        # Row counts come from the run's table metadata (see table_metadata), not a new scan
         for res in validation_result.results:
             exp_config = res.expectation_config
             meta = exp_config.meta or {}
@@ -205,10 +1367,7 @@ class GXRunner:
                 if "unexpected_count" in res.result:
                     unexpected_count = int(res.result["unexpected_count"])
                 
-                if cached_table_count is None:
-                    cached_table_count = self._get_table_count(creds, table_name)
-
-                element_count = cached_table_count
+                element_count = self._get_table_count(engine, lender_id, table_name)
 
             else:
                 # Metric-based expectation
@@ -216,9 +1375,7 @@ class GXRunner:
                 raw_element_count = int(res.result.get("element_count", 0))
 
                 if raw_element_count == 0:
-                    if cached_table_count is None:
-                        cached_table_count = self._get_table_count(creds, table_name)
-                    element_count = cached_table_count
+                    element_count = self._get_table_count(engine, lender_id, table_name)
                 else:
                     element_count = raw_element_count
 
@@ -236,6 +1393,8 @@ class GXRunner:
                 raw_msg = self._extract_error_message(res.exception_info)
                 if raw_msg:
                     error_msg = str(raw_msg)[:2000]
+                    if is_timeout_error(error_msg):
+                        status = "TIMEOUT"
                 else:
                     logger.error(f"Failed to extract error message. Raw info: {res.exception_info}")
                     error_msg = "Unknown execution error (Check logs)"
@@ -248,56 +1407,36 @@ class GXRunner:
                 else:
                     display_name = exp_config.type
 
-            severity = meta.get('severity', 'warning')
-            
-            # --- Detailed Logging ---
-            log_msg = f"[{lender_id}] [{table_name}] Test: {display_name} | Status: {status}"
-            if status in ["FAIL", "ERROR"]:
-                logger.warning(f"{log_msg} - {error_msg}")
-            else:
-                logger.info(log_msg)
-            
-            parsed_rows.append({
-                "lender": lender_id,
-                "table": table_name,
-                "test_description": meta.get('description', display_name),
-                "status": status,
-                "failed_rows": unexpected_count,
-                "total_rows": element_count,
-                "severity": severity,
-                "error_msg": error_msg
-            })
+            parsed_rows.append(self._build_result_row(
+                lender_id, table_name, display_name, meta, status, unexpected_count, element_count, error_msg
+            ))
             
             # --- CSV Generation (Modified to allow re-running query) ---
             if status == "FAIL":
-                self._generate_failure_csv(lender_id, table_name, display_name, res, creds)
+                self._generate_failure_csv(lender_id, table_name, display_name, res, engine)
+            elif status == "PASS":
+                self._clear_failed_rows(lender_id, table_name, display_name)
 
         return pd.DataFrame(parsed_rows)
 
-    def _generate_failure_csv(self, lender_id, table_name, test_name, result_obj, creds):
+    def _generate_failure_csv(self, lender_id, table_name, test_name, result_obj, engine):
         """
         Generates a CSV file for failed tests.
         Filename format: lender_table_test_name_testruntime.csv
         Content: lender_name, table_name, test_name, [pk_cols...], expected_value, actual_value
         """
         try:
-            # Create directory if not exists
-            output_dir = "failed_rows"
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            # Sanitize filename components
-            safe_test_name = "".join([c if c.isalnum() else "_" for c in test_name])
-            filename = f"{lender_id}_{table_name}_{safe_test_name}_{timestamp}.csv"
-            filepath = os.path.join(output_dir, filename)
-
-            rows_to_save = []
-            
             # Retrieve configured PKs from meta
             meta = result_obj.expectation_config.meta or {}
             primary_keys = meta.get('primary_keys', [])
             description = meta.get('description', 'Pass Expectation')
+
+            # Default GX behavior
+            unexpected_list = result_obj.result.get("unexpected_list", [])
+            unexpected_rows = result_obj.result.get("unexpected_rows")
+            if unexpected_rows is None:
+                unexpected_rows = result_obj.result.get("details", {}).get("unexpected_rows", [])
+            gx_items = unexpected_list or unexpected_rows or []
             
             # CHECK: If this is a SQL expectation, bypass GX limits and run query directly
             exp_config = result_obj.expectation_config
@@ -310,81 +1449,183 @@ class GXRunner:
                 logger.info(f"Downloading full failed rows directly from DB for {test_name}...")
                 
                 try:
-                    conn_str = self._build_connection_string(creds)
-                    # Use pandas to read sql
-                    df_fail_direct = pd.read_sql(query, conn_str)
-                    unexpected_items = df_fail_direct.to_dict(orient='records')
+                    self._write_failed_rows(
+                        lender_id, table_name, test_name, self._stream_unexpected_rows(query, engine), primary_keys, description
+                    )
+                    return
                 except Exception as db_err:
                     logger.error(f"Direct DB fetch failed: {db_err}. Falling back to GX results.")
-                    # Fallback to GX results
-                    unexpected_list = result_obj.result.get("unexpected_list", [])
-                    unexpected_rows = result_obj.result.get("unexpected_rows")
-                    if unexpected_rows is None:
-                        unexpected_rows = result_obj.result.get("details", {}).get("unexpected_rows", [])
-                    unexpected_items = unexpected_list or unexpected_rows or []
 
+            # GX only returns a limited list, so this never resolves rows in the delta store
+            self._write_failed_rows(lender_id, table_name, test_name, [gx_items], primary_keys, description, complete=False)
+        
+        except Exception as e:
+            logger.error(f"Failed to generate CSV for {test_name}: {e}")
+
+    def _export_query_failures(self, lender_id, table_name, test_name, query, primary_keys, description, engine,
+                               complete=True):
+        """
+        Same CSV as _generate_failure_csv, for checks that never went through a GX result object.
+        complete=False when the query only covers part of the table (incremental, sampled).
+        """
+        try:
+            logger.info(f"Downloading full failed rows directly from DB for {test_name}...")
+            self._write_failed_rows(
+                lender_id, table_name, test_name, self._stream_unexpected_rows(query, engine), primary_keys, description,
+                complete=complete
+            )
+        except Exception as e:
+            logger.error(f"Failed to generate CSV for {test_name}: {e}")
+
+    def _clear_failed_rows(self, lender_id, table_name, test_name):
+        """A check passed on its whole table: every open failure of it is resolved (delta store only)."""
+        if self.failed_row_store is None:
+            return
+        try:
+            self.failed_row_store.apply(self.run_id, lender_id, table_name, test_name, [], [], complete=True)
+        except Exception as e:
+            logger.error(f"Failed to update the failed-row store for {test_name}: {e}")
+
+    def _stream_unexpected_rows(self, query, engine):
+        """
+        Yields the rows of an unexpected_rows_query as lists of dicts of at most
+        settings.export_chunk_rows rows, so a check failing on millions of rows
+        never sits in memory all at once.
+        """
+        chunk_rows = int(self.settings.get('export_chunk_rows', 50000))
+        raw_conn = engine.raw_connection()
+        finished = False
+        try:
+            if engine.dialect.driver == "mysqlconnector":
+                # Unbuffered cursor: rows stay on the server until they are fetched
+                cursor = raw_conn.cursor(buffered=False)
             else:
-                # Default GX behavior
-                unexpected_list = result_obj.result.get("unexpected_list", [])
-                unexpected_rows = result_obj.result.get("unexpected_rows")
-                if unexpected_rows is None:
-                    unexpected_rows = result_obj.result.get("details", {}).get("unexpected_rows", [])
-                
-                if unexpected_list:
-                    unexpected_items = unexpected_list
-                else:
-                    unexpected_items = unexpected_rows or []
-
-            def _build_row(item):
-                row = {
-                    "lender_name": lender_id,
-                    "table_name": table_name,
-                    "test_name": test_name
-                }
-                
-                # Dynamic PK columns
-                if isinstance(item, dict):
-                    for pk in primary_keys:
-                        val = item.get(pk)
-                        row[pk] = str(val) if val is not None else "N/A"
-                else:
-                    row["raw_item"] = str(item)
-                
-                row["expected_value"] = description if description != 'Pass Expectation' else "0 rows returned"
+                cursor = raw_conn.cursor()
+            try:
+                if engine.dialect.name == "mysql":
+                    # A slow reader keeps the statement running; exports get their own limit
+                    export_ms = int(float(self.settings.get('export_timeout_seconds') or 0) * 1000)
+                    cursor.execute(f"SET SESSION max_execution_time = {export_ms}")
+                rewrite = self._query_rewriters.get(engine)
+                cursor.execute(rewrite(query) if rewrite else query)
+                columns = [col[0] for col in cursor.description]
+                while True:
+                    batch = cursor.fetchmany(chunk_rows)
+                    if not batch:
+                        break
+                    yield [dict(zip(columns, values)) for values in batch]
+                if engine.dialect.name == "mysql":
+                    default_ms = int(float(self.settings.get('query_timeout_seconds') or 0) * 1000)
+                    cursor.execute(f"SET SESSION max_execution_time = {default_ms}")
+                finished = True
+            finally:
+                if finished:
+                    cursor.close()
+        finally:
+            if finished:
+                raw_conn.close()
+            else:
+                # An unbuffered cursor abandoned mid-result can't go back to the pool
+                raw_conn.invalidate()
+
+    def _write_failed_rows(self, lender_id, table_name, test_name, item_batches, primary_keys, description,
+                           complete=True):
+        """
+        Writes failed rows in the configured format (settings.failed_rows_format).
+        Returns the number of rows written (for the delta store: new plus resolved rows).
+        """
+        with self.profiler.phase("export", lender_id, table_name, test_name) as timing:
+            if self.failed_row_store is not None:
+                new_rows, resolved_rows, _ = self.failed_row_store.apply(
+                    self.run_id, lender_id, table_name, test_name, primary_keys, item_batches, complete=complete
+                )
+                rows_written, bytes_written = new_rows + resolved_rows, None
+            elif self.failed_rows_format == "parquet":
+                rows_written, bytes_written = parquet_export.write_failed_rows(
+                    self.run_id, lender_id, table_name, test_name, item_batches,
+                    compression=self.settings.get('parquet_compression', 'zstd')
+                )
+            else:
+                rows_written, bytes_written = self._write_failure_csv(
+                    lender_id, table_name, test_name, item_batches, primary_keys, description
+                )
+            timing['rows'] = rows_written
+            timing['bytes'] = bytes_written
+        return rows_written
+
+    def _write_failure_csv(self, lender_id, table_name, test_name, item_batches, primary_keys, description):
+        """
+        Writes failed rows to the CSV batch by batch.
+        The file is only created once the first row arrives.
+        Returns (rows written, bytes written).
+        """
+        # Create directory if not exists
+        output_dir = "failed_rows"
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Sanitize filename components
+        safe_test_name = "".join([c if c.isalnum() else "_" for c in test_name])
+        filename = f"{lender_id}_{table_name}_{safe_test_name}_{timestamp}.csv"
+        filepath = os.path.join(output_dir, filename)
+
+        expected_value = description if description != 'Pass Expectation' else "0 rows returned"
+
+        def _build_row(item):
+            row = {
+                "lender_name": lender_id,
+                "table_name": table_name,
+                "test_name": test_name
+            }
+            
+            # Dynamic PK columns
+            if isinstance(item, dict):
+                for pk in primary_keys:
+                    val = item.get(pk)
+                    row[pk] = str(val) if val is not None else "N/A"
+            else:
+                row["raw_item"] = str(item)
+            
+            row["expected_value"] = expected_value
+            
+            # Refine actual_value
+            if isinstance(item, dict):
+                # Filter out PKs to find the "actual value" content
+                actual_content = {k: v for k, v in item.items() if k not in primary_keys}
                 
-                # Refine actual_value
-                if isinstance(item, dict):
-                    # Filter out PKs to find the "actual value" content
-                    actual_content = {k: v for k, v in item.items() if k not in primary_keys}
-                    
-                    if len(actual_content) == 1:
-                        row["actual_value"] = str(list(actual_content.values())[0])
-                    else:
-                        row["actual_value"] = str(actual_content)
+                if len(actual_content) == 1:
+                    row["actual_value"] = str(list(actual_content.values())[0])
                 else:
-                    row["actual_value"] = str(item)
-                
-                return row
+                    row["actual_value"] = str(actual_content)
+            else:
+                row["actual_value"] = str(item)
+            
+            return row
 
-            for item in unexpected_items:
-                rows_to_save.append(_build_row(item))
+        # Define column order: Context -> PKs -> Expected -> Actual
+        cols = ["lender_name", "table_name", "test_name"] + primary_keys + ["expected_value", "actual_value"]
 
-            if rows_to_save:
-                df_fail = pd.DataFrame(rows_to_save)
-                
-                # Define column order: Context -> PKs -> Expected -> Actual
-                cols = ["lender_name", "table_name", "test_name"] + primary_keys + ["expected_value", "actual_value"]
-                
-                # Ensure all columns exist
-                for c in cols:
-                    if c not in df_fail.columns:
-                        df_fail[c] = "N/A"
-                
-                # Select only relevant columns
-                df_fail = df_fail[cols]
-                
-                df_fail.to_csv(filepath, index=False)
-                logger.info(f"Generated failure report: {filepath}")
-        
-        except Exception as e:
-            logger.error(f"Failed to generate CSV for {test_name}: {e}")
\ No newline at end of file
+        csv_file = None
+        rows_written = 0
+        bytes_written = 0
+        try:
+            for batch in item_batches:
+                for item in batch:
+                    if csv_file is None:
+                        csv_file = open(filepath, 'w', newline='', encoding='utf-8')
+                        # Missing columns are filled with N/A, anything else is dropped
+                        writer = csv.DictWriter(
+                            csv_file, fieldnames=cols, restval="N/A", extrasaction='ignore', lineterminator=os.linesep
+                        )
+                        writer.writeheader()
+                    writer.writerow(_build_row(item))
+                    rows_written += 1
+        finally:
+            if csv_file is not None:
+                csv_file.close()
+                bytes_written = os.path.getsize(filepath)
+
+        if rows_written:
+            logger.info(f"Generated failure report: {filepath} ({rows_written} rows)")
+        return rows_written, bytes_written
@@ -0,0 +1,194 @@
+"""
+Background validation jobs for the dashboard.
+
+A job is one "Run Diagnostics" request (lenders x tables). It is queued on a
+thread pool shared by every dashboard session, gets a job id, and fills in its
+results table by table, so the page can show progress and partial results
+while it runs and survives reruns of the Streamlit script.
+
+Load is shared instead of duplicated:
+  - submitting a request identical to a running job returns that job's id;
+  - a (lender, table, engine, depth) unit already running for another job is not
+    run again, its result is reused when it finishes.
+
+Each job runs on its own view of the shared runner (GXRunner.for_run): same
+engines and result cache, but its own run_id (profile, Parquet folder and
+results-store run) and lender time budgets. Each lender's tables run one after
+another on one worker (run_validation already runs a table's checks
+concurrently), different lenders in parallel.
+The statuses of a lender's finished tables are passed on to its next ones, so a
+rule depending on a failed rule of an earlier table is SKIPPED.
+"""
+import time
+import uuid
+import logging
+import datetime
+import threading
+import concurrent.futures
+
+import pandas as pd
+
+from src import rule_registry
+
+logger = logging.getLogger('dq_engine')
+
+# Finished jobs kept for sessions that still show them
+MAX_FINISHED_JOBS = 20
+
+
+class ValidationJob:
+    def __init__(self, job_id, lenders, tables, check_engine, refresh, depth=None):
+        self.job_id = job_id
+        self.lenders = lenders
+        self.tables = tables
+        self.check_engine = check_engine
+        self.refresh = refresh
+        self.depth = depth
+        self.submitted_at = datetime.datetime.now()
+        self.run_id = f"{self.submitted_at.strftime('%Y%m%d_%H%M%S')}_{job_id[:6]}"
+        # Set by JobManager.submit: the shared runner's view for this run
+        self.runner = None
+        self.finished_at = None
+        self.status = "QUEUED"
+        self.error = None
+        self.units = [(lender_id, table_name) for lender_id in lenders for table_name in tables]
+        # (lender, table) -> "QUEUED" | "RUNNING" | "DONE" | "FAILED"
+        self.unit_status = {unit: "QUEUED" for unit in self.units}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        return (tuple(self.lenders), tuple(self.tables), self.check_engine, self.depth)
+
+    @property
+    def done(self):
+        return self.status in ("COMPLETED", "FAILED")
+
+    def progress(self):
+        """(finished units, total units)"""
+        with self._lock:
+            finished = sum(1 for status in self.unit_status.values() if status in ("DONE", "FAILED"))
+        return finished, len(self.units)
+
+    def results(self):
+        """Results of the units finished so far, in submission order."""
+        with self._lock:
+            frames = [self._results[unit] for unit in self.units if unit in self._results]
+        frames = [frame for frame in frames if frame is not None and not frame.empty]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def _set_unit(self, unit, status, results_df=None):
+        with self._lock:
+            self.unit_status[unit] = status
+            if results_df is not None:
+                self._results[unit] = results_df
+
+
+class JobManager:
+    def __init__(self, runner, max_workers=4, results_store=None):
+        self.runner = runner
+        self.results_store = results_store
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dq-job")
+        self._jobs = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def submit(self, lenders, tables, check_engine, refresh=False, depth=None):
+        """
+        Queues a run and returns (job_id, joined). joined is True when an identical
+        run was already in progress and its id is returned instead.
+        """
+        job = ValidationJob(uuid.uuid4().hex[:12], list(lenders), list(tables), check_engine, refresh, depth)
+        with self._lock:
+            if not refresh:
+                for existing in self._jobs.values():
+                    if not existing.done and existing.key == job.key:
+                        return existing.job_id, True
+            self._jobs[job.job_id] = job
+            self._prune()
+
+        job.runner = self.runner.for_run(job.run_id)
+        job.status = "RUNNING"
+        lender_futures = [self._executor.submit(self._run_lender, job, lender_id) for lender_id in job.lenders]
+        # Completion bookkeeping runs off the request thread as well
+        threading.Thread(
+            target=self._finish_job, args=(job, lender_futures), name=f"dq-job-{job.job_id}", daemon=True
+        ).start()
+        logger.info(f"Queued validation job {job.job_id}: {len(job.lenders)} lender(s) x {len(job.tables)} table(s).")
+        return job.job_id, False
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def active_jobs(self):
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.done]
+
+    def _prune(self):
+        finished = sorted((job for job in self._jobs.values() if job.done), key=lambda job: job.finished_at)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.job_id]
+
+    def _run_lender(self, job, lender_id):
+        # One wall-clock budget for all of this lender's tables, as in the daily job
+        budget = job.runner.lender_time_budget(lender_id)
+        deadline = time.time() + budget if budget else None
+        gate_status = {}
+        for table_name in job.tables:
+            unit = (lender_id, table_name)
+            job._set_unit(unit, "RUNNING")
+            try:
+                results_df = self._run_unit(job, lender_id, table_name, deadline, gate_status)
+                gate_status.update(rule_registry.rule_statuses(results_df))
+                job._set_unit(unit, "DONE", results_df)
+            except Exception as e:
+                logger.error(f"Job {job.job_id}: {lender_id} / {table_name} failed: {e}")
+                job._set_unit(unit, "FAILED")
+
+    def _run_unit(self, job, lender_id, table_name, deadline, gate_status=None):
+        """Runs one (lender, table), or waits for the identical unit another job is running."""
+        key = (lender_id, table_name, job.check_engine, job.depth)
+        with self._lock:
+            shared = None if job.refresh else self._inflight.get(key)
+            if shared is None:
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+        if shared is not None:
+            logger.info(f"Job {job.job_id}: reusing the in-flight run of {lender_id} / {table_name}.")
+            return shared.result()
+
+        try:
+            results_df = job.runner.run_validation(
+                lender_id, specific_table=table_name, check_engine=job.check_engine,
+                deadline=deadline, refresh=job.refresh, depth=job.depth, gate_status=dict(gate_status or {})
+            )
+            future.set_result(results_df)
+            return results_df
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+
+    def _finish_job(self, job, lender_futures):
+        concurrent.futures.wait(lender_futures)
+        errors = [f.exception() for f in lender_futures if f.exception() is not None]
+        job.error = str(errors[0]) if errors else None
+
+        # Recorded before the job reports done, so "last recorded run" already includes it
+        results_df = job.results()
+        if self.results_store is not None and not results_df.empty:
+            try:
+                self.results_store.start_run(job.run_id, "dashboard")
+                self.results_store.record_results(job.run_id, results_df)
+                self.results_store.finish_run(job.run_id)
+            except Exception as e:
+                logger.error(f"Could not record job {job.job_id} in the results store: {e}")
+
+        job.finished_at = datetime.datetime.now()
+        job.status = "FAILED" if errors else "COMPLETED"
+        logger.info(f"Validation job {job.job_id} {job.status.lower()} ({len(results_df)} results).")
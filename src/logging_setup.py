@@ -0,0 +1,21 @@
+"""
+Logging configuration for the entry points (daily job, scheduler, CLI, dashboard).
+
+Importing a module of the engine no longer configures logging; each entry point
+calls configure_logging() once, and worker processes call it as their pool
+initializer (on Windows they start fresh and inherit nothing).
+"""
+import os
+import logging.config
+
+_configured = False
+
+
+def configure_logging(config_path="config/logging.conf", log_dir="logs"):
+    """Applies config/logging.conf once per process (later calls do nothing)."""
+    global _configured
+    if _configured:
+        return
+    os.makedirs(log_dir, exist_ok=True)
+    logging.config.fileConfig(config_path)
+    _configured = True
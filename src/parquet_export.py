@@ -0,0 +1,171 @@
+"""
+Parquet output for failed rows (settings.failed_rows_format: parquet).
+
+Rows keep their database types instead of being stringified for the CSV.
+Files are laid out as hive-style partitions, one folder per run:
+
+    failed_rows/parquet/run=<run_id>/lender=<lender>/table=<table>/test=<test>/part-0.parquet
+    failed_rows/parquet/run=<run_id>/_manifest.json
+
+Each process appends its files to its own manifest part per lender
+(_manifest_parts/<lender>.<pid>.jsonl); finalize_run_manifest() merges the parts
+into a single _manifest.json for the run (the leading underscore keeps it out of
+pyarrow dataset discovery). A test exported again in the same run (a re-run unit,
+or the dashboard's long-lived runner) replaces its file, and the manifest keeps
+only the latest entry for it.
+"""
+import os
+import json
+import glob
+import logging
+import datetime
+import threading
+
+logger = logging.getLogger('dq_engine')
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+PARQUET_ROOT = os.path.join("failed_rows", "parquet")
+
+_manifest_lock = threading.Lock()
+
+
+def parquet_available():
+    return pa is not None
+
+
+def get_run_dir(run_id, root=PARQUET_ROOT):
+    return os.path.join(root, f"run={run_id}")
+
+
+def _safe_name(value):
+    return "".join([c if c.isalnum() or c in "-_" else "_" for c in str(value)])
+
+
+def _normalise_schema(schema):
+    """
+    Widens types inferred from the first chunk so later chunks still fit:
+    all-NULL columns become strings and decimals get the maximum precision.
+    """
+    fields = []
+    for field in schema:
+        if pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        elif pa.types.is_decimal(field.type):
+            field = field.with_type(pa.decimal128(38, field.type.scale))
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def write_failed_rows(run_id, lender_id, table_name, test_name, item_batches, compression="zstd", root=PARQUET_ROOT):
+    """
+    Streams batches of failed rows into one Parquet file and records it in the run manifest.
+    Items that are not dicts (GX unexpected_list values) are stored in a single 'value' column.
+    Returns (rows written, bytes written).
+    """
+    if pa is None:
+        raise ImportError("pyarrow is required for failed_rows_format: parquet")
+
+    run_path = get_run_dir(run_id, root)
+    part_dir = os.path.join(
+        run_path,
+        f"lender={_safe_name(lender_id)}",
+        f"table={_safe_name(table_name)}",
+        f"test={_safe_name(test_name)}"
+    )
+    filepath = os.path.join(part_dir, "part-0.parquet")
+    # Written under a hidden name (ignored by dataset discovery) and swapped in when complete
+    tmp_path = os.path.join(part_dir, f".part-0.parquet.{os.getpid()}.{threading.get_ident()}.tmp")
+
+    writer = None
+    schema = None
+    rows_written = 0
+    try:
+        for batch in item_batches:
+            rows = [item if isinstance(item, dict) else {"value": item} for item in batch]
+            if not rows:
+                continue
+            if writer is None:
+                schema = _normalise_schema(pa.Table.from_pylist(rows).schema)
+                os.makedirs(part_dir, exist_ok=True)
+                writer = pq.ParquetWriter(tmp_path, schema, compression=compression)
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            rows_written += len(rows)
+    except Exception:
+        if writer is not None:
+            writer.close()
+            os.remove(tmp_path)
+        raise
+    if writer is not None:
+        writer.close()
+        os.replace(tmp_path, filepath)
+
+    bytes_written = 0
+    if rows_written:
+        bytes_written = os.path.getsize(filepath)
+        _append_manifest_entry(run_path, lender_id, {
+            "path": os.path.relpath(filepath, run_path).replace(os.sep, "/"),
+            "lender": lender_id,
+            "table": table_name,
+            "test": test_name,
+            "rows": rows_written,
+            "bytes": bytes_written,
+            "schema": [{"name": f.name, "type": str(f.type)} for f in schema],
+            "written_at": datetime.datetime.now().isoformat(timespec="microseconds")
+        })
+        logger.info(f"Generated failure parquet: {filepath} ({rows_written} rows)")
+    return rows_written, bytes_written
+
+
+def _append_manifest_entry(run_path, lender_id, entry):
+    parts_dir = os.path.join(run_path, "_manifest_parts")
+    os.makedirs(parts_dir, exist_ok=True)
+    # A lender's units run in several processes; each appends to its own part
+    part_path = os.path.join(parts_dir, f"{_safe_name(lender_id)}.{os.getpid()}.jsonl")
+    with _manifest_lock:
+        with open(part_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def finalize_run_manifest(run_id, root=PARQUET_ROOT):
+    """
+    Merges every manifest part of a run (all lenders and processes) into run=<run_id>/_manifest.json.
+    Safe to call repeatedly; the file is replaced atomically.
+    Returns the manifest path, or None if the run wrote no Parquet files.
+    """
+    run_path = get_run_dir(run_id, root)
+    part_paths = sorted(glob.glob(os.path.join(run_path, "_manifest_parts", "*.jsonl")))
+    if not part_paths:
+        return None
+
+    records = []
+    for part_path in part_paths:
+        with open(part_path, 'r', encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    # A file written twice in the run was replaced; its latest entry (possibly from
+    # another process's part) describes it
+    entries = {}
+    for entry in sorted(records, key=lambda entry: entry["written_at"]):
+        entries[entry["path"]] = entry
+    files = sorted(entries.values(), key=lambda entry: entry["path"])
+
+    manifest = {
+        "run_id": run_id,
+        "generated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "file_count": len(files),
+        "total_rows": sum(entry["rows"] for entry in files),
+        "total_bytes": sum(entry["bytes"] for entry in files),
+        "files": files
+    }
+
+    manifest_path = os.path.join(run_path, "_manifest.json")
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest_path
@@ -0,0 +1,119 @@
+"""
+Timing instrumentation for validation runs (settings.profiling).
+
+Every timed phase is appended as one JSON line to
+logs/profile/run=<run_id>/<lender>.<pid>.jsonl (one file per process, since a
+lender's units run in several worker processes; load_run merges them), e.g.
+
+    {"run_id": "20260317_020000", "lender": "lender_a", "table": "v73__loan_details",
+     "rule": "check_apr_range", "phase": "query", "status": "ok",
+     "started_at": "2026-03-17T02:00:04", "duration_s": 1.942, "rows": 12, "bytes": null}
+
+Phases: connect, fingerprint, metadata (row counts/sizes of a lender's tables),
+watermark, gx_context, suite_build, checkpoint,
+parse, query (count-first rule), fused_query (one scan shared by several rules)
+and export (failed-row download + file write, with rows and bytes written).
+parse includes the exports of the GX rules it reports on.
+"""
+import os
+import json
+import glob
+import time
+import datetime
+import threading
+import contextlib
+
+import pandas as pd
+
+PROFILE_ROOT = os.path.join("logs", "profile")
+
+# Phases that belong to a single check (or a shared scan) rather than to the run or table setup
+CHECK_PHASES = ("query", "fused_query", "checkpoint", "export")
+
+
+def _safe_name(value):
+    return "".join([c if c.isalnum() or c in "-_" else "_" for c in str(value)])
+
+
+def get_run_dir(run_id, root=PROFILE_ROOT):
+    return os.path.join(root, f"run={run_id}")
+
+
+class Profiler:
+    def __init__(self, run_id, root=PROFILE_ROOT, enabled=True):
+        self.run_id = run_id
+        self.root = root
+        self.enabled = enabled
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, phase, lender, table=None, rule=None):
+        """
+        Times the enclosed block. The yielded dict can be filled with
+        'rows' / 'bytes' counters before the block ends.
+        """
+        counters = {"rows": None, "bytes": None}
+        started_at = datetime.datetime.now().isoformat(timespec="seconds")
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            yield counters
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            if self.enabled:
+                self._emit({
+                    "run_id": self.run_id,
+                    "lender": lender,
+                    "table": table,
+                    "rule": rule,
+                    "phase": phase,
+                    "status": status,
+                    "started_at": started_at,
+                    "duration_s": round(time.perf_counter() - start, 4),
+                    "rows": counters["rows"],
+                    "bytes": counters["bytes"]
+                })
+
+    def _emit(self, record):
+        run_dir = get_run_dir(self.run_id, self.root)
+        path = os.path.join(run_dir, f"{_safe_name(record['lender'])}.{os.getpid()}.jsonl")
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            os.makedirs(run_dir, exist_ok=True)
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+
+def load_run(run_id, root=PROFILE_ROOT):
+    """All timing records of a run (every lender and process) as a DataFrame."""
+    records = []
+    for path in sorted(glob.glob(os.path.join(get_run_dir(run_id, root), "*.jsonl"))):
+        with open(path, 'r', encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return pd.DataFrame(records)
+
+
+def slowest_checks(run_id, n=10, root=PROFILE_ROOT):
+    """The n slowest check-level phases of a run, slowest first."""
+    timings = load_run(run_id, root)
+    if timings.empty:
+        return timings
+    timings = timings[timings['phase'].isin(CHECK_PHASES)]
+    cols = ['lender', 'table', 'rule', 'phase', 'duration_s', 'rows', 'bytes', 'status']
+    return timings.sort_values('duration_s', ascending=False).head(n)[cols].reset_index(drop=True)
+
+
+def phase_totals(run_id, root=PROFILE_ROOT):
+    """Total time, call count and rows/bytes per phase for a run."""
+    timings = load_run(run_id, root)
+    if timings.empty:
+        return timings
+    return (
+        timings.groupby('phase')
+        .agg(calls=('duration_s', 'size'), total_s=('duration_s', 'sum'), max_s=('duration_s', 'max'),
+             rows=('rows', 'sum'), bytes=('bytes', 'sum'))
+        .sort_values('total_s', ascending=False)
+        .reset_index()
+    )
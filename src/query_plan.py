@@ -0,0 +1,309 @@
+"""
+Query plan review of the SQL rules (`python -m src.cli plan`).
+
+Runs `EXPLAIN FORMAT=JSON` for every unexpected_rows_query on each lender and
+reports, per rule:
+
+    query_cost          - the optimizer's cost estimate
+    rows_examined_est   - rows read across all tables, from rows_examined_per_scan
+                          times the number of scans (the rows produced before it
+                          in a nested-loop join, or once with a join buffer)
+    full_scans          - tables read in full (access_type ALL) with at least
+                          settings.plan_scan_rows_threshold rows per scan
+    unindexed_joins     - joined tables read without an index (ALL, or a join buffer)
+    full_index_scans    - whole-index reads (access_type index)
+    temporary_tables, filesorts, dependent_subqueries
+    suggested_indexes   - CREATE INDEX statements for the scanned tables: equality
+                          columns of their conditions first, then one range column,
+                          then the other columns the query reads from the table if
+                          that keeps the index within plan_covering_max_columns
+                          (a covering index)
+
+Rules with any of those problems get the verdict REVIEW. Suggestions come from
+the plan's attached conditions only; check them against the table's existing
+indexes and write load before creating them. MySQL's JSON format is read in
+full, MariaDB's (block-nl-join, filesort, temporary_table nodes) in part;
+other databases are reported as ERROR.
+"""
+import re
+import json
+import logging
+
+import pandas as pd
+import sqlalchemy
+
+logger = logging.getLogger('dq_engine')
+
+# Real table names behind the aliases of a rule's FROM/JOIN clauses
+_TABLE_ALIAS = re.compile(
+    r"\b(?:FROM|JOIN)\s+([`\w.]+)(?:\s+(?:AS\s+)?(?!(?:WHERE|ON|USING|JOIN|LEFT|RIGHT|INNER|OUTER|CROSS|STRAIGHT_JOIN|"
+    r"GROUP|ORDER|HAVING|LIMIT|UNION|WINDOW|NATURAL|FOR|LOCK)\b)(\w+))?",
+    re.IGNORECASE
+)
+# `schema`.`alias`.`column` or `alias`.`column` followed by its operator in an attached condition
+_PREDICATE = r"(?:`[^`]+`\.)?`{alias}`\.`(\w+)`\s*(<=>|<>|!=|<=|>=|<|>|=|not\s+in\b|in\s*\(|is\s+not\s+null|is\s+null|between\b|not\s+like\b|like\s+'[^%_])"
+# `other`.`column` = `alias`.`column`: a join equality written the other way round
+_REVERSED_EQUALITY = r"=\s*(?:`[^`]+`\.)?`{alias}`\.`(\w+)`"
+_EQUALITY_OPERATORS = ("=", "<=>", "in", "is null")
+_RANGE_OPERATORS = ("<", ">", "<=", ">=", "between", "like")
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def table_aliases(sql):
+    """{alias: table} for the FROM/JOIN clauses of a query; a table without an alias maps to itself."""
+    aliases = {}
+    for table, alias in _TABLE_ALIAS.findall(sql):
+        if table.startswith("("):
+            continue
+        table = table.replace("`", "")
+        short_name = table.split(".")[-1]
+        aliases[alias or short_name] = table
+    return aliases
+
+
+def _predicate_columns(condition, alias):
+    """(equality columns, range columns) of `alias` that an index could seek on, in order of appearance."""
+    equality, ranges = [], []
+    if not condition:
+        return equality, ranges
+    for column, operator in re.findall(_PREDICATE.format(alias=re.escape(alias)), condition, re.IGNORECASE):
+        operator = re.sub(r"\s+", " ", operator.lower()).rstrip("( ")
+        if operator.startswith("like"):
+            operator = "like"
+        if operator in _EQUALITY_OPERATORS and column not in equality:
+            equality.append(column)
+        elif operator in _RANGE_OPERATORS and column not in ranges:
+            ranges.append(column)
+    for column in re.findall(_REVERSED_EQUALITY.format(alias=re.escape(alias)), condition, re.IGNORECASE):
+        if column not in equality:
+            equality.append(column)
+    return equality, [c for c in ranges if c not in equality]
+
+
+def suggest_index(table_name, alias, condition, used_columns, covering_max_columns=5):
+    """A CREATE INDEX statement for a scanned table, or None if its condition has nothing to seek on."""
+    equality, ranges = _predicate_columns(condition, alias)
+    columns = equality + ranges[:1]
+    if not columns:
+        return None
+    covering = columns + [c for c in used_columns or () if c not in columns]
+    if len(covering) <= covering_max_columns:
+        columns = covering
+    # MySQL names are at most 64 characters: keep as many leading columns as fit
+    name = f"ix_{table_name.split('.')[-1]}"[:64]
+    for column in columns:
+        if len(name) + 1 + len(column) > 64:
+            break
+        name = f"{name}_{column}"
+    return f"CREATE INDEX {name} ON {table_name} ({', '.join(columns)})"
+
+
+def _query_cost(block):
+    cost = _number((block.get('cost_info') or {}).get('query_cost'))
+    if cost is not None:
+        return cost
+    # UNION: the sum of its parts
+    specs = (block.get('union_result') or {}).get('query_specifications') or []
+    costs = [_query_cost(spec.get('query_block') or {}) for spec in specs]
+    costs = [c for c in costs if c is not None]
+    return sum(costs) if costs else None
+
+
+def analyze_plan(plan, sql, scan_rows_threshold=100000, covering_max_columns=5):
+    """The findings (see the module docstring) for one EXPLAIN FORMAT=JSON document."""
+    findings = {
+        "query_cost": _query_cost(plan.get('query_block') or {}),
+        "rows_examined_est": 0.0,
+        "full_scans": [],
+        "unindexed_joins": [],
+        "full_index_scans": [],
+        "temporary_tables": 0,
+        "filesorts": 0,
+        "dependent_subqueries": 0,
+        "suggested_indexes": [],
+    }
+    context = {
+        "aliases": table_aliases(sql),
+        "scan_rows_threshold": scan_rows_threshold,
+        "covering_max_columns": covering_max_columns,
+    }
+    _visit(plan, findings, context)
+    findings['rows_examined_est'] = int(findings['rows_examined_est'])
+    return findings
+
+
+def _visit(node, findings, context):
+    if isinstance(node, list):
+        for item in node:
+            _visit(item, findings, context)
+        return
+    if not isinstance(node, dict):
+        return
+
+    if node.get('using_temporary_table') is True or isinstance(node.get('temporary_table'), dict):
+        findings['temporary_tables'] += 1
+    if node.get('using_filesort') is True or isinstance(node.get('filesort'), dict):
+        findings['filesorts'] += 1
+    if node.get('dependent') is True:
+        findings['dependent_subqueries'] += 1
+
+    if isinstance(node.get('nested_loop'), list):
+        _visit_join(node['nested_loop'], findings, context)
+    elif isinstance(node.get('table'), dict):
+        _visit_join([{"table": node['table']}], findings, context)
+    for key, value in node.items():
+        if key not in ("nested_loop", "table"):
+            _visit(value, findings, context)
+
+
+def _visit_join(items, findings, context):
+    """One nested-loop join (or a single table), in join order."""
+    prefix_rows = 1.0
+    for position, item in enumerate(items):
+        join_buffer = False
+        table = item.get('table') if isinstance(item, dict) else None
+        if table is None and isinstance(item, dict) and isinstance(item.get('block-nl-join'), dict):
+            # MariaDB
+            table, join_buffer = item['block-nl-join'].get('table'), True
+        if not isinstance(table, dict):
+            _visit(item, findings, context)
+            continue
+        join_buffer = join_buffer or bool(table.get('using_join_buffer'))
+
+        rows_per_scan = _number(table.get('rows_examined_per_scan', table.get('rows'))) or 0.0
+        scans = 1.0 if position == 0 or join_buffer else max(prefix_rows, 1.0)
+        findings['rows_examined_est'] += rows_per_scan * scans
+        produced = _number(table.get('rows_produced_per_join'))
+        if produced is None:
+            produced = prefix_rows * rows_per_scan * (_number(table.get('filtered')) or 100.0) / 100
+        prefix_rows = produced
+
+        _check_access(table, position > 0, join_buffer, rows_per_scan, findings, context)
+        for value in table.values():
+            if isinstance(value, (dict, list)):
+                _visit(value, findings, context)
+
+
+def _check_access(table, joined, join_buffer, rows_per_scan, findings, context):
+    alias = table.get('table_name') or "?"
+    access_type = (table.get('access_type') or "").upper()
+    # <derived2>, <union1,2>, <subquery3>: temporary results, not indexable tables
+    materialized = alias.startswith("<")
+    label = f"{alias} ({int(rows_per_scan):,} rows)"
+
+    if access_type == "ALL":
+        if joined:
+            findings['unindexed_joins'].append(label)
+        elif rows_per_scan >= context['scan_rows_threshold']:
+            findings['full_scans'].append(label)
+        else:
+            return
+    elif access_type == "INDEX" and rows_per_scan >= context['scan_rows_threshold']:
+        findings['full_index_scans'].append(label)
+        return
+    elif joined and join_buffer:
+        findings['unindexed_joins'].append(label)
+    else:
+        return
+
+    if materialized:
+        return
+    statement = suggest_index(
+        context['aliases'].get(alias, alias), alias, table.get('attached_condition'), table.get('used_columns'),
+        context['covering_max_columns']
+    )
+    if statement and statement not in findings['suggested_indexes']:
+        findings['suggested_indexes'].append(statement)
+
+
+class PlanAdvisor:
+    def __init__(self, runner):
+        self.runner = runner
+        settings = runner.settings
+        self.scan_rows_threshold = int(settings.get('plan_scan_rows_threshold', 100000))
+        self.covering_max_columns = int(settings.get('plan_covering_max_columns', 5))
+
+    def _row(self, lender_id, table_name, exp_config, **values):
+        row = {
+            "lender": lender_id,
+            "table": table_name,
+            "rule_name": exp_config.get('name'),
+            "severity": exp_config['meta'].get('severity', 'warning'),
+            "verdict": "OK",
+            "query_cost": None,
+            "rows_examined_est": None,
+            "full_scans": "",
+            "unindexed_joins": "",
+            "full_index_scans": "",
+            "temporary_tables": None,
+            "filesorts": None,
+            "dependent_subqueries": None,
+            "suggested_indexes": "",
+            "error_msg": "",
+        }
+        row.update(values)
+        return row
+
+    def explain_lender(self, lender_id, selection=None):
+        """One report row per SQL rule of the lender (limited to `selection`, {table: [rule names]})."""
+        runner = self.runner
+        rules = [
+            (table_name, exp_config)
+            for table_name in runner.registry.tables
+            if selection is None or table_name in selection
+            for exp_config in runner.registry.lender_rules(lender_id, table_name)
+            if exp_config['type'] == "unexpected_rows_expectation"
+            and (selection is None or exp_config.get('name') in selection[table_name])
+        ]
+        if not rules:
+            return []
+        try:
+            engine = runner._get_engine(lender_id)
+        except Exception as e:
+            return [self._row(lender_id, t, r, verdict="ERROR", error_msg=f"Connection failed: {e}") for t, r in rules]
+        if engine.dialect.name != "mysql":
+            message = f"EXPLAIN FORMAT=JSON needs MySQL or MariaDB (lender uses {engine.dialect.name})"
+            return [self._row(lender_id, t, r, verdict="ERROR", error_msg=message) for t, r in rules]
+
+        rows = []
+        for table_name, exp_config in rules:
+            try:
+                timeout = runner._query_timeout(lender_id, exp_config)
+                with engine.connect() as conn, runner._watchdog(engine, conn.connection, lender_id, timeout):
+                    raw = conn.execute(sqlalchemy.text(f"EXPLAIN FORMAT=JSON {exp_config['sql']}")).scalar()
+                findings = analyze_plan(json.loads(raw), exp_config['sql'], self.scan_rows_threshold,
+                                        self.covering_max_columns)
+            except Exception as e:
+                logger.warning(f"[{lender_id}] [{table_name}] Could not explain {exp_config.get('name')}: {e}")
+                rows.append(self._row(lender_id, table_name, exp_config, verdict="ERROR", error_msg=str(e)[:2000]))
+                continue
+            problems = (findings['full_scans'] or findings['unindexed_joins'] or findings['dependent_subqueries']
+                        or ((findings['filesorts'] or findings['temporary_tables'])
+                            and findings['rows_examined_est'] >= self.scan_rows_threshold))
+            rows.append(self._row(
+                lender_id, table_name, exp_config,
+                verdict="REVIEW" if problems else "OK",
+                **{key: "; ".join(value) if isinstance(value, list) else value for key, value in findings.items()}
+            ))
+        return rows
+
+    def report(self, lenders, selection=None):
+        """Every lender's rows as one DataFrame, REVIEW first, then by rows examined."""
+        rows = []
+        for lender_id in lenders:
+            try:
+                rows.extend(self.explain_lender(lender_id, selection))
+            finally:
+                self.runner.dispose_engines(lender_id)
+        df = pd.DataFrame(rows)
+        if df.empty:
+            return df
+        df['_order'] = df['verdict'].map({"REVIEW": 0, "ERROR": 1, "OK": 2})
+        df = df.sort_values(['_order', 'rows_examined_est'], ascending=[True, False], na_position='last')
+        return df.drop(columns='_order').reset_index(drop=True)
@@ -0,0 +1,59 @@
+"""
+In-memory cache of per-table validation results (GXRunner(cache_results=True)).
+
+Entries are keyed by (lender, table, rules_hash, check_engine, count_first,
+rule_names, depth) and hold the result rows together with the table-change
+fingerprint taken before the checks ran (see GXRunner._table_fingerprints;
+for tables with rules that read the clock it includes a time bucket).
+A later run of the same table is served from the cache only while the
+fingerprint is unchanged and the entry is younger than
+settings.result_cache_ttl_seconds. At most settings.result_cache_max_entries
+entries are kept, least recently used first out.
+"""
+import time
+import threading
+import collections
+
+
+class ResultCache:
+    def __init__(self, max_entries=500, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, fingerprint):
+        """The cached DataFrame for key, or None if missing, expired or the table changed."""
+        if fingerprint is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_fingerprint, stored_at, results_df = entry
+            if stored_fingerprint != fingerprint or (
+                self.ttl_seconds and time.monotonic() - stored_at > self.ttl_seconds
+            ):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return results_df.copy()
+
+    def put(self, key, fingerprint, results_df):
+        if fingerprint is None or results_df is None or results_df.empty:
+            return
+        with self._lock:
+            self._entries[key] = (fingerprint, time.monotonic(), results_df.copy())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, lender_id=None, table_name=None):
+        """Drops every entry, or those of one lender and/or table."""
+        with self._lock:
+            for key in list(self._entries):
+                if (lender_id is None or key[0] == lender_id) and (table_name is None or key[1] == table_name):
+                    del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
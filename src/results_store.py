@@ -0,0 +1,250 @@
+"""
+Persistent store for validation results (settings.results_db).
+
+Every run of daily_job.py or the dashboard is recorded in a local SQLite file,
+one row per (run, lender, table, rule), so reports and the dashboard can read
+past results instead of re-running validation:
+
+    runs    - run_id, source, started_at, finished_at, status
+    results - run_id, lender, table_name, rule_name, test_description, status,
+              failed_rows, total_rows, severity, error_msg, duration_s, recorded_at,
+              failed_rows_low, failed_rows_high, sample_fraction (sampled rules only)
+
+History queries (rule_trend, table_trend) are served by indexes on
+(rule_name, recorded_at) and (lender, table_name, recorded_at).
+"""
+import os
+import sqlite3
+import logging
+import datetime
+import contextlib
+
+import pandas as pd
+
+logger = logging.getLogger('dq_engine')
+
+DEFAULT_DB_PATH = os.path.join("state", "dq_results.db")
+
+RESULT_COLUMNS = [
+    "lender", "table", "rule_name", "test_description", "status", "failed_rows",
+    "total_rows", "severity", "error_msg", "duration_s", "failed_rows_low", "failed_rows_high",
+    "sample_fraction"
+]
+
+# Columns added after the first release; existing databases get them on open
+_ADDED_COLUMNS = {
+    "failed_rows_low": "INTEGER",
+    "failed_rows_high": "INTEGER",
+    "sample_fraction": "REAL",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id      TEXT PRIMARY KEY,
+    source      TEXT NOT NULL,
+    started_at  TEXT NOT NULL,
+    finished_at TEXT,
+    status      TEXT NOT NULL DEFAULT 'RUNNING'
+);
+CREATE TABLE IF NOT EXISTS results (
+    id               INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id           TEXT NOT NULL REFERENCES runs(run_id),
+    lender           TEXT NOT NULL,
+    table_name       TEXT NOT NULL,
+    rule_name        TEXT,
+    test_description TEXT,
+    status           TEXT NOT NULL,
+    failed_rows      INTEGER,
+    total_rows       INTEGER,
+    severity         TEXT,
+    error_msg        TEXT,
+    duration_s       REAL,
+    recorded_at      TEXT NOT NULL,
+    failed_rows_low  INTEGER,
+    failed_rows_high INTEGER,
+    sample_fraction  REAL
+);
+CREATE INDEX IF NOT EXISTS idx_results_run ON results(run_id);
+CREATE INDEX IF NOT EXISTS idx_results_rule_time ON results(rule_name, recorded_at);
+CREATE INDEX IF NOT EXISTS idx_results_table_time ON results(lender, table_name, recorded_at);
+CREATE INDEX IF NOT EXISTS idx_runs_started ON runs(source, started_at);
+"""
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def _none_if_nan(value):
+    return None if pd.isna(value) else value
+
+
+class ResultsStore:
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(results)")}
+            for column, column_type in _ADDED_COLUMNS.items():
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE results ADD COLUMN {column} {column_type}")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # A short-lived connection per call keeps the store safe to share between threads
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def start_run(self, run_id, source):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO runs (run_id, source, started_at) VALUES (?, ?, ?)",
+                (run_id, source, _now())
+            )
+
+    def finish_run(self, run_id, status="COMPLETED"):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE runs SET finished_at = ?, status = ? WHERE run_id = ?",
+                (_now(), status, run_id)
+            )
+
+    def record_results(self, run_id, results_df):
+        """Appends a run_validation DataFrame to the run. Returns the number of rows stored."""
+        if results_df is None or results_df.empty:
+            return 0
+        recorded_at = _now()
+        rows = []
+        for record in results_df.to_dict('records'):
+            failed_rows = _none_if_nan(record.get('failed_rows'))
+            total_rows = _none_if_nan(record.get('total_rows'))
+            duration_s = _none_if_nan(record.get('duration_s'))
+            failed_rows_low = _none_if_nan(record.get('failed_rows_low'))
+            failed_rows_high = _none_if_nan(record.get('failed_rows_high'))
+            sample_fraction = _none_if_nan(record.get('sample_fraction'))
+            rows.append((
+                run_id,
+                record.get('lender'),
+                record.get('table'),
+                _none_if_nan(record.get('rule_name')),
+                _none_if_nan(record.get('test_description')),
+                record.get('status'),
+                int(failed_rows) if failed_rows is not None else None,
+                int(total_rows) if total_rows is not None else None,
+                _none_if_nan(record.get('severity')),
+                _none_if_nan(record.get('error_msg')),
+                float(duration_s) if duration_s is not None else None,
+                recorded_at,
+                int(failed_rows_low) if failed_rows_low is not None else None,
+                int(failed_rows_high) if failed_rows_high is not None else None,
+                float(sample_fraction) if sample_fraction is not None else None
+            ))
+        with self._connect() as conn:
+            conn.executemany(
+                """INSERT INTO results (run_id, lender, table_name, rule_name, test_description, status,
+                                        failed_rows, total_rows, severity, error_msg, duration_s, recorded_at,
+                                        failed_rows_low, failed_rows_high, sample_fraction)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                rows
+            )
+        return len(rows)
+
+    def _read(self, query, params=()):
+        with self._connect() as conn:
+            return pd.read_sql_query(query, conn, params=params)
+
+    def list_runs(self, limit=50, source=None):
+        query = "SELECT * FROM runs"
+        params = []
+        if source:
+            query += " WHERE source = ?"
+            params.append(source)
+        query += " ORDER BY started_at DESC LIMIT ?"
+        params.append(limit)
+        return self._read(query, params)
+
+    def latest_run_id(self, source=None, completed_only=True):
+        query = "SELECT run_id FROM runs WHERE 1 = 1"
+        params = []
+        if source:
+            query += " AND source = ?"
+            params.append(source)
+        if completed_only:
+            query += " AND status = 'COMPLETED'"
+        query += " ORDER BY started_at DESC LIMIT 1"
+        with self._connect() as conn:
+            row = conn.execute(query, params).fetchone()
+        return row[0] if row else None
+
+    def get_run_results(self, run_id, lender=None, table_name=None):
+        """One run's results with the same columns as run_validation returns."""
+        query = """SELECT lender, table_name AS "table", rule_name, test_description, status, failed_rows,
+                          total_rows, severity, error_msg, duration_s, failed_rows_low, failed_rows_high,
+                          sample_fraction
+                   FROM results WHERE run_id = ?"""
+        params = [run_id]
+        if lender:
+            query += " AND lender = ?"
+            params.append(lender)
+        if table_name:
+            query += " AND table_name = ?"
+            params.append(table_name)
+        return self._read(query + " ORDER BY id", params)
+
+    def rule_trend(self, rule_name, days=30, lender=None, table_name=None):
+        """failed_rows/status history of one rule over the last `days` days, oldest first."""
+        since = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat(timespec="seconds")
+        query = """SELECT recorded_at, run_id, lender, table_name AS "table", status, failed_rows, total_rows, duration_s
+                   FROM results WHERE rule_name = ? AND recorded_at >= ?"""
+        params = [rule_name, since]
+        if lender:
+            query += " AND lender = ?"
+            params.append(lender)
+        if table_name:
+            query += " AND table_name = ?"
+            params.append(table_name)
+        return self._read(query + " ORDER BY recorded_at", params)
+
+    def table_trend(self, lender, table_name, days=30):
+        """Per-run totals for one lender's table over the last `days` days."""
+        since = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat(timespec="seconds")
+        return self._read(
+            """SELECT run_id, MIN(recorded_at) AS recorded_at,
+                      SUM(CASE WHEN status = 'FAIL' THEN 1 ELSE 0 END) AS failed_checks,
+                      SUM(CASE WHEN status NOT IN ('PASS', 'FAIL', 'SKIPPED') THEN 1 ELSE 0 END) AS error_checks,
+                      SUM(failed_rows) AS failed_rows,
+                      SUM(duration_s) AS duration_s
+               FROM results
+               WHERE lender = ? AND table_name = ? AND recorded_at >= ?
+               GROUP BY run_id
+               ORDER BY recorded_at""",
+            (lender, table_name, since)
+        )
+
+    def average_durations(self, days=14):
+        """Mean duration_s per (lender, table, rule) over the last `days` days, for cost-based scheduling."""
+        since = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat(timespec="seconds")
+        with self._connect() as conn:
+            rows = conn.execute(
+                """SELECT lender, table_name, rule_name, AVG(duration_s)
+                   FROM results
+                   WHERE recorded_at >= ? AND duration_s IS NOT NULL AND rule_name IS NOT NULL
+                   GROUP BY lender, table_name, rule_name""",
+                (since,)
+            ).fetchall()
+        return {(lender, table_name, rule_name): avg for lender, table_name, rule_name, avg in rows}
+
+    def rule_names(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT rule_name FROM results WHERE rule_name IS NOT NULL ORDER BY rule_name"
+            ).fetchall()
+        return [row[0] for row in rows]
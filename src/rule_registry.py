@@ -0,0 +1,522 @@
+"""
+Compiled form of config/gx_rules.yaml.
+
+The YAML is parsed, validated and normalised once per version of the file:
+
+    tables[<table>]         - primary_keys (list), watermark_column, rules,
+                              source_tables (every table its rules read) and
+                              rules_hash (changes when its rules or the settings do)
+    rule                    - the YAML entry plus `expectation_class` (GX class name),
+                              `meta` (with test_alias), `schedule` (rule_schedule.parse
+                              of its own or its table's schedule), `dependencies`
+                              ((table, rule) pairs from `depends_on` and the table's
+                              `gate: true` rules) and `level` (the batch it runs in:
+                              rules others depend on as early as their own dependencies
+                              allow, every other rule in the last batch), and for SQL
+                              rules `sql` (the query with {batch} resolved), `fusion`
+                              (sql_fusion.parse_simple_check of it, or None) and
+                              `reads_clock` (it calls NOW(), CURDATE(), ...)
+    lender_rules(lender)    - each table's rules after target_lenders filtering
+
+The result is pickled under state/rule_cache/, keyed by the file's SHA-256 and the
+source of the compiler modules (this one, sql_fusion, rule_schedule), so worker
+processes and the dashboard load it without re-parsing YAML, and kept in memory
+for the life of the process. Any change to the file or the compiler recompiles.
+
+A table with config errors (including its rules' depends_on) is logged and left
+out, like every table that depends on it; the other tables still run. Errors in
+the file's layout or settings, or no usable table at all, raise RuleConfigError
+when the registry is loaded, before any database connection is made.
+"""
+import os
+import re
+import json
+import pickle
+import hashlib
+import logging
+import threading
+
+import yaml
+
+from src import rule_schedule
+from src import sql_fusion
+
+logger = logging.getLogger('dq_engine')
+
+CACHE_DIR = os.path.join("state", "rule_cache")
+
+# Bump when the compiled layout changes so stale pickles are ignored; changes to
+# the compiler modules' source invalidate them too (see _compiler_hash)
+_COMPILED_VERSION = 5
+
+_SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Table names a rule reads. Over-matches (e.g. EXTRACT(DAY FROM col)), which only
+# makes the result cache more conservative.
+_TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN)\s+([`\w.]+)", re.IGNORECASE)
+
+# Rules whose result can change with the clock alone (e.g. "max_val < NOW() - INTERVAL 24 HOUR")
+_CLOCK_FUNCTION = re.compile(
+    r"\b(?:NOW|CURDATE|CURTIME|SYSDATE|UTC_TIMESTAMP|UTC_DATE|UNIX_TIMESTAMP)\s*\(|\bCURRENT_(?:TIMESTAMP|DATE|TIME)\b",
+    re.IGNORECASE
+)
+
+# In-process registries by (absolute path, file hash)
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def _compiler_hash():
+    digest = hashlib.sha256()
+    for module_file in (__file__, sql_fusion.__file__, rule_schedule.__file__):
+        with open(module_file, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+_COMPILER_HASH = _compiler_hash()
+
+
+class RuleConfigError(ValueError):
+    """gx_rules.yaml is malformed. The message lists every problem found."""
+
+
+def expectation_class_name(rule_type):
+    """'expect_column_values_to_not_be_null' -> 'ExpectColumnValuesToNotBeNull'"""
+    return "".join([x.capitalize() for x in rule_type.split('_')])
+
+
+def _prepare_query(query, table_name):
+    # Same normalisation as GXRunner._prepare_query
+    query = query.strip().rstrip(';').strip()
+    return query.replace("{batch}", table_name)
+
+
+def referenced_tables(query):
+    return {name.replace('`', '') for name in _TABLE_REFERENCE.findall(query)}
+
+
+def reads_clock(query):
+    return bool(_CLOCK_FUNCTION.search(query))
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def rule_statuses(results_df):
+    """{(table, rule_name): status} of a results DataFrame, for checking dependencies."""
+    if results_df is None or results_df.empty or 'rule_name' not in results_df.columns:
+        return {}
+    return {
+        (table_name, rule_name): status
+        for table_name, rule_name, status in zip(results_df['table'], results_df['rule_name'], results_df['status'])
+        if isinstance(rule_name, str)
+    }
+
+
+def failed_dependency(rule, statuses):
+    """
+    The first (table, rule, status) among the rule's dependencies that ran and did
+    not pass, or None. Dependencies that are not part of the run are ignored.
+    """
+    for dependency in rule.get('dependencies', ()):
+        status = statuses.get(dependency)
+        if status is not None and status != "PASS":
+            return dependency + (status,)
+    return None
+
+
+def _compile_rule(table_name, index, exp_config, primary_keys, errors, table_schedule=None):
+    where = f"tables.{table_name}.expectations[{index}]"
+    if not isinstance(exp_config, dict):
+        errors.append(f"{where}: must be a mapping.")
+        return None
+
+    rule_type = exp_config.get('type')
+    if not isinstance(rule_type, str) or not rule_type:
+        errors.append(f"{where}: missing 'type'.")
+        return None
+
+    kwargs = exp_config.get('kwargs') or {}
+    if not isinstance(kwargs, dict):
+        errors.append(f"{where}: 'kwargs' must be a mapping.")
+        return None
+
+    meta = exp_config.get('meta') or {}
+    if not isinstance(meta, dict):
+        errors.append(f"{where}: 'meta' must be a mapping.")
+        return None
+
+    target_lenders = exp_config.get('target_lenders')
+    if target_lenders is not None and (
+        not isinstance(target_lenders, list) or not all(isinstance(l, str) for l in target_lenders)
+    ):
+        errors.append(f"{where}: 'target_lenders' must be a list of lender names.")
+        return None
+
+    timeout = exp_config.get('timeout_seconds')
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float))):
+        errors.append(f"{where}: 'timeout_seconds' must be a number.")
+        return None
+
+    mode = exp_config.get('mode', 'full')
+    if mode not in ("full", "sample"):
+        errors.append(f"{where}: 'mode' must be 'full' or 'sample'.")
+        return None
+    if mode == "sample" and rule_type != "unexpected_rows_expectation":
+        errors.append(f"{where}: only unexpected_rows_expectation rules can use 'mode: sample'.")
+        return None
+    fraction = exp_config.get('sample_fraction')
+    if fraction is not None and (isinstance(fraction, bool) or not isinstance(fraction, (int, float))
+                                 or not 0 < fraction <= 1):
+        errors.append(f"{where}: 'sample_fraction' must be a number in (0, 1].")
+        return None
+    sample_rows = exp_config.get('sample_rows')
+    if sample_rows is not None and (isinstance(sample_rows, bool) or not isinstance(sample_rows, int) or sample_rows < 1):
+        errors.append(f"{where}: 'sample_rows' must be a positive integer.")
+        return None
+
+    try:
+        schedule = rule_schedule.parse(exp_config.get('schedule', table_schedule))
+    except ValueError as e:
+        errors.append(f"{where}: {e}")
+        return None
+
+    if not isinstance(exp_config.get('gate', False), bool):
+        errors.append(f"{where}: 'gate' must be true or false.")
+        return None
+    if exp_config.get('gate') and not exp_config.get('name'):
+        errors.append(f"{where}: a gate needs a 'name'.")
+        return None
+    depends_on = exp_config.get('depends_on') or []
+    if isinstance(depends_on, str):
+        depends_on = [depends_on]
+    if not isinstance(depends_on, list) or not all(isinstance(d, str) and d for d in depends_on):
+        errors.append(f"{where}: 'depends_on' must be a rule name or a list of them.")
+        return None
+
+    rule = dict(exp_config)
+    rule['kwargs'] = kwargs
+    rule['schedule'] = schedule
+    rule['depends_on'] = depends_on
+    rule['expectation_class'] = expectation_class_name(rule_type)
+    # Built once here instead of per lender; the GX path copies it onto the expectation
+    rule['meta'] = dict(meta, test_alias=exp_config.get('name'), primary_keys=primary_keys)
+
+    if rule_type == "unexpected_rows_expectation":
+        query = kwargs.get('unexpected_rows_query')
+        if not isinstance(query, str) or not query.strip():
+            errors.append(f"{where}: unexpected_rows_expectation needs kwargs.unexpected_rows_query.")
+            return None
+        rule['sql'] = _prepare_query(query, table_name)
+        rule['fusion'] = sql_fusion.parse_simple_check(rule['sql'])
+        rule['source_tables'] = referenced_tables(rule['sql'])
+        rule['reads_clock'] = reads_clock(rule['sql'])
+    return rule
+
+
+def _compile_table(table_name, table_config, errors):
+    if not isinstance(table_config, dict):
+        errors.append(f"tables.{table_name}: must be a mapping with 'primary_key' and 'expectations'.")
+        return None
+
+    pk_config = table_config.get('primary_key')
+    primary_keys = pk_config if isinstance(pk_config, list) else [pk_config]
+    if not pk_config or not all(isinstance(pk, str) and pk for pk in primary_keys):
+        errors.append(f"tables.{table_name}: missing or invalid 'primary_key'.")
+        return None
+
+    expectations = table_config.get('expectations') or []
+    if not isinstance(expectations, list):
+        errors.append(f"tables.{table_name}: 'expectations' must be a list.")
+        return None
+
+    rules = []
+    seen_names = set()
+    source_tables = {table_name}
+    for index, exp_config in enumerate(expectations):
+        rule = _compile_rule(table_name, index, exp_config, primary_keys, errors, table_config.get('schedule'))
+        if rule is None:
+            continue
+        name = rule.get('name')
+        if name:
+            # Units, profiles and the results store identify a rule by (table, name)
+            if name in seen_names:
+                errors.append(f"tables.{table_name}: duplicate rule name '{name}'.")
+            seen_names.add(name)
+        rules.append(rule)
+        source_tables.update(rule.get('source_tables', ()))
+
+    return {
+        "table": table_name,
+        "primary_keys": primary_keys,
+        "watermark_column": table_config.get('watermark_column'),
+        "rules": rules,
+        "source_tables": sorted(source_tables)
+    }
+
+
+class RuleRegistry:
+    def __init__(self, raw, file_hash, source_path=None):
+        self.raw = raw
+        self.file_hash = file_hash
+        self.source_path = source_path
+        self.settings = raw.get('settings') or {}
+        self.tables = {}
+        # {table: [problems]} of the tables left out
+        self.skipped_tables = {}
+        self._lender_rules = {}
+        self._lock = threading.Lock()
+
+        errors = []
+        if not isinstance(self.settings, dict):
+            errors.append("settings: must be a mapping.")
+            self.settings = {}
+        tables = raw.get('tables')
+        if not isinstance(tables, dict) or not tables:
+            errors.append("tables: must be a non-empty mapping of table name -> config.")
+            tables = {}
+        for table_name, table_config in tables.items():
+            table_errors = []
+            compiled = _compile_table(table_name, table_config, table_errors)
+            if table_errors:
+                self.skipped_tables[table_name] = table_errors
+            elif compiled:
+                compiled['rules_hash'] = _digest([table_config, self.settings])
+                self.tables[table_name] = compiled
+        while True:
+            # Leaving a table out can break another table's depends_on; repeat until stable
+            dependency_errors = {}
+            _resolve_dependencies(self.tables, dependency_errors)
+            if not dependency_errors:
+                break
+            for table_name, table_errors in dependency_errors.items():
+                self.skipped_tables[table_name] = table_errors
+                del self.tables[table_name]
+        if tables and not self.tables:
+            errors.append("no table without errors is left.")
+        if errors:
+            errors += [problem for problems in self.skipped_tables.values() for problem in problems]
+            raise RuleConfigError(f"{len(errors)} problem(s) in {source_path or 'rules'}:\n  " + "\n  ".join(errors))
+
+    def log_skipped_tables(self):
+        for table_name, problems in self.skipped_tables.items():
+            logger.error(f"Skipping table {table_name}, {len(problems)} problem(s) in "
+                         f"{self.source_path or 'rules'}:\n  " + "\n  ".join(problems))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        # Lender rule sets depend on secrets.toml, so they are resolved per process
+        state['_lender_rules'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def lender_rules(self, lender_id, table_name):
+        """The table's rules that apply to this lender (target_lenders resolved), in YAML order."""
+        with self._lock:
+            if lender_id not in self._lender_rules:
+                self._lender_rules[lender_id] = self._resolve(lender_id)
+        return self._lender_rules[lender_id].get(table_name, ())
+
+    def select(self, tables=None, rule_names=None, severities=None):
+        """
+        The named rules matching every given filter, as {table: [rule names]} in YAML
+        order (tables without a match are left out), plus the rules they depend on
+        (see with_dependencies). A rule's severity defaults to "warning". Unknown
+        table or rule names raise RuleConfigError.
+        """
+        unknown = [t for t in tables or () if t not in self.tables]
+        known_rules = {rule.get('name') for table in self.tables.values() for rule in table['rules']}
+        unknown += [r for r in rule_names or () if r not in known_rules]
+        if unknown:
+            raise RuleConfigError(f"Unknown table or rule name(s): {', '.join(unknown)}")
+
+        selection = {}
+        for table_name, table in self.tables.items():
+            if tables and table_name not in tables:
+                continue
+            names = [
+                rule['name'] for rule in table['rules']
+                if rule.get('name')
+                and (not rule_names or rule['name'] in rule_names)
+                and (not severities or rule['meta'].get('severity', 'warning') in severities)
+            ]
+            if names:
+                selection[table_name] = names
+        return self.with_dependencies(selection)
+
+    def with_dependencies(self, selection):
+        """
+        `selection` ({table: [rule names]}) plus every rule its rules depend on,
+        directly or not, in YAML order: a run needs their results to decide what to skip.
+        """
+        wanted = {(table_name, name) for table_name, names in selection.items() for name in names}
+        rules = {
+            (table_name, rule['name']): rule
+            for table_name, table in self.tables.items() for rule in table['rules'] if rule.get('name')
+        }
+        pending = list(wanted)
+        while pending:
+            for dependency in rules[pending.pop()]['dependencies']:
+                if dependency not in wanted:
+                    wanted.add(dependency)
+                    pending.append(dependency)
+        result = {}
+        for table_name, table in self.tables.items():
+            names = [rule['name'] for rule in table['rules'] if (table_name, rule.get('name')) in wanted]
+            if names:
+                result[table_name] = names
+        return result
+
+    def resolve_lenders(self, lenders):
+        """Resolves every lender's rule sets up front."""
+        for lender_id in lenders:
+            self.lender_rules(lender_id, None)
+
+    def _resolve(self, lender_id):
+        resolved = {}
+        for table_name, table in self.tables.items():
+            rules = []
+            for rule in table['rules']:
+                target_lenders = rule.get('target_lenders')
+                if target_lenders and lender_id not in target_lenders:
+                    logger.info(f"[{lender_id}] Skipping test '{rule.get('name')}' as lender is not in target_lenders.")
+                    continue
+                rules.append(rule)
+            resolved[table_name] = tuple(rules)
+        return resolved
+
+
+def _resolve_dependencies(tables, errors):
+    """
+    Sets every rule's `dependencies` and `level`. A rule depends on the rules named
+    in its `depends_on` ("rule" on its own table, "table.rule" on another one) and
+    on its table's gates (`gate: true`), unless it is a gate itself. Problems are
+    added to `errors` as {table: [problems]}.
+    """
+    named = {
+        (table_name, rule['name']): rule
+        for table_name, table in tables.items() for rule in table['rules'] if rule.get('name')
+    }
+    for table_name, table in tables.items():
+        gates = [(table_name, rule['name']) for rule in table['rules'] if rule.get('gate')]
+        for index, rule in enumerate(table['rules']):
+            where = f"tables.{table_name}.{rule.get('name') or f'expectations[{index}]'}"
+            dependencies = [] if rule.get('gate') else list(gates)
+            for reference in rule['depends_on']:
+                dependency_table, _, dependency_name = reference.rpartition('.')
+                dependency = (dependency_table or table_name, dependency_name)
+                if dependency not in named:
+                    errors.setdefault(table_name, []).append(
+                        f"{where}: depends_on '{reference}' is not a named rule "
+                        f"(use 'rule' on the same table or 'table.rule')."
+                    )
+                elif dependency == (table_name, rule.get('name')):
+                    errors.setdefault(table_name, []).append(f"{where}: a rule can't depend on itself.")
+                elif dependency not in dependencies:
+                    dependencies.append(dependency)
+            rule['dependencies'] = tuple(dependencies)
+
+    levels = {}
+    cycles = set()
+
+    def level(key, rule, chain):
+        if key in levels:
+            return levels[key]
+        if key in chain:
+            cycle = chain[chain.index(key):] + [key]
+            if frozenset(cycle) not in cycles:
+                cycles.add(frozenset(cycle))
+                for cycle_table in {t for t, _ in cycle}:
+                    errors.setdefault(cycle_table, []).append(
+                        "depends_on cycle: " + " -> ".join(f"{t}.{n}" for t, n in cycle)
+                    )
+            return 0
+        chain = chain + [key]
+        value = max((level(d, named[d], chain) + 1 for d in rule['dependencies']), default=0)
+        if key[1] is not None:
+            levels[key] = value
+        return value
+
+    for table_name, table in tables.items():
+        for rule in table['rules']:
+            rule['level'] = level((table_name, rule.get('name')), rule, [])
+
+    # Nothing waits on the other rules: they run together in the last batch, so the
+    # earlier batches only hold the (cheap) gates
+    depended_on = {d for table in tables.values() for rule in table['rules'] for d in rule['dependencies']}
+    last = max((rule['level'] for table in tables.values() for rule in table['rules']), default=0)
+    for table_name, table in tables.items():
+        for rule in table['rules']:
+            if (table_name, rule.get('name')) not in depended_on:
+                rule['level'] = last
+
+
+def _cache_path(cache_dir, file_hash):
+    return os.path.join(cache_dir, f"{file_hash}.v{_COMPILED_VERSION}.{_COMPILER_HASH}.pickle")
+
+
+def _read_cache(path, file_hash):
+    try:
+        with open(path, 'rb') as f:
+            registry = pickle.load(f)
+        if isinstance(registry, RuleRegistry) and registry.file_hash == file_hash:
+            return registry
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable rule cache '{path}': {e}")
+    return None
+
+
+def _write_cache(path, registry):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(registry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.warning(f"Could not write rule cache '{path}': {e}")
+
+
+def load(rules_path="config/gx_rules.yaml", cache_dir=CACHE_DIR):
+    """
+    The compiled registry for rules_path: from memory, else from the pickle cache,
+    else parsed and compiled (and cached). Raises RuleConfigError for a bad config.
+    """
+    with open(rules_path, 'rb') as f:
+        content = f.read()
+    file_hash = hashlib.sha256(content).hexdigest()
+    key = (os.path.abspath(rules_path), file_hash)
+
+    with _loaded_lock:
+        registry = _loaded.get(key)
+    if registry is not None:
+        return registry
+
+    path = _cache_path(cache_dir, file_hash) if cache_dir else None
+    registry = _read_cache(path, file_hash) if path else None
+    if registry is None:
+        try:
+            raw = yaml.load(content, Loader=_SafeLoader) or {}
+        except yaml.YAMLError as e:
+            raise RuleConfigError(f"{rules_path} is not valid YAML: {e}") from e
+        if not isinstance(raw, dict):
+            raise RuleConfigError(f"{rules_path} must contain a mapping with 'settings' and 'tables'.")
+        registry = RuleRegistry(raw, file_hash, rules_path)
+        if path:
+            _write_cache(path, registry)
+        logger.info(f"Compiled {sum(len(t['rules']) for t in registry.tables.values())} rules "
+                    f"on {len(registry.tables)} tables from '{rules_path}'.")
+    # Once per process, whether compiled here or read from the cache
+    registry.log_skipped_tables()
+
+    with _loaded_lock:
+        _loaded[key] = registry
+    return registry
@@ -0,0 +1,57 @@
+"""
+Cadences of rules under the scheduler daemon (`schedule:` on a rule, or on its
+table for every rule without one).
+
+    schedule: "15m"      every 15 minutes (units s, m, h, d)
+    schedule: "02:30"    daily at 02:30
+    schedule: "daily"    daily at settings.daily_run_time (the default)
+
+The daily job and the CLI ignore schedules and run every rule.
+"""
+import re
+import datetime
+
+DAILY = ("daily", None)
+
+_INTERVAL = re.compile(r"^(\d+)\s*([smhd])$")
+_TIME_OF_DAY = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+_UNIT_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse(value):
+    """
+    "15m" -> ("every", 900), "02:30" -> ("at", "02:30"), "daily" or None -> ("daily", None).
+    Raises ValueError for anything else.
+    """
+    if value is None:
+        return DAILY
+    text = str(value).strip().lower()
+    if text == "daily":
+        return DAILY
+    match = _INTERVAL.match(text)
+    if match and int(match.group(1)) > 0:
+        return ("every", int(match.group(1)) * _UNIT_SECONDS[match.group(2)])
+    match = _TIME_OF_DAY.match(text)
+    if match:
+        return ("at", f"{int(match.group(1)):02d}:{match.group(2)}")
+    raise ValueError(f"'schedule' must be an interval like '15m' / '2h', a time like '02:30', or 'daily' (got {value!r}).")
+
+
+def last_slot(schedule, now, daily_run_time):
+    """
+    The most recent time at or before `now` the rule was due, or None for
+    interval schedules (those are due `interval` after their last run).
+    """
+    kind, value = schedule
+    if kind == "every":
+        return None
+    hours, minutes = (value or daily_run_time).split(":")
+    slot = now.replace(hour=int(hours), minute=int(minutes), second=0, microsecond=0)
+    return slot if slot <= now else slot - datetime.timedelta(days=1)
+
+
+def is_due(schedule, last_run, now, daily_run_time):
+    """True if a rule last run at `last_run` (None: never) should run at `now`."""
+    if schedule[0] == "every":
+        return last_run is None or (now - last_run).total_seconds() >= schedule[1]
+    return last_run is None or last_run < last_slot(schedule, now, daily_run_time)
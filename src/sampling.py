@@ -0,0 +1,69 @@
+"""
+Key-hash sampling for expensive count-first rules (`mode: sample`).
+
+In a run with depth "sample", a rule marked `mode: sample` only reads the
+rows of its main table whose primary key hashes into the sample:
+
+    CRC32(CONCAT_WS('|', <pk columns>)) % 10000 < <fraction * 10000>
+
+The same keys are picked on every run, so results are comparable between
+runs and a failing row either is or isn't in the sample, consistently. The
+failure count is scaled up to the whole table and reported with a Wilson score
+confidence interval. Runs with depth "full" (the default, e.g. nightly) ignore
+`mode: sample`.
+"""
+import math
+import statistics
+
+# Resolution of the hash sample: fractions are rounded to 1/HASH_BUCKETS
+HASH_BUCKETS = 10000
+
+DEPTHS = ("full", "sample")
+
+
+def sample_fraction(exp_config, table_count, settings):
+    """
+    The fraction of rows to read for a sampled rule: its `sample_rows` cap relative
+    to the table size, else its `sample_fraction`, else settings.sample_fraction.
+    None when the whole table would be read anyway.
+    """
+    sample_rows = exp_config.get('sample_rows')
+    if sample_rows:
+        if not table_count:
+            return None
+        fraction = sample_rows / table_count
+    else:
+        fraction = exp_config.get('sample_fraction') or settings.get('sample_fraction', 0.05)
+    fraction = max(fraction, 1 / HASH_BUCKETS)
+    return fraction if fraction < 1 else None
+
+
+def sample_predicate(dialect, primary_keys, fraction):
+    """SQL condition selecting the sample, or None if the dialect has no CRC32."""
+    if dialect != "mysql":
+        return None
+    key = primary_keys[0] if len(primary_keys) == 1 else f"CONCAT_WS('|', {', '.join(primary_keys)})"
+    return f"CRC32({key}) % {HASH_BUCKETS} < {max(1, round(fraction * HASH_BUCKETS))}"
+
+
+def wilson_interval(failures, sample_size, confidence=0.95):
+    """Wilson score interval (low, high) for the failing proportion."""
+    if sample_size <= 0:
+        return 0.0, 1.0
+    z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+    # A join can return a sampled row more than once
+    p = min(1.0, failures / sample_size)
+    denominator = 1 + z * z / sample_size
+    centre = (p + z * z / (2 * sample_size)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / sample_size + z * z / (4 * sample_size * sample_size)) / denominator
+    return max(0.0, centre - margin), min(1.0, centre + margin)
+
+
+def estimate_failures(failures, sample_size, population, confidence=0.95):
+    """(estimate, low, high) failing rows in a population of `population` rows."""
+    if sample_size <= 0:
+        return 0, 0, population
+    low, high = wilson_interval(failures, sample_size, confidence)
+    estimate = round(failures * population / sample_size)
+    # The sample's own failures are certain, whatever the interval says
+    return estimate, max(failures, math.floor(low * population)), max(failures, math.ceil(high * population))
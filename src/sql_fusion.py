@@ -0,0 +1,89 @@
+"""
+Fuses compatible unexpected_rows_query checks on the same table into one scan.
+
+A check is "simple" when its query has the shape
+
+    SELECT <columns> FROM <table> [[AS] alias] WHERE <condition>
+
+with no joins, grouping, DISTINCT, aggregates, sub-queries or set operators.
+For such checks the number of unexpected rows is exactly the number of rows
+for which <condition> is TRUE. Several of them can therefore be counted in a
+single pass:
+
+    SELECT SUM(CASE WHEN (<cond 1>) THEN 1 ELSE 0 END) AS dq_c0,
+           SUM(CASE WHEN (<cond 2>) THEN 1 ELSE 0 END) AS dq_c1
+    FROM <table> [alias]
+
+Anything that does not match is left to run on its own.
+"""
+import re
+
+_SIMPLE_CHECK = re.compile(
+    r"^\s*SELECT\s+(?P<columns>.+?)\s+FROM\s+(?P<table>[\w.`]+)"
+    r"(?:\s+(?:AS\s+)?(?P<alias>\w+))?\s+WHERE\s+(?P<condition>.+)$",
+    re.IGNORECASE | re.DOTALL
+)
+
+# Anything that changes the row count or the scope of the scan
+_UNSAFE_CONDITION = re.compile(
+    r"\b(SELECT|JOIN|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|UNION|INTERSECT|EXCEPT|OVER)\b",
+    re.IGNORECASE
+)
+_UNSAFE_COLUMNS = re.compile(
+    r"\b(DISTINCT|COUNT|SUM|MIN|MAX|AVG|GROUP_CONCAT|OVER)\b",
+    re.IGNORECASE
+)
+
+_RESERVED_ALIASES = {"where", "join", "left", "right", "inner", "outer", "cross", "group", "order", "limit"}
+
+
+def parse_simple_check(query):
+    """
+    Returns {'table', 'alias', 'condition'} for a fusable query, or None.
+    The query must already be stripped of its trailing semicolon.
+    """
+    match = _SIMPLE_CHECK.match(query)
+    if not match:
+        return None
+
+    alias = match.group('alias')
+    if alias and alias.lower() in _RESERVED_ALIASES:
+        return None
+    if _UNSAFE_COLUMNS.search(match.group('columns')):
+        return None
+
+    condition = match.group('condition').strip()
+    if _UNSAFE_CONDITION.search(condition):
+        return None
+    # A trailing comment would swallow the rest of the CASE expression
+    if "--" in condition or "/*" in condition or "#" in condition:
+        return None
+
+    return {
+        "table": match.group('table'),
+        "alias": alias,
+        "condition": condition
+    }
+
+
+def fusion_key(parsed):
+    """Checks can share a scan when they read the same table under the same alias."""
+    table = parsed['table'].replace('`', '').lower()
+    alias = parsed['alias'].lower() if parsed['alias'] else None
+    return (table, alias)
+
+
+def build_fused_count_query(table, alias, conditions, where=None):
+    """
+    One scan of `table` returning a counter column dq_c<i> per condition.
+    `where` optionally narrows the scan (e.g. an incremental watermark range).
+    """
+    counters = ",\n       ".join(
+        f"SUM(CASE WHEN ({condition}) THEN 1 ELSE 0 END) AS dq_c{i}"
+        for i, condition in enumerate(conditions)
+    )
+    source = f"{table} {alias}" if alias else table
+    query = f"SELECT {counters}\nFROM {source}"
+    if where:
+        query += f"\nWHERE {where}"
+    return query
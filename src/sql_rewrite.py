@@ -0,0 +1,166 @@
+"""
+Small, conservative rewrites of YAML rule queries.
+
+restrict_table() narrows the rows a query reads from its main table without
+touching the rest of the statement: the first top-level FROM <table> is
+replaced by a derived table that keeps the original name/alias, e.g.
+
+    FROM v73__loan_details ld
+ -> FROM (SELECT * FROM v73__loan_details WHERE <predicate>) ld
+
+This is only done when it cannot change what a surviving row means: the main
+table must be the first top-level FROM, and the top level of the query must not
+aggregate, de-duplicate, window or UNION rows. Joins and sub-queries on other
+tables are left alone and still see their full tables.
+
+qualify_tables() points a query at another database on the same server (cross-
+lender execution): every unqualified FROM/JOIN of a known table gets the
+schema (references that already name a database are left alone), e.g.
+
+    FROM v73__loan_details ld JOIN v73__offer_details
+ -> FROM `acme`.`v73__loan_details` ld JOIN `acme`.`v73__offer_details` AS v73__offer_details
+"""
+import re
+import datetime
+import decimal
+
+_TOP_LEVEL_UNSAFE = re.compile(
+    r"\b(GROUP\s+BY|HAVING|DISTINCT|UNION|INTERSECT|EXCEPT|OVER|COUNT|SUM|MIN|MAX|AVG|GROUP_CONCAT)\b",
+    re.IGNORECASE
+)
+_FROM_TABLE = re.compile(
+    r"\bFROM\s+(?P<table>[\w.`]+)(?:\s+(?:AS\s+)?(?P<alias>\w+))?",
+    re.IGNORECASE
+)
+_NOT_AN_ALIAS = {
+    "where", "join", "left", "right", "inner", "outer", "cross", "natural",
+    "straight_join", "group", "order", "limit", "having", "union", "on", "using"
+}
+
+
+def mask_nested(query):
+    """
+    Returns a copy of the query of the same length in which string literals and
+    everything inside parentheses is blanked out, so regexes only see the top level
+    while match positions still line up with the original text.
+    """
+    masked = []
+    depth = 0
+    quote = None
+    for ch in query:
+        if quote:
+            masked.append(" ")
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+            masked.append(" ")
+        elif ch == "(":
+            depth += 1
+            masked.append("(" if depth == 1 else " ")
+        elif ch == ")":
+            masked.append(")" if depth == 1 else " ")
+            depth = max(0, depth - 1)
+        else:
+            masked.append(ch if depth == 0 else " ")
+    return "".join(masked)
+
+
+_TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN)\s+(?P<ref>(`?)(?P<table>[\w$]+)\2)(?![\w$`.])", re.IGNORECASE)
+_FOLLOWING_WORD = re.compile(r"\s+(?:AS\s+)?(\w+)", re.IGNORECASE)
+
+
+def mask_strings(query):
+    """A copy of the query of the same length with string literals blanked out."""
+    masked = []
+    quote = None
+    for ch in query:
+        if quote:
+            masked.append(" ")
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+            masked.append(" ")
+        else:
+            masked.append(ch)
+    return "".join(masked)
+
+
+def _bare_name(table_ref):
+    return table_ref.replace("`", "").split(".")[-1].lower()
+
+
+def restrict_table(query, table_name, predicate):
+    """
+    Rewrites `query` so its main table only contributes rows matching `predicate`.
+    Returns None when the query is not safe to restrict (see module docstring).
+    The query must already be stripped of its trailing semicolon.
+    """
+    masked = mask_nested(query)
+    if _TOP_LEVEL_UNSAFE.search(masked):
+        return None
+
+    match = _FROM_TABLE.search(masked)
+    if not match or _bare_name(match.group('table')) != table_name.lower():
+        return None
+
+    alias = match.group('alias')
+    if alias and alias.lower() in _NOT_AN_ALIAS:
+        alias = None
+
+    table_ref = query[match.start('table'):match.end('table')]
+    derived = f"(SELECT * FROM {table_ref} WHERE {predicate})"
+    if not alias:
+        # Keep `table.column` references working
+        derived += f" AS {_bare_name(table_ref)}"
+    return query[:match.start('table')] + derived + query[match.end('table'):]
+
+
+def qualify_tables(query, schema, tables):
+    """
+    Rewrites `query` to read `tables` from database `schema`: each unqualified FROM/JOIN
+    of one of them becomes `schema`.`table`, keeping its alias or aliased to its own
+    name so `table.column` references still work. References that already name a
+    database are left alone; they read the same tables whichever lender runs them.
+    Returns None when the query reads any other unqualified table (or a CTE), or names
+    a table outside FROM/JOIN (e.g. a comma join), i.e. when it can't be moved safely.
+    """
+    masked = mask_strings(query)
+    known = {t.lower() for t in tables}
+
+    parts = []
+    references = set()
+    last = 0
+    for match in _TABLE_REFERENCE.finditer(masked):
+        table = match.group('table')
+        if table.lower() not in known:
+            return None
+        alias = _FOLLOWING_WORD.match(masked, match.end())
+        has_alias = alias is not None and alias.group(1).lower() not in _NOT_AN_ALIAS
+        parts.append(query[last:match.start('ref')])
+        parts.append(f"`{schema}`.`{table}`" + ("" if has_alias else f" AS {table}"))
+        last = match.end('ref')
+        references.add(match.start('table'))
+
+    # Any other mention of a known table that isn't a `table.column` qualifier
+    mention = re.compile(
+        r"(?<![\w$.`])`?(" + "|".join(re.escape(t) for t in known) + r")`?(?![\w$])(?!\s*\.)", re.IGNORECASE
+    )
+    for match in mention.finditer(masked):
+        if match.start(1) not in references:
+            return None
+    return "".join(parts) + query[last:]
+
+
+def sql_literal(value):
+    """Renders a Python value fetched from MySQL as a SQL literal."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat(sep=" ") if isinstance(value, datetime.datetime) else value.isoformat()
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
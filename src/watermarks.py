@@ -0,0 +1,61 @@
+"""
+High-water marks for incremental validation (settings.incremental).
+
+One small JSON file per lender and table (state/watermarks/<lender>/<table>.json),
+so the worker processes checking a lender's tables never write the same file:
+
+    {
+      "column": "application_timestamp",
+      "high_water_mark": "2026-03-16 23:59:12",
+      "high_water_mark_sql": "'2026-03-16 23:59:12'",
+      "last_full_scan": "2026-03-14T17:10:03",
+      "updated_at": "2026-03-16T17:10:41"
+    }
+"""
+import os
+import json
+import datetime
+import threading
+
+from src import sql_rewrite
+
+
+class WatermarkStore:
+    def __init__(self, state_dir=os.path.join("state", "watermarks")):
+        self.state_dir = state_dir
+        self._lock = threading.Lock()
+
+    def _safe_name(self, name):
+        return "".join([c if c.isalnum() or c in "-_" else "_" for c in name])
+
+    def _path(self, lender_id, table_name):
+        return os.path.join(self.state_dir, self._safe_name(lender_id), f"{self._safe_name(table_name)}.json")
+
+    def _load(self, path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def get(self, lender_id, table_name):
+        with self._lock:
+            return self._load(self._path(lender_id, table_name))
+
+    def save(self, lender_id, table_name, column, value, full_scan):
+        """Records `value` as the table's new high-water mark after a successful run."""
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        previous = self.get(lender_id, table_name) or {}
+        state = {
+            "column": column,
+            "high_water_mark": str(value),
+            "high_water_mark_sql": sql_rewrite.sql_literal(value),
+            "last_full_scan": now if full_scan else previous.get("last_full_scan"),
+            "updated_at": now
+        }
+        path = self._path(lender_id, table_name)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_path, path)
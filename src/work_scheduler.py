@@ -0,0 +1,221 @@
+"""
+Cost-based scheduling of a validation run across worker processes.
+
+Instead of one job per lender, the run is split into small units (a fused scan,
+a single count-first rule, or a table's GX checkpoint; see GXRunner.plan_units)
+that are dispatched longest-first, using each unit's average duration from the
+results store (units without history are sized from their table's on-disk size).
+Every database host gets at most `per_host_limit` queries at a time (a unit
+counts as the statements it can have in flight, see GXRunner.plan_units), so
+adding workers never overloads a single MySQL server. The run then
+finishes close to total work / workers instead of waiting on the biggest lender.
+
+Rule dependencies (`depends_on`, `gate: true`): units holding rules that others
+depend on are dispatched first, and a unit only starts once the lender's units
+holding its dependencies have finished; their statuses go with it so the worker
+can skip rules whose dependency did not pass.
+"""
+import os
+import time
+import logging
+import concurrent.futures
+
+from src import rule_registry
+from src.logging_setup import configure_logging
+
+logger = logging.getLogger('dq_engine')
+
+# Assumed cost (seconds) of a unit with no history yet: slow enough to start early
+DEFAULT_UNIT_COST = 60.0
+
+# Assumed scan speed, to add a table's size to the cost of its units without history
+SCAN_BYTES_PER_SECOND = 100 * 1024 * 1024
+
+
+def _default_cost(table_meta):
+    data_bytes = (table_meta or {}).get('data_bytes')
+    return DEFAULT_UNIT_COST + (data_bytes / SCAN_BYTES_PER_SECOND if data_bytes else 0)
+
+
+# One runner per worker process, reused for every unit the process picks up
+_worker_runner = None
+
+
+def run_unit(unit, deadline, run_id):
+    """
+    Worker entry point: runs one unit with the process's runner. Lives here rather
+    than in daily_job so a freshly spawned worker only imports this module, and
+    src.gx_wrapper (pandas, SQLAlchemy) on its first unit.
+    """
+    # Instantiate inside the worker to avoid PicklingError with ProcessPoolExecutor.
+    # All workers share the run_id so their failed-row files land in one run folder;
+    # engines and table row counts are kept between the units of this process.
+    global _worker_runner
+    if _worker_runner is None:
+        from src.gx_wrapper import GXRunner
+        _worker_runner = GXRunner(run_id=run_id, persistent_engines=True, cache_table_counts=True)
+    elif _worker_runner.run_id != run_id:
+        # A warm pool (the scheduler daemon) keeps the runner and its engines between runs
+        _worker_runner.start_run(run_id)
+    return _worker_runner.run_validation(
+        unit['lender'], specific_table=unit['table'], rule_names=unit['rule_names'], deadline=deadline,
+        check_engine=unit.get('check_engine'), gate_status=unit.get('gate_status'), max_queries=unit.get('queries')
+    )
+
+
+def warm_worker(import_gx=False):
+    """
+    Pool initializer of the scheduler daemon's long-lived workers: logging, the
+    engine modules and a runner are ready before the first unit arrives.
+    """
+    global _worker_runner
+    configure_logging()
+    from src.gx_wrapper import GXRunner
+    _worker_runner = GXRunner(persistent_engines=True, cache_table_counts=True)
+    if import_gx:
+        import great_expectations  # noqa: F401
+
+
+def plan_work(runner, lenders, history=None, check_engine=None, table_metadata=None, selection=None):
+    """
+    Returns one dict per unit: lender, table, rule_names, check_engine, host, queries
+    (statements in flight at once), cost (seconds), rules ((table, rule) pairs it runs), after (the pairs it depends on
+    that other units run) and gating (whether another unit depends on it). `history` maps (lender, table, rule) to an average duration, as returned
+    by ResultsStore.average_durations(); `table_metadata` maps lender to
+    GXRunner.table_metadata() and sizes the units that have no history.
+    `selection` ({table: [rule names]}) limits the work to those rules.
+    """
+    history = history or {}
+    table_metadata = table_metadata or {}
+    units = []
+    for lender_id in lenders:
+        host = runner.lender_host(lender_id)
+        lender_units = []
+        for table_name, rule_names, queries in runner.plan_units(lender_id, check_engine, selection=selection):
+            default_cost = _default_cost(table_metadata.get(lender_id, {}).get(table_name))
+            if rule_names is None:
+                known = [cost for (lid, tbl, _), cost in history.items() if lid == lender_id and tbl == table_name]
+                cost = sum(known) if known else default_cost
+            else:
+                cost = sum(history.get((lender_id, table_name, rule), default_cost) for rule in rule_names)
+            rules = [
+                rule for rule in runner.registry.lender_rules(lender_id, table_name)
+                if rule_names is None or rule.get('name') in rule_names
+            ]
+            provides = [(table_name, rule['name']) for rule in rules if rule.get('name')]
+            lender_units.append({
+                "lender": lender_id,
+                "table": table_name,
+                "rule_names": rule_names,
+                "check_engine": check_engine,
+                "host": host,
+                "queries": queries,
+                "cost": cost,
+                "rules": provides,
+                "after": sorted({d for rule in rules for d in rule.get('dependencies', ())} - set(provides))
+            })
+        depended_on = {d for unit in lender_units for d in unit['after']}
+        for unit in lender_units:
+            unit['gating'] = any(rule in depended_on for rule in unit['rules'])
+        units.extend(lender_units)
+    # Gates first, then longest first
+    units.sort(key=lambda unit: (unit['gating'], unit['cost']), reverse=True)
+    return units
+
+
+def auto_workers(units, per_host_limit):
+    """
+    As many workers as the hosts can take at once. Units mostly wait on MySQL, so the
+    cap is the CPU count but never below the 5 processes the daily job always ran.
+    """
+    host_counts = {}
+    for unit in units:
+        host_counts[unit['host']] = host_counts.get(unit['host'], 0) + 1
+    host_capacity = sum(min(per_host_limit, count) for count in host_counts.values())
+    return max(1, min(host_capacity, max(5, os.cpu_count() or 1)))
+
+
+def run_schedule(units, worker_fn, max_workers, per_host_limit, lender_budgets=None,
+                 executor_cls=concurrent.futures.ProcessPoolExecutor, executor=None):
+    """
+    Runs worker_fn(unit, deadline) for every unit, longest first, and yields
+    (unit, result, error) as they complete. A unit is only started when its host
+    has room for its queries; otherwise the next unit in cost order on another host
+    goes first. A unit wanting more than `per_host_limit` queries runs with that many.
+    `lender_budgets` maps lender -> seconds; the clock starts at the lender's first unit
+    and every unit of that lender gets the same wall-clock deadline.
+    A long-lived `executor` (the scheduler daemon's warm pool) is used and left
+    running; otherwise a pool of `executor_cls` is created for this run.
+    """
+    if executor is not None:
+        yield from _dispatch(units, worker_fn, executor, max_workers, per_host_limit, lender_budgets or {})
+        return
+    # Spawned workers (Windows) start without the parent's logging configuration
+    with executor_cls(max_workers=max_workers, initializer=configure_logging) as run_executor:
+        yield from _dispatch(units, worker_fn, run_executor, max_workers, per_host_limit, lender_budgets or {})
+
+
+def _dispatch(units, worker_fn, executor, max_workers, per_host_limit, lender_budgets):
+    pending = list(units)
+    host_running = {}
+    deadlines = {}
+    running = {}
+    # (lender, table, rule) -> units not finished yet that run it; lender -> {(table, rule): status}
+    unfinished = {}
+    for unit in pending:
+        for table_name, rule in unit.get('rules', ()):
+            key = (unit['lender'], table_name, rule)
+            unfinished[key] = unfinished.get(key, 0) + 1
+    statuses = {}
+
+    def _waiting(unit):
+        return any(unfinished.get((unit['lender'],) + dependency) for dependency in unit.get('after', ()))
+
+    def _queries(unit):
+        return max(1, min(unit.get('queries', 1), per_host_limit))
+
+    def _submit(unit):
+        lender_id = unit['lender']
+        if lender_id not in deadlines:
+            budget = lender_budgets.get(lender_id)
+            deadlines[lender_id] = time.time() + budget if budget else None
+        if unit.get('after'):
+            lender_statuses = statuses.get(lender_id, {})
+            unit = dict(unit, gate_status={d: lender_statuses[d] for d in unit['after'] if d in lender_statuses})
+        unit = dict(unit, queries=_queries(unit))
+        future = executor.submit(worker_fn, unit, deadlines[lender_id])
+        host_running[unit['host']] = host_running.get(unit['host'], 0) + unit['queries']
+        return future
+
+    while pending or running:
+        # Fill free workers with the most expensive units whose host has capacity
+        # and whose dependencies have finished
+        index = 0
+        while len(running) < max_workers and index < len(pending):
+            unit = pending[index]
+            if host_running.get(unit['host'], 0) + _queries(unit) > per_host_limit or _waiting(unit):
+                index += 1
+                continue
+            running[_submit(pending.pop(index))] = unit
+        if not running:
+            # Only whole-table units (incremental or unnamed rules) can wait on each other
+            unit = pending.pop(0)
+            logger.warning(f"{unit['lender']} / {unit['table']}: dependencies wait on each other; running it anyway.")
+            running[_submit(unit)] = unit
+
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            unit = running.pop(future)
+            host_running[unit['host']] -= _queries(unit)
+            try:
+                result, error = future.result(), None
+            except Exception as exc:
+                result, error = None, exc
+            lender_statuses = statuses.setdefault(unit['lender'], {})
+            if result is not None:
+                lender_statuses.update(rule_registry.rule_statuses(result))
+            for table_name, rule in unit.get('rules', ()):
+                # A rule without a result row (crashed unit, lender failure) did not pass
+                lender_statuses.setdefault((table_name, rule), "ERROR")
+                unfinished[(unit['lender'], table_name, rule)] -= 1
+            yield unit, result, error